@@ -0,0 +1,178 @@
+# -*- coding:utf-8 -*-
+
+# ==============================================================================
+# 在同一个语料上比较simhash和minhash两种近似重复查找方法。
+# 1. 语料为文本文件（每行一篇文档，用simhash_dedup.tokenize分词）或合成语料：
+#    先生成n_templates篇模板文档，每篇文档复制一个模板后随机替换0到max_edits个token；
+# 2. 两种方法分别测试fingerprint（批量计算签名）、build（bulk_build建立索引）、
+#    query（随机n_query篇文档的查询）三个阶段的耗时和每秒处理的文档数；
+# 3. 对查询的文档用稀疏的文档×token矩阵计算与所有文档的精确Jaccard相似度，
+#    以相似度不低于threshold的文档为标准，统计两种方法的准确率和召回率。
+# 命令：python dedup_benchmark.py --n_docs 100000 或 python dedup_benchmark.py --input corpus.txt
+# ==============================================================================
+import argparse
+import json
+import random
+import time
+import numpy as np
+import scipy.sparse as sp
+from nlp_basic.minhash_demo import minhash_batch
+from nlp_basic.minhash_index import MinHashIndex
+from nlp_basic.simhash_dedup import iter_documents, tokenize, TOKENIZERS
+from nlp_basic.simhash_demo import simhash_batch
+from nlp_basic.simhash_index import SimHashIndex
+from util.log_util import LoggerUtil
+
+# 日志器
+common_logger = LoggerUtil.get_common_logger()
+
+
+def synthetic_corpus(n_docs, n_templates=None, doc_len=50, vocab_size=20000, max_edits=10, seed=0):
+    """
+    生成带有近似重复的合成语料。
+    :param n_docs: 文档数
+    :param n_templates: 模板数，默认为n_docs // 10
+    :param doc_len: 每篇文档的token数
+    :param vocab_size: 词表大小
+    :param max_edits: 每篇文档最多替换的token数
+    :param seed: 随机种子
+    :return: token列表的列表
+    """
+    rng = random.Random(seed)
+    vocab = ["w{0}".format(i) for i in range(vocab_size)]
+    templates = [rng.sample(vocab, doc_len) for _ in range(n_templates or max(1, n_docs // 10))]
+    documents = []
+    for _ in range(n_docs):
+        document = list(rng.choice(templates))
+        for _ in range(rng.randint(0, max_edits)):
+            document[rng.randrange(doc_len)] = rng.choice(vocab)
+        documents.append(document)
+    return documents
+
+
+def exact_neighbors(documents, queries, threshold):
+    """
+    每篇查询文档与所有文档的精确Jaccard相似度不低于threshold的文档。
+    :param documents: token列表的列表
+    :param queries: 查询文档的下标列表
+    :param threshold: Jaccard相似度的阈值
+    :return: 与queries对应的文档下标集合的列表
+    """
+    vocab = {}
+    rows, cols = [], []
+    for d, tokens in enumerate(documents):
+        for token in set(tokens):
+            rows.append(d)
+            cols.append(vocab.setdefault(token, len(vocab)))
+    binary = sp.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=(len(documents), len(vocab)))
+    sizes = np.diff(binary.indptr)
+    intersections = (binary[queries] * binary.T).tocsr()
+    result = []
+    for i, query in enumerate(queries):
+        start, end = intersections.indptr[i], intersections.indptr[i + 1]
+        others = intersections.indices[start:end]
+        shared = intersections.data[start:end]
+        similarity = shared / np.maximum(sizes[query] + sizes[others] - shared, 1).astype(np.float64)
+        result.append(set(others[similarity >= threshold].tolist()))
+    return result
+
+
+def _timed(records, method, stage, func, n_docs):
+    """
+    执行一个阶段并记录耗时和每秒处理的文档数。
+    :param records: 结果列表
+    :param method: 方法名称
+    :param stage: 阶段名称
+    :param func: 无参数的函数
+    :param n_docs: 本阶段处理的文档数
+    :return: func的返回值
+    """
+    start_time = time.perf_counter()
+    result = func()
+    wall_time = time.perf_counter() - start_time
+    records.append({"method": method, "stage": stage, "wall_time": wall_time, "docs": n_docs,
+                    "docs_per_sec": n_docs / wall_time if wall_time > 0 else None})
+    common_logger.info("{0} {1}: {2:.3f}s".format(method, stage, wall_time))
+    return result
+
+
+def _accuracy(found, truth):
+    """
+    准确率和召回率。
+    :param found: 每篇查询文档找到的文档下标集合
+    :param truth: 每篇查询文档的标准结果
+    :return:
+    """
+    hit = sum(len(f & t) for f, t in zip(found, truth))
+    n_found = sum(len(f) for f in found)
+    n_truth = sum(len(t) for t in truth)
+    return {"precision": hit / float(n_found) if n_found else None,
+            "recall": hit / float(n_truth) if n_truth else None}
+
+
+def run_benchmark(documents, k=3, threshold=0.8, num_perm=128, n_query=1000, seed=0):
+    """
+    在同一个语料上测试simhash和minhash。
+    :param documents: token列表的列表
+    :param k: simhash的海明距离阈值
+    :param threshold: minhash和标准结果的Jaccard相似度阈值
+    :param num_perm: minhash签名的长度
+    :param n_query: 查询的文档数
+    :param seed: 随机种子
+    :return: 结果字典
+    """
+    n_docs = len(documents)
+    queries = random.Random(seed).sample(range(n_docs), min(n_query, n_docs))
+    truth = exact_neighbors(documents, queries, threshold)
+    records = []
+
+    fingerprints = _timed(records, "simhash", "fingerprint",
+                          lambda: simhash_batch(documents, 64, as_array=True), n_docs)
+    simhash_index = SimHashIndex(k=k, f=64)
+    _timed(records, "simhash", "build", lambda: simhash_index.bulk_build(fingerprints), n_docs)
+    simhash_found = _timed(records, "simhash", "query",
+                           lambda: [set(doc for doc, _ in simhash_index.query(fingerprints[q])) for q in queries],
+                           len(queries))
+
+    signatures = _timed(records, "minhash", "fingerprint", lambda: minhash_batch(documents, num_perm), n_docs)
+    minhash_index = MinHashIndex(threshold=threshold, num_perm=num_perm)
+    _timed(records, "minhash", "build", lambda: minhash_index.bulk_build(signatures), n_docs)
+    minhash_found = _timed(records, "minhash", "query",
+                           lambda: [set(doc for doc, _ in minhash_index.query(signatures[q])) for q in queries],
+                           len(queries))
+
+    return {"n_docs": n_docs,
+            "n_query": len(queries),
+            "params": {"k": k, "threshold": threshold, "num_perm": num_perm,
+                       "bands": [minhash_index.b, minhash_index.r]},
+            "results": records,
+            "accuracy": {"simhash": _accuracy(simhash_found, truth),
+                         "minhash": _accuracy(minhash_found, truth)}}
+
+
+def test_dedup_benchmark():
+    """
+    在2万篇合成文档上比较simhash和minhash。
+    :return:
+    """
+    result = run_benchmark(synthetic_corpus(20000), n_query=200)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="compare simhash and minhash near-duplicate detection")
+    parser.add_argument("--input", default=None, help="text file with one document per line, synthetic when omitted")
+    parser.add_argument("--tokenizer", default="jieba", choices=TOKENIZERS)
+    parser.add_argument("--n_docs", type=int, default=100000, help="size of the synthetic corpus")
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--threshold", type=float, default=0.8)
+    parser.add_argument("--num_perm", type=int, default=128)
+    parser.add_argument("--n_query", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    if args.input is None:
+        corpus = synthetic_corpus(args.n_docs, seed=args.seed)
+    else:
+        corpus = [tokenize(text, args.tokenizer) for _, text in iter_documents(args.input)]
+    print(json.dumps(run_benchmark(corpus, args.k, args.threshold, args.num_perm, args.n_query, args.seed),
+                     indent=2))
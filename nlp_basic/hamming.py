@@ -0,0 +1,140 @@
+# -*- coding:utf-8 -*-
+
+# ==============================================================================
+# uint64数组上的海明距离计算。
+# 海明距离为两个值异或后1的个数（popcount）：
+# 1. numpy 2.0以上使用np.bitwise_count，一次得到每个元素的popcount；
+# 2. 旧版本numpy用65536项的查找表，把64位分成4个16位依次查表累加，
+#    给定阈值时每累加一段就去掉已经超过阈值的元素，后面的段只计算剩下的元素（提前终止）。
+# hamming_one_to_many计算一个查询值与大量simhash的距离，
+# hamming_many_to_many按块计算多个查询值与大量simhash的距离，每块的临时数组大小不超过block_size，
+# 给定阈值时两者都只返回距离不超过阈值的结果，内存与结果个数成正比。
+# ==============================================================================
+import numpy as np
+
+# 16位的popcount查找表
+POPCOUNT_TABLE16 = np.array([bin(i).count("1") for i in range(1 << 16)], dtype=np.uint8)
+# 默认每块计算的元素个数
+DEFAULT_BLOCK_SIZE = 1 << 20
+
+
+def popcount(values):
+    """
+    计算uint64数组每个元素中1的个数。
+    :param values: uint64数组
+    :return: 形状相同的uint8数组
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    counts = np.zeros(values.shape, dtype=np.uint8)
+    for shift in (0, 16, 32, 48):
+        counts += POPCOUNT_TABLE16[(values >> np.uint64(shift)) & np.uint64(0xffff)]
+    return counts
+
+
+def _threshold_popcount(values, threshold):
+    """
+    找出popcount不超过threshold的元素，查表时每16位去掉一次已经超过阈值的元素。
+    :param values: uint64数组
+    :param threshold: 阈值
+    :return: (元素下标, popcount)
+    """
+    if hasattr(np, "bitwise_count"):
+        counts = np.bitwise_count(values)
+        index = np.flatnonzero(counts <= threshold)
+        return index, counts[index]
+    index = np.arange(len(values))
+    counts = np.zeros(len(values), dtype=np.uint8)
+    for shift in (0, 16, 32, 48):
+        counts += POPCOUNT_TABLE16[(values >> np.uint64(shift)) & np.uint64(0xffff)]
+        keep = counts <= threshold
+        if not keep.all():
+            index, values, counts = index[keep], values[keep], counts[keep]
+    return index, counts
+
+
+def hamming_one_to_many(query, fingerprints, threshold=None, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    计算一个simhash与多个simhash的海明距离。
+    :param query: simhash值
+    :param fingerprints: uint64数组
+    :param threshold: 为None时返回所有距离，否则只返回距离不超过阈值的结果
+    :param block_size: 每次计算的元素个数
+    :return: threshold为None时为uint8距离数组，否则为(下标数组, 距离数组)
+    """
+    fingerprints = np.asarray(fingerprints, dtype=np.uint64)
+    query = np.uint64(query)
+    if threshold is None:
+        result = np.empty(len(fingerprints), dtype=np.uint8)
+        for start in range(0, len(fingerprints), block_size):
+            result[start:start + block_size] = popcount(fingerprints[start:start + block_size] ^ query)
+        return result
+    indices = []
+    distances = []
+    for start in range(0, len(fingerprints), block_size):
+        index, counts = _threshold_popcount(fingerprints[start:start + block_size] ^ query, threshold)
+        indices.append(index + start)
+        distances.append(counts)
+    if not indices:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint8)
+    return np.concatenate(indices), np.concatenate(distances)
+
+
+def hamming_many_to_many(queries, fingerprints, threshold=None, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    按块计算多个simhash与多个simhash两两之间的海明距离，每块约block_size个元素。
+    :param queries: uint64数组
+    :param fingerprints: uint64数组
+    :param threshold: 为None时返回完整的距离矩阵，否则只返回距离不超过阈值的结果
+    :param block_size: 每块计算的元素个数，控制临时数组的内存
+    :return: threshold为None时为(len(queries), len(fingerprints))的uint8矩阵，
+    否则为(查询下标数组, simhash下标数组, 距离数组)
+    """
+    queries = np.asarray(queries, dtype=np.uint64)
+    fingerprints = np.asarray(fingerprints, dtype=np.uint64)
+    n_queries, n = len(queries), len(fingerprints)
+    # 每块的列数和行数
+    cols = max(1, min(n, block_size))
+    rows = max(1, block_size // cols)
+    if threshold is None:
+        result = np.empty((n_queries, n), dtype=np.uint8)
+    else:
+        query_index, fingerprint_index, distances = [], [], []
+    for row_start in range(0, n_queries, rows):
+        query_block = queries[row_start:row_start + rows, np.newaxis]
+        for col_start in range(0, n, cols):
+            xor = query_block ^ fingerprints[np.newaxis, col_start:col_start + cols]
+            if threshold is None:
+                result[row_start:row_start + rows, col_start:col_start + cols] = popcount(xor)
+                continue
+            index, counts = _threshold_popcount(xor.ravel(), threshold)
+            width = xor.shape[1]
+            query_index.append(index // width + row_start)
+            fingerprint_index.append(index % width + col_start)
+            distances.append(counts)
+    if threshold is None:
+        return result
+    if not distances:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, np.zeros(0, dtype=np.uint8)
+    return np.concatenate(query_index), np.concatenate(fingerprint_index), np.concatenate(distances)
+
+
+def test_hamming():
+    """
+    测试一个查询值与100万个simhash的海明距离。
+    :return:
+    """
+    import time
+    rng = np.random.RandomState(0)
+    fingerprints = rng.randint(0, 1 << 62, size=10 ** 6, dtype=np.int64).astype(np.uint64)
+    start_time = time.perf_counter()
+    index, distances = hamming_one_to_many(fingerprints[0], fingerprints, threshold=3)
+    print("{0} matches in {1:.2f}ms".format(len(index), (time.perf_counter() - start_time) * 1000))
+    query_index, fingerprint_index, distances = hamming_many_to_many(fingerprints[:100], fingerprints, threshold=3)
+    print("{0} pairs within distance 3".format(len(distances)))
+
+
+if __name__ == '__main__':
+    test_hamming()
@@ -0,0 +1,300 @@
+# -*- coding:utf-8 -*-
+
+# ==============================================================================
+# 预编译、内存映射的jieba词典。
+# jieba在每个进程中初始化时要从缓存中读出约60万个词（含前缀）的FREQ字典，
+# 再执行load_userdict、add_word、suggest_freq，每个进程需要一秒左右，内存也不能在进程之间共享。
+# 1. compile_dictionary用jieba_segment.create_tokenizer加载主词典、用户词典并调整词频，
+#    然后把最终的FREQ编译为前缀树，保存为.npy文件：
+#    按层（词长）编号节点，同一父节点的子节点连续、按字符的码位排列，
+#    indptr[p]:indptr[p + 1]为节点p的子节点在child_chars中的范围，第j个子节点的编号为j + 1；
+#    freqs为每个节点的词频（只是前缀时为0），log_weights为log(词频或1) - log(total)，与jieba的calc相同；
+# 2. MappedTokenizer继承jieba.Tokenizer，以只读内存映射的方式打开这些文件，初始化只需要几毫秒，
+#    多个进程映射同一个文件时共享物理内存。数组通过memoryview按下标读取，得到python的int和float；
+# 3. get_DAG沿前缀树逐字向后查找，在子节点中用bisect二分查找下一个字符，同时记录每条边的权重，
+#    calc直接使用这些权重，不再对每条边切片查字典；
+# 4. FREQ为MappedFreq，支持jieba其他方法用到的in、get、[]。加载后再调用add_word等方法时写入FREQ的覆盖字典，
+#    此后get_DAG和calc退回jieba原来的实现，结果仍然正确。
+# 命令：python jieba_dict_cache.py output_dir --user_dict userdict.txt --add_word 石墨烯 --suggest_freq 中,将
+# ==============================================================================
+import os
+import io
+import json
+import math
+import time
+import bisect
+import argparse
+import tempfile
+import collections
+import numpy as np
+import jieba
+from util.log_util import LoggerUtil
+from util.os_util import OsUtil
+
+# 日志器
+common_logger = LoggerUtil.get_common_logger()
+
+ARRAY_NAMES = ("indptr", "child_chars", "freqs", "log_weights", "params")
+
+
+def build_trie(freq, total):
+    """
+    把jieba的FREQ编译为按层编号的前缀树。
+    :param freq: {词: 词频}，前缀的词频为0
+    :param total: 词频总和
+    :return: 数组名到数组的字典
+    """
+    freq = dict(freq)
+    # jieba的FREQ包含所有前缀，这里再补全一次，保证每个节点的父节点存在
+    for word in list(freq):
+        for end in range(1, len(word)):
+            freq.setdefault(word[:end], 0)
+    by_length = collections.defaultdict(list)
+    for word in freq:
+        by_length[len(word)].append(word)
+    ids = {u"": 0}
+    parents = [0]
+    chars = [0]
+    freqs = [0]
+    for length in range(1, max(by_length) + 1 if by_length else 1):
+        level = by_length[length]
+        level.sort(key=lambda w: (ids[w[:-1]], w[-1]))
+        for word in level:
+            ids[word] = len(freqs)
+            parents.append(ids[word[:-1]])
+            chars.append(ord(word[-1]))
+            freqs.append(freq[word])
+    n_nodes = len(freqs)
+    counts = np.bincount(np.array(parents[1:], dtype=np.int64), minlength=n_nodes)
+    log_total = math.log(total)
+    return {"indptr": np.concatenate(([0], np.cumsum(counts))).astype(np.int64),
+            "child_chars": np.array(chars[1:], dtype=np.uint32),
+            "freqs": np.array(freqs, dtype=np.int64),
+            "log_weights": np.array([math.log(f or 1) - log_total for f in freqs], dtype=np.float64),
+            "params": np.array([total, n_nodes], dtype=np.int64)}
+
+
+def compile_dictionary(path, dictionary=None, user_dicts=(), add_words=(), del_words=(), freqs=()):
+    """
+    加载词典并调整词频后编译为内存映射的前缀树。
+    :param path: 输出目录
+    :param dictionary: 主词典文件，默认为jieba自带的词典
+    :param user_dicts: 用户词典文件列表
+    :param add_words: 添加的词，元素为词或(词, 词频, 词性)
+    :param del_words: 删除的词
+    :param freqs: 调整词频的词或切分
+    :return:
+    """
+    from nlp_basic.jieba_segment import create_tokenizer
+    tokenizer = create_tokenizer(dictionary, user_dicts, add_words, del_words, freqs)
+    arrays = build_trie(tokenizer.FREQ, tokenizer.total)
+    OsUtil.makedirs(path)
+    for name, array in arrays.items():
+        np.save(os.path.join(path, name + ".npy"), array)
+    meta = {"dictionary": None if dictionary is None else os.path.abspath(dictionary),
+            "user_word_tag_tab": tokenizer.user_word_tag_tab,
+            "jieba_version": jieba.__version__}
+    with io.open(os.path.join(path, "meta.json"), "w", encoding="utf-8") as f:
+        f.write(json.dumps(meta, ensure_ascii=False))
+    common_logger.info("compiled {0} trie nodes into {1}".format(len(arrays["freqs"]), path))
+
+
+class MappedFreq(object):
+    def __init__(self, tokenizer):
+        """
+        前缀树上的FREQ，新加入或修改的词保存在overlay中。
+        :param tokenizer: MappedTokenizer
+        """
+        self.tokenizer = tokenizer
+        self.overlay = {}
+
+    def _node(self, word):
+        """
+        词在前缀树中的节点编号。
+        :param word:
+        :return: 不存在时为-1
+        """
+        if not word:
+            return -1
+        tokenizer = self.tokenizer
+        node = tokenizer.root.get(word[0], -1)
+        for char in word[1:]:
+            if node < 0:
+                break
+            node = tokenizer.child(node, ord(char))
+        return node
+
+    def get(self, word, default=None):
+        if word in self.overlay:
+            return self.overlay[word]
+        node = self._node(word)
+        return default if node < 0 else self.tokenizer.freqs[node]
+
+    def __contains__(self, word):
+        return word in self.overlay or self._node(word) >= 0
+
+    def __getitem__(self, word):
+        value = self.get(word, self)
+        if value is self:
+            raise KeyError(word)
+        return value
+
+    def __setitem__(self, word, value):
+        self.overlay[word] = value
+
+    def __len__(self):
+        return len(self.tokenizer.freqs) - 1 + sum(1 for word in self.overlay if self._node(word) < 0)
+
+
+class MappedTokenizer(jieba.Tokenizer):
+    def __init__(self, path):
+        """
+        以只读内存映射的方式打开compile_dictionary编译的词典。
+        :param path: compile_dictionary的输出目录
+        """
+        with io.open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.loads(f.read())
+        jieba.Tokenizer.__init__(self, meta["dictionary"] or jieba.DEFAULT_DICT)
+        self.path = path
+        self.arrays = dict((name, np.load(os.path.join(path, name + ".npy"), mmap_mode="r")) for name in ARRAY_NAMES)
+        self.indptr = memoryview(self.arrays["indptr"])
+        self.child_chars = memoryview(self.arrays["child_chars"])
+        self.freqs = memoryview(self.arrays["freqs"])
+        self.log_weights = memoryview(self.arrays["log_weights"])
+        # 根节点的子节点最多，用字典查找
+        n_root = self.indptr[1]
+        self.root = dict((chr(code), j + 1) for j, code in enumerate(self.arrays["child_chars"][:n_root].tolist()))
+        self.total = int(self.arrays["params"][0])
+        self.FREQ = MappedFreq(self)
+        self.user_word_tag_tab = meta["user_word_tag_tab"]
+        self.initialized = True
+        self._last_weights = None
+
+    def __repr__(self):
+        return "<MappedTokenizer path={0!r}>".format(self.path)
+
+    def initialize(self, dictionary=None):
+        """
+        词典在加载时已经初始化，不能更换。
+        :param dictionary:
+        :return:
+        """
+        if dictionary is not None:
+            raise ValueError("MappedTokenizer cannot change its dictionary, compile a new one instead")
+
+    def child(self, node, code):
+        """
+        节点node中字符码位为code的子节点。
+        :param node:
+        :param code:
+        :return: 不存在时为-1
+        """
+        start, end = self.indptr[node], self.indptr[node + 1]
+        j = bisect.bisect_left(self.child_chars, code, start, end)
+        return j + 1 if j < end and self.child_chars[j] == code else -1
+
+    def get_DAG(self, sentence):
+        """
+        沿前缀树生成有向无环图，结果与jieba.Tokenizer.get_DAG相同，同时记录每条边的权重供calc使用。
+        :param sentence:
+        :return: {起始位置: [结束位置]}
+        """
+        if self.FREQ.overlay:
+            return jieba.Tokenizer.get_DAG(self, sentence)
+        root, indptr, child_chars = self.root, self.indptr, self.child_chars
+        freqs, log_weights = self.freqs, self.log_weights
+        bisect_left = bisect.bisect_left
+        # 不在词典中的单字的权重：log(1) - log(total)
+        unknown_weight = -math.log(self.total)
+        dag = {}
+        weights = {}
+        n = len(sentence)
+        for k in range(n):
+            ends = []
+            end_weights = []
+            node = root.get(sentence[k], -1)
+            i = k
+            while node >= 0:
+                if freqs[node]:
+                    ends.append(i)
+                    end_weights.append(log_weights[node])
+                i += 1
+                if i >= n:
+                    break
+                start, end = indptr[node], indptr[node + 1]
+                # 大部分节点没有或只有一个子节点，不需要二分查找
+                if start == end:
+                    break
+                code = ord(sentence[i])
+                if end - start == 1:
+                    node = end if child_chars[start] == code else -1
+                else:
+                    j = bisect_left(child_chars, code, start, end)
+                    node = j + 1 if j < end and child_chars[j] == code else -1
+            if not ends:
+                ends.append(k)
+                end_weights.append(unknown_weight)
+            dag[k] = ends
+            weights[k] = end_weights
+        self._last_weights = (dag, weights)
+        return dag
+
+    def calc(self, sentence, DAG, route):
+        """
+        动态规划求最大概率路径，DAG由get_DAG生成时使用记录的边权重。
+        :param sentence:
+        :param DAG:
+        :param route:
+        :return:
+        """
+        last_weights = self._last_weights
+        if last_weights is None or last_weights[0] is not DAG:
+            return jieba.Tokenizer.calc(self, sentence, DAG, route)
+        weights = last_weights[1]
+        n = len(sentence)
+        route[n] = (0, 0)
+        for idx in range(n - 1, -1, -1):
+            ends = DAG[idx]
+            if len(ends) == 1:
+                x = ends[0]
+                route[idx] = (weights[idx][0] + route[x + 1][0], x)
+            else:
+                route[idx] = max((weight + route[x + 1][0], x) for x, weight in zip(ends, weights[idx]))
+
+
+def test_mapped_tokenizer():
+    """
+    测试编译词典，比较初始化时间和分词结果。
+    :return:
+    """
+    user_dict = os.path.join(os.path.dirname(os.path.abspath(__file__)), "userdict.txt")
+    config = {"user_dicts": [user_dict], "add_words": ["石墨烯", "凯特琳"], "del_words": ["自定义词"],
+              "freqs": [("中", "将"), "台中"]}
+    path = os.path.join(tempfile.gettempdir(), "jieba_dict_cache")
+    compile_dictionary(path, **config)
+
+    from nlp_basic.jieba_segment import create_tokenizer
+    start_time = time.perf_counter()
+    tokenizer = create_tokenizer(**config)
+    common_logger.info("jieba.Tokenizer: {0:.3f}s".format(time.perf_counter() - start_time))
+    start_time = time.perf_counter()
+    mapped = MappedTokenizer(path)
+    common_logger.info("MappedTokenizer: {0:.3f}s".format(time.perf_counter() - start_time))
+
+    sentence = "李小福是创新办主任也是云计算方面的专家; 什么是八一双鹿。「台中」正確應該不會被切開。如果放到post中将出错。"
+    common_logger.info("/".join(tokenizer.lcut(sentence)))
+    common_logger.info("/".join(mapped.lcut(sentence)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="compile jieba dictionaries into a memory-mapped trie")
+    parser.add_argument("output", help="output directory")
+    parser.add_argument("--dictionary", default=None, help="main dictionary, jieba's default when omitted")
+    parser.add_argument("--user_dict", action="append", default=[], help="user dictionary, can be repeated")
+    parser.add_argument("--add_word", action="append", default=[], help="word to add, can be repeated")
+    parser.add_argument("--del_word", action="append", default=[], help="word to delete, can be repeated")
+    parser.add_argument("--suggest_freq", action="append", default=[],
+                        help="word or comma separated segments passed to suggest_freq, can be repeated")
+    args = parser.parse_args()
+    segments = [tuple(segment.split(",")) if "," in segment else segment for segment in args.suggest_freq]
+    compile_dictionary(args.output, args.dictionary, args.user_dict, args.add_word, args.del_word, segments)
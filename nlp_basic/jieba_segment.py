@@ -0,0 +1,292 @@
+# -*- coding:utf-8 -*-
+
+# ==============================================================================
+# 多进程批量分词。
+# jieba_demo中每次调用jieba.cut只处理一句话，自定义词典也在调用时才加载，大量文本只能使用一个CPU。
+# 1. 每个工作进程在启动时（Pool的initializer）创建一个jieba.Tokenizer，加载主词典、用户词典，
+#    并执行add_word、del_word、suggest_freq，之后的所有分词任务都复用这个Tokenizer；
+# 2. 文本按chunk_size篇一块提交给进程池，同时进行中的块不超过max_pending个，
+#    按提交顺序取回结果，因此结果的顺序与输入相同，输入可以是很大的生成器，内存有上限；
+# 3. 记录处理的文本数、字符数和每秒处理的字符数，每report_every篇文本打印一次。
+# n_jobs为1时在当前进程中分词，不创建进程池。
+# 给定compiled时每个进程以内存映射的方式打开jieba_dict_cache编译的词典，初始化只需要几毫秒，进程之间共享内存。
+# 其他按块在工作进程中执行的任务（如关键词提取）可以通过imap或map_chunks复用同一个进程池和Tokenizer。
+# ==============================================================================
+import os
+import time
+import itertools
+import collections
+import multiprocessing
+from util.log_util import LoggerUtil
+
+# 日志器
+common_logger = LoggerUtil.get_common_logger()
+
+# 分词模式：精确模式、全模式、搜索引擎模式
+MODES = ("default", "full", "search")
+# 工作进程中的Tokenizer
+_tokenizer = None
+
+
+def create_tokenizer(dictionary=None, user_dicts=(), add_words=(), del_words=(), freqs=(), compiled=None):
+    """
+    创建并初始化jieba.Tokenizer。
+    :param dictionary: 主词典文件，默认为jieba自带的词典
+    :param user_dicts: 用户词典文件列表
+    :param add_words: 添加的词，元素为词或(词, 词频, 词性)
+    :param del_words: 删除的词
+    :param freqs: 调整词频的词或切分，元素与jieba.suggest_freq的segment参数相同
+    :param compiled: jieba_dict_cache.compile_dictionary编译的词典目录，给定时以内存映射的方式加载，
+    词典和词频的调整应当在编译时完成，这里的调整会使分词退回jieba原来较慢的实现
+    :return: jieba.Tokenizer
+    """
+    if compiled is not None:
+        from nlp_basic.jieba_dict_cache import MappedTokenizer
+        tokenizer = MappedTokenizer(compiled)
+    else:
+        import jieba
+        tokenizer = jieba.Tokenizer() if dictionary is None else jieba.Tokenizer(dictionary)
+        tokenizer.initialize()
+    for user_dict in user_dicts:
+        tokenizer.load_userdict(user_dict)
+    for word in add_words:
+        if isinstance(word, (tuple, list)):
+            tokenizer.add_word(*word)
+        else:
+            tokenizer.add_word(word)
+    for word in del_words:
+        tokenizer.del_word(word)
+    for segment in freqs:
+        tokenizer.suggest_freq(segment, True)
+    return tokenizer
+
+
+def cut(tokenizer, text, mode="default", hmm=True):
+    """
+    用指定的模式分词。
+    :param tokenizer: jieba.Tokenizer
+    :param text: 文本
+    :param mode: default（精确模式）、full（全模式）或search（搜索引擎模式）
+    :param hmm: 是否使用HMM模型识别新词
+    :return: 词列表
+    """
+    if mode == "default":
+        return tokenizer.lcut(text, cut_all=False, HMM=hmm)
+    if mode == "full":
+        return tokenizer.lcut(text, cut_all=True, HMM=hmm)
+    if mode == "search":
+        return tokenizer.lcut_for_search(text, HMM=hmm)
+    raise ValueError("mode must be one of {0}".format(MODES))
+
+
+def segment_chunk(tokenizer, texts, mode="default", hmm=True):
+    """
+    对一块文本分词，可以作为imap的func。
+    :param tokenizer: jieba.Tokenizer
+    :param texts: 文本列表
+    :param mode: 分词模式
+    :param hmm: 是否使用HMM模型
+    :return: 每篇文本的词列表
+    """
+    return [cut(tokenizer, text, mode, hmm) for text in texts]
+
+
+def _init_worker(tokenizer_config):
+    """
+    工作进程的初始化函数，只执行一次。
+    :param tokenizer_config: create_tokenizer的参数
+    :return:
+    """
+    global _tokenizer
+    _tokenizer = create_tokenizer(**tokenizer_config)
+
+
+def _run_chunk(func, texts, args):
+    """
+    在工作进程中用该进程的Tokenizer执行func。
+    :param func: 模块级函数func(tokenizer, texts, *args)
+    :param texts: 文本列表
+    :param args: func的其他参数
+    :return:
+    """
+    return func(_tokenizer, texts, *args)
+
+
+class JiebaSegmenter(object):
+    def __init__(self, n_jobs=-1, chunk_size=256, max_pending=None, report_every=100000, **tokenizer_config):
+        """
+        构造函数，创建进程池，每个进程初始化一次Tokenizer。
+        :param n_jobs: 进程数，-1表示使用所有CPU，1表示在当前进程中分词
+        :param chunk_size: 每个任务的文本数
+        :param max_pending: 同时进行中的任务数，默认为2 * n_jobs
+        :param report_every: 每处理多少篇文本打印一次速度，为None时不打印
+        :param tokenizer_config: create_tokenizer的参数：dictionary、user_dicts、add_words、del_words、freqs、compiled
+        """
+        if n_jobs == -1:
+            n_jobs = os.cpu_count() or 1
+        self.n_jobs = max(1, n_jobs)
+        self.chunk_size = chunk_size
+        self.max_pending = max_pending or 2 * self.n_jobs
+        self.report_every = report_every
+        self.stats = {"texts": 0, "chars": 0, "seconds": 0.0}
+        if self.n_jobs == 1:
+            self.pool = None
+            self.tokenizer = create_tokenizer(**tokenizer_config)
+        else:
+            self.pool = multiprocessing.Pool(self.n_jobs, initializer=_init_worker, initargs=(tokenizer_config,))
+            self.tokenizer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        关闭进程池。
+        :return:
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def _chunks(self, texts):
+        """
+        把文本流切分为块。
+        :param texts: 文本的可迭代对象
+        :return: 文本列表的生成器
+        """
+        texts = iter(texts)
+        while True:
+            chunk = list(itertools.islice(texts, self.chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+    def _collect(self, chunk, result):
+        """
+        取回一块的结果并更新统计。
+        :param chunk: 文本列表
+        :param result: 结果或AsyncResult
+        :return: 结果
+        """
+        if self.pool is not None:
+            result = result.get()
+        now = time.perf_counter()
+        self.stats["texts"] += len(chunk)
+        self.stats["chars"] += sum(len(text) for text in chunk)
+        self.stats["seconds"] += now - self._last_time
+        self._last_time = now
+        if self.report_every and self.stats["texts"] >= self._next_report:
+            self._next_report = (self.stats["texts"] // self.report_every + 1) * self.report_every
+            self.log_stats()
+        return result
+
+    def map_chunks(self, func, texts, *args):
+        """
+        按块在工作进程中执行func(tokenizer, chunk, *args)，按输入顺序逐块返回结果。
+        :param func: 模块级函数
+        :param texts: 文本的可迭代对象
+        :param args: func的其他参数，必须可以pickle
+        :return: 每块结果的生成器
+        """
+        self._last_time = time.perf_counter()
+        self._next_report = (self.stats["texts"] // self.report_every + 1) * self.report_every \
+            if self.report_every else None
+        pending = collections.deque()
+        for chunk in self._chunks(texts):
+            if self.pool is None:
+                pending.append((chunk, func(self.tokenizer, chunk, *args)))
+            else:
+                pending.append((chunk, self.pool.apply_async(_run_chunk, (func, chunk, args))))
+            if len(pending) >= self.max_pending:
+                yield self._collect(*pending.popleft())
+        while pending:
+            yield self._collect(*pending.popleft())
+
+    def imap(self, func, texts, *args):
+        """
+        按块在工作进程中执行func(tokenizer, chunk, *args)，按输入顺序逐篇返回结果。
+        :param func: 模块级函数，返回与chunk等长的列表
+        :param texts: 文本的可迭代对象
+        :param args: func的其他参数，必须可以pickle
+        :return: 每篇文本结果的生成器
+        """
+        for result in self.map_chunks(func, texts, *args):
+            for item in result:
+                yield item
+
+    def segment_stream(self, texts, mode="default", hmm=True):
+        """
+        流式分词，按输入顺序逐篇返回词列表。
+        :param texts: 文本的可迭代对象
+        :param mode: default（精确模式）、full（全模式）或search（搜索引擎模式）
+        :param hmm: 是否使用HMM模型
+        :return: 词列表的生成器
+        """
+        if mode not in MODES:
+            raise ValueError("mode must be one of {0}".format(MODES))
+        return self.imap(segment_chunk, texts, mode, hmm)
+
+    def segment_batch(self, texts, mode="default", hmm=True):
+        """
+        对一批文本分词。
+        :param texts: 文本的可迭代对象
+        :param mode: 分词模式
+        :param hmm: 是否使用HMM模型
+        :return: 词列表的列表
+        """
+        result = list(self.segment_stream(texts, mode, hmm))
+        self.log_stats()
+        return result
+
+    def chars_per_sec(self):
+        """
+        每秒处理的字符数。
+        :return:
+        """
+        return self.stats["chars"] / self.stats["seconds"] if self.stats["seconds"] > 0 else 0.0
+
+    def log_stats(self):
+        """
+        打印处理的文本数和速度。
+        :return:
+        """
+        common_logger.info("segmented {0} texts, {1} chars, {2:.0f} chars/sec".format(
+            self.stats["texts"], self.stats["chars"], self.chars_per_sec()))
+
+
+def segment_batch(texts, mode="default", hmm=True, n_jobs=-1, **tokenizer_config):
+    """
+    用临时的进程池对一批文本分词，多次调用时应复用JiebaSegmenter，避免重复初始化词典。
+    :param texts: 文本的可迭代对象
+    :param mode: default（精确模式）、full（全模式）或search（搜索引擎模式）
+    :param hmm: 是否使用HMM模型
+    :param n_jobs: 进程数，-1表示使用所有CPU
+    :param tokenizer_config: create_tokenizer的参数
+    :return: 词列表的列表
+    """
+    with JiebaSegmenter(n_jobs, **tokenizer_config) as segmenter:
+        return segmenter.segment_batch(texts, mode, hmm)
+
+
+def test_segment_batch():
+    """
+    测试多进程分词和用户词典。
+    :return:
+    """
+    texts = ["李小福是创新办主任也是云计算方面的专家; 什么是八一双鹿",
+             "「台中」正確應該不會被切開。mac上可分出「石墨烯」；此時又可以分出來凯特琳了。",
+             "如果放到post中将出错。"] * 100
+    user_dict = os.path.join(os.path.dirname(os.path.abspath(__file__)), "userdict.txt")
+    with JiebaSegmenter(n_jobs=2, chunk_size=16, user_dicts=[user_dict], add_words=["石墨烯", "凯特琳"],
+                        del_words=["自定义词"], freqs=[("中", "将")]) as segmenter:
+        for mode in MODES:
+            words = segmenter.segment_batch(texts, mode, hmm=False)
+            common_logger.info("{0}: {1}".format(mode, "/".join(words[0] + words[1] + words[2])))
+
+
+if __name__ == '__main__':
+    test_segment_batch()
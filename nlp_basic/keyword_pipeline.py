@@ -0,0 +1,371 @@
+# -*- coding:utf-8 -*-
+
+# ==============================================================================
+# 大规模语料的关键词提取。
+# jieba_demo中的extract_tags和textrank每次处理一段文本，使用jieba自带的IDF表，不能反映语料本身的词分布。
+# 1. 学习IDF：用JiebaSegmenter的进程池流式分词，每个工作进程把一块文档中每篇出现的词计数为一个Counter，
+#    主进程只合并每块的Counter，因此进程间传输的数据量与块内不同的词数成正比，而不是与文档数成正比；
+# 2. 词表有上限：不同的词超过max_terms个时删除文档频率上界最低的一半（lossy counting），
+#    删除后新加入的词记录可能少计的文档频率（不超过max_error），高频词不会被删除，
+#    只有低频词的文档频率可能偏小、IDF偏大，对关键词排序影响很小；
+# 3. IDF为log(文档数 / 文档频率)，按jieba的格式（每行"词 IDF"）保存到文件，
+#    可以直接用于jieba.analyse.TFIDF(idf_path)或jieba.analyse.set_idf_path，也作为下次运行的缓存；
+# 4. 提取关键词：工作进程按IDF文件创建一次TFIDF或TextRank提取器（分词使用该进程的Tokenizer），
+#    之后的任务复用，每篇文档返回top_k个(词, 权重)，结果按输入顺序流式返回，内存有上限。
+# 命令：python keyword_pipeline.py corpus.txt keywords.tsv --idf idf.txt --n_jobs -1
+# ==============================================================================
+import argparse
+import collections
+import io
+import math
+import os
+import tempfile
+import numpy as np
+import jieba.analyse
+import jieba.posseg
+from nlp_basic.jieba_segment import JiebaSegmenter
+from nlp_basic.simhash_dedup import iter_documents
+from util.log_util import LoggerUtil
+from util.os_util import OsUtil
+
+# 日志器
+common_logger = LoggerUtil.get_common_logger()
+
+# 关键词提取方法
+METHODS = ("tfidf", "textrank")
+# jieba关键词提取默认的停用词
+STOP_WORDS = frozenset(jieba.analyse.TFIDF.STOP_WORDS)
+# 工作进程中的关键词提取器
+_extractors = {}
+
+
+def document_terms(words, stop_words=STOP_WORDS):
+    """
+    文档中参与关键词提取的词，过滤规则与jieba.analyse.TFIDF.extract_tags相同。
+    :param words: 词列表
+    :param stop_words: 停用词
+    :return: 词的集合
+    """
+    return set(word for word in words if len(word.strip()) >= 2 and word.lower() not in stop_words)
+
+
+def document_frequency_chunk(tokenizer, texts, stop_words=STOP_WORDS):
+    """
+    统计一块文档中每个词出现的文档数，可以作为JiebaSegmenter.map_chunks的func。
+    :param tokenizer: jieba.Tokenizer
+    :param texts: 文本列表
+    :param stop_words: 停用词
+    :return: (文档数, {词: 文档频率})
+    """
+    counter = collections.Counter()
+    for text in texts:
+        counter.update(document_terms(tokenizer.cut(text), stop_words))
+    return len(texts), counter
+
+
+class DocumentFrequency(object):
+    def __init__(self, max_terms=2000000):
+        """
+        构造函数。
+        :param max_terms: 最多保存的词数，超过时删除文档频率最低的一半
+        """
+        self.max_terms = max_terms
+        self.n_documents = 0
+        self.counts = {}
+        # 删除过词之后新加入的词可能在之前被删除过，文档频率最多少计deltas[词]，没有删除过词时为空
+        self.deltas = {}
+        # 已删除的词的文档频率上界的最大值
+        self.max_error = 0
+
+    def __len__(self):
+        return len(self.counts)
+
+    def update(self, n_documents, counter):
+        """
+        合并一块文档的统计结果。
+        :param n_documents: 文档数
+        :param counter: {词: 文档频率}
+        :return:
+        """
+        self.n_documents += n_documents
+        counts = self.counts
+        if self.max_error:
+            deltas, max_error = self.deltas, self.max_error
+            for term, count in counter.items():
+                if term in counts:
+                    counts[term] += count
+                else:
+                    counts[term] = count
+                    deltas[term] = max_error
+        else:
+            for term, count in counter.items():
+                counts[term] = counts.get(term, 0) + count
+        if len(counts) > self.max_terms:
+            self._prune()
+
+    def upper_bound(self, term):
+        """
+        词的文档频率的上界，下界为counts[词]，没有保存的词为0。
+        :param term:
+        :return:
+        """
+        if term in self.counts:
+            return self.counts[term] + self.deltas.get(term, 0)
+        return self.max_error
+
+    def _prune(self):
+        """
+        删除文档频率上界最低的词，保留不超过max_terms // 2个。
+        :return:
+        """
+        deltas = self.deltas
+        terms = list(self.counts)
+        upper = np.fromiter((self.counts[term] + deltas.get(term, 0) for term in terms),
+                            dtype=np.int64, count=len(terms))
+        position = len(upper) - self.max_terms // 2 - 1
+        threshold = int(np.partition(upper, position)[position])
+        self.counts = dict((term, self.counts[term]) for term, bound in zip(terms, upper.tolist())
+                           if bound > threshold)
+        self.deltas = dict((term, delta) for term, delta in deltas.items() if term in self.counts)
+        self.max_error = max(self.max_error, threshold)
+        common_logger.info("pruned document frequency to {0} terms, max error {1}".format(
+            len(self.counts), self.max_error))
+
+    def idf(self, min_df=1):
+        """
+        每个词的IDF：log(文档数 / 文档频率)。
+        :param min_df: 文档频率低于min_df的词不保存，使用jieba的中位数IDF
+        :return: {词: IDF}
+        """
+        n_documents = float(self.n_documents)
+        return dict((term, math.log(n_documents / count)) for term, count in self.counts.items() if count >= min_df)
+
+    def save_idf(self, path, min_df=1):
+        """
+        按jieba的IDF文件格式保存。
+        :param path: 文件路径
+        :param min_df: 最小文档频率
+        :return: 保存的词数
+        """
+        return save_idf(self.idf(min_df), path)
+
+
+def save_idf(idf, path):
+    """
+    按jieba的IDF文件格式保存，每行"词 IDF"，先写临时文件再改名，中断时不会留下不完整的缓存。
+    :param idf: {词: IDF}
+    :param path: 文件路径
+    :return: 保存的词数
+    """
+    # jieba按空格切分每一行，含有空白字符的词不能保存
+    items = sorted((term, value) for term, value in idf.items() if len(term.split()) == 1)
+    if not items:
+        raise ValueError("idf table is empty")
+    directory = os.path.dirname(os.path.abspath(path))
+    OsUtil.makedirs(directory)
+    temp_path = path + ".tmp"
+    with io.open(temp_path, "w", encoding="utf-8") as f:
+        for term, value in items:
+            f.write(u"{0} {1:.6f}\n".format(term, value))
+    os.replace(temp_path, path)
+    return len(items)
+
+
+def learn_idf(segmenter, texts, path=None, max_terms=2000000, min_df=1, stop_words=STOP_WORDS):
+    """
+    流式分词，一遍统计文档频率，可选地保存为IDF文件。
+    :param segmenter: JiebaSegmenter
+    :param texts: 文本的可迭代对象
+    :param path: IDF文件路径，为None或没有学到任何词时不保存
+    :param max_terms: 最多保存的词数
+    :param min_df: 保存的最小文档频率
+    :param stop_words: 停用词
+    :return: DocumentFrequency
+    """
+    document_frequency = DocumentFrequency(max_terms)
+    for n_documents, counter in segmenter.map_chunks(document_frequency_chunk, texts, frozenset(stop_words)):
+        document_frequency.update(n_documents, counter)
+    common_logger.info("learned document frequency of {0} terms from {1} documents".format(
+        len(document_frequency), document_frequency.n_documents))
+    if path is not None:
+        if document_frequency.idf(min_df):
+            n_terms = document_frequency.save_idf(path, min_df)
+            common_logger.info("saved idf of {0} terms to {1}".format(n_terms, path))
+        else:
+            # jieba不能读取空的IDF文件
+            common_logger.warning("no terms with document frequency >= {0}, idf not saved to {1}".format(
+                min_df, path))
+    return document_frequency
+
+
+def _extractor(tokenizer, method, idf_path, stop_words, pos):
+    """
+    当前进程的关键词提取器，每个Tokenizer、方法和IDF文件只创建一次。
+    :param tokenizer: jieba.Tokenizer
+    :param method: tfidf或textrank
+    :param idf_path: IDF文件路径，为None时使用jieba自带的IDF表
+    :param stop_words: 停用词
+    :param pos: 是否需要词性标注
+    :return: jieba.analyse.TFIDF或jieba.analyse.TextRank
+    """
+    if method != "tfidf":
+        # 只有tfidf使用IDF文件
+        idf_path = None
+    # IDF文件被重新生成后需要重新加载
+    mtime = os.path.getmtime(idf_path) if idf_path else None
+    key = (id(tokenizer), method, idf_path, mtime, stop_words)
+    if key not in _extractors:
+        if method == "tfidf":
+            extractor = jieba.analyse.TFIDF(idf_path)
+            extractor.tokenizer = tokenizer
+            # POSTokenizer初始化时要读取词典中的词性，只在需要时创建
+            extractor.postokenizer = None
+        elif method == "textrank":
+            extractor = jieba.analyse.TextRank()
+            extractor.tokenizer = extractor.postokenizer = jieba.posseg.POSTokenizer(tokenizer)
+        else:
+            raise ValueError("method must be one of {0}".format(METHODS))
+        extractor.stop_words = set(stop_words)
+        # 同时保存tokenizer，避免它被回收后id被其他对象复用
+        _extractors[key] = (tokenizer, extractor)
+    extractor = _extractors[key][1]
+    if pos and extractor.postokenizer is None:
+        extractor.postokenizer = jieba.posseg.POSTokenizer(tokenizer)
+    return extractor
+
+
+def keywords_chunk(tokenizer, texts, method="tfidf", idf_path=None, top_k=20, allow_pos=None,
+                   stop_words=STOP_WORDS):
+    """
+    提取一块文档的关键词，可以作为JiebaSegmenter.imap的func。
+    :param tokenizer: jieba.Tokenizer
+    :param texts: 文本列表
+    :param method: tfidf或textrank
+    :param idf_path: tfidf使用的IDF文件
+    :param top_k: 每篇文档的关键词数
+    :param allow_pos: 允许的词性，为None时使用jieba各方法的默认值
+    :param stop_words: 停用词
+    :return: 每篇文档的(词, 权重)列表
+    """
+    extractor = _extractor(tokenizer, method, idf_path, stop_words, bool(allow_pos))
+    kwargs = {"topK": top_k, "withWeight": True}
+    if allow_pos is not None:
+        kwargs["allowPOS"] = allow_pos
+    return [extractor.extract_tags(text, **kwargs) for text in texts]
+
+
+def extract_keywords(segmenter, texts, method="tfidf", idf_path=None, top_k=20, allow_pos=None,
+                     stop_words=STOP_WORDS):
+    """
+    并行提取关键词，按输入顺序流式返回。
+    :param segmenter: JiebaSegmenter
+    :param texts: 文本的可迭代对象
+    :param method: tfidf或textrank
+    :param idf_path: tfidf使用的IDF文件，为None时使用jieba自带的IDF表，textrank忽略该参数
+    :param top_k: 每篇文档的关键词数
+    :param allow_pos: 允许的词性
+    :param stop_words: 停用词
+    :return: (词, 权重)列表的生成器
+    """
+    if method not in METHODS:
+        raise ValueError("method must be one of {0}".format(METHODS))
+    if method != "tfidf":
+        idf_path = None
+    if allow_pos is not None:
+        allow_pos = tuple(allow_pos)
+    return segmenter.imap(keywords_chunk, texts, method, idf_path, top_k, allow_pos, frozenset(stop_words))
+
+
+def _split_ids(documents, ids):
+    """
+    把(文档id, 文本)拆开，id按顺序放入队列，文本交给进程池，队列长度不超过进行中的文档数。
+    :param documents: (文档id, 文本)的可迭代对象
+    :param ids: collections.deque
+    :return: 文本的生成器
+    """
+    for doc_id, text in documents:
+        ids.append(doc_id)
+        yield text
+
+
+def run(input_path, output_path, idf_path=None, method="tfidf", top_k=20, allow_pos=None, relearn=False,
+        max_terms=2000000, min_df=1, encoding="utf-8", segmenter=None):
+    """
+    学习（或读取缓存的）IDF，并把每篇文档的关键词写入tsv文件：文档id、以空格分隔的"词:权重"。
+    :param input_path: 每行一篇文档的文本文件，或文档目录
+    :param output_path: 输出文件
+    :param idf_path: tfidf使用的IDF文件，存在时直接使用，不存在时从输入学习后保存；为None时使用jieba自带的IDF表
+    :param method: tfidf或textrank
+    :param top_k: 每篇文档的关键词数
+    :param allow_pos: 允许的词性
+    :param relearn: IDF文件存在时是否重新学习
+    :param max_terms: 学习IDF时最多保存的词数
+    :param min_df: 保存的最小文档频率
+    :param encoding: 输入文件编码
+    :param segmenter: JiebaSegmenter，默认使用所有CPU
+    :return: 处理的文档数
+    """
+    own_segmenter = segmenter is None
+    if own_segmenter:
+        segmenter = JiebaSegmenter()
+    try:
+        if method == "tfidf" and idf_path is not None and (relearn or not os.path.exists(idf_path)):
+            texts = (text for _, text in iter_documents(input_path, encoding))
+            learn_idf(segmenter, texts, idf_path, max_terms, min_df)
+        if method == "tfidf" and idf_path is not None and not os.path.exists(idf_path):
+            # 输入为空或没有可用的词，没有生成IDF文件
+            common_logger.warning("{0} does not exist, using the default idf of jieba".format(idf_path))
+            idf_path = None
+        ids = collections.deque()
+        n_documents = 0
+        with io.open(output_path, "w", encoding="utf-8") as out:
+            texts = _split_ids(iter_documents(input_path, encoding), ids)
+            for keywords in extract_keywords(segmenter, texts, method, idf_path, top_k, allow_pos):
+                out.write(u"{0}\t{1}\n".format(ids.popleft(), " ".join(
+                    u"{0}:{1:.4f}".format(word, weight) for word, weight in keywords)))
+                n_documents += 1
+        segmenter.log_stats()
+        return n_documents
+    finally:
+        if own_segmenter:
+            segmenter.close()
+
+
+def test_keyword_pipeline():
+    """
+    在几篇文档上学习IDF，并用学到的IDF和textrank提取关键词。
+    :return:
+    """
+    texts = ["此外，公司拟对全资子公司吉林欧亚置业有限公司增资4.3亿元，增资后，吉林欧亚置业注册资本由7000万元增加到5亿元。",
+             "吉林欧亚置业主要经营范围为房地产开发及百货零售等业务。目前在建吉林欧亚城市商业综合体项目。",
+             "2013年，实现营业收入0万元，实现净利润-139.13万元。",
+             "线程是程序执行时的最小单位，它是进程的一个执行流，是CPU调度和分派的基本单位。"] * 50
+    idf_path = os.path.join(tempfile.gettempdir(), "keyword_idf.txt")
+    with JiebaSegmenter(n_jobs=2, chunk_size=16) as segmenter:
+        learn_idf(segmenter, texts, idf_path)
+        for method in METHODS:
+            for keywords in extract_keywords(segmenter, texts[:4], method, idf_path, top_k=5):
+                common_logger.info("{0}: {1}".format(method, keywords))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="corpus level keyword extraction with a learned idf table")
+    parser.add_argument("input", help="text file with one document per line, or a directory of documents")
+    parser.add_argument("output", help="tsv file of document id and space separated word:weight")
+    parser.add_argument("--idf", default=None,
+                        help="idf cache in jieba format for tfidf, learned from the input when missing")
+    parser.add_argument("--relearn", action="store_true", help="learn the idf table even if the cache exists")
+    parser.add_argument("--method", default="tfidf", choices=METHODS)
+    parser.add_argument("--top_k", type=int, default=20)
+    parser.add_argument("--allow_pos", default=None, help="comma separated part-of-speech tags, e.g. ns,n,vn,v")
+    parser.add_argument("--max_terms", type=int, default=2000000, help="vocabulary bound while counting")
+    parser.add_argument("--min_df", type=int, default=1)
+    parser.add_argument("--n_jobs", type=int, default=-1)
+    parser.add_argument("--chunk_size", type=int, default=256)
+    parser.add_argument("--compiled", default=None, help="dictionary compiled by jieba_dict_cache")
+    parser.add_argument("--encoding", default="utf-8")
+    args = parser.parse_args()
+    with JiebaSegmenter(args.n_jobs, args.chunk_size, compiled=args.compiled) as segmenter:
+        run(args.input, args.output, args.idf, args.method, args.top_k,
+            args.allow_pos.split(",") if args.allow_pos else None, args.relearn, args.max_terms, args.min_df,
+            args.encoding, segmenter)
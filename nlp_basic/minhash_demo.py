@@ -0,0 +1,170 @@
+# -*- coding:utf-8 -*-
+
+# ==============================================================================
+# 测试minhash算法。
+# minhash用于估计两个集合的Jaccard相似度 |A∩B| / |A∪B|：
+# 对集合中的元素做一次随机排列，两个集合排列后最小元素相同的概率恰好等于Jaccard相似度。
+# 用num_perm个随机排列得到num_perm个最小值作为签名，两个签名相同位置相等的比例就是Jaccard相似度的估计。
+# 与simhash相比，minhash直接反映集合的重合程度，对短文本和大量共同词的文本更准确，但签名更长。
+#
+# 向量化的计算方式（minhash_batch）：
+# 1. 所有文档的token去重后用crc32计算32位hash值h（与进程无关，结果可以复现）；
+# 2. 随机排列用通用hash近似：(a * h + b) mod p，p = 2^31 - 1为梅森素数，a、b为[1, p)和[0, p)中的随机数，
+#    a * h < 2^63，uint64不会溢出。所有token同时对num_perm个排列计算，得到(token数, num_perm)的矩阵，
+#    不同的token不多时只对去重后的token计算一次，各文档按token取对应的行；
+# 3. token按文档顺序排列，用np.minimum.reduceat求每篇文档每个排列的最小值。
+#    token按块计算，每块的临时矩阵不超过block_size个元素。
+# 空文档的签名全部为p：两篇空文档的签名相同，估计的Jaccard相似度为1，与jaccard中两个空集合的约定一致；
+# 非空文档的最小值都小于p，因此空文档与任何非空文档的估计相似度为0。
+# ==============================================================================
+import zlib
+import itertools
+import numpy as np
+from util.log_util import LoggerUtil
+
+# 日志器
+common_logger = LoggerUtil.get_common_logger()
+
+# 通用hash的模数，梅森素数2^31 - 1
+MERSENNE_PRIME = (1 << 31) - 1
+# 默认每块计算的元素个数
+DEFAULT_BLOCK_SIZE = 1 << 22
+
+
+def permutations(num_perm=128, seed=1):
+    """
+    生成num_perm个通用hash函数的参数。
+    :param num_perm: 排列个数
+    :param seed: 随机种子，签名只有在相同的num_perm和seed下才能比较
+    :return: (a, b)，两个长度为num_perm的uint64数组
+    """
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, MERSENNE_PRIME, size=num_perm).astype(np.uint64)
+    b = rng.randint(0, MERSENNE_PRIME, size=num_perm).astype(np.uint64)
+    return a, b
+
+
+def token_hashes(tokens):
+    """
+    用crc32计算token的32位hash值。
+    :param tokens: 字符串列表
+    :return: uint64数组
+    """
+    return np.array([zlib.crc32(token.encode("utf-8", "surrogatepass")) & 0xffffffff for token in tokens],
+                    dtype=np.uint64)
+
+
+def _token_set(tokens):
+    """
+    文档中的token，minhash不使用权重。
+    :param tokens: token列表、{token: weight}或(token, weight)的列表
+    :return: token列表
+    """
+    if isinstance(tokens, dict):
+        return list(tokens)
+    tokens = list(tokens)
+    if tokens and isinstance(tokens[0], (tuple, list)):
+        return [token[0] for token in tokens]
+    return tokens
+
+
+def minhash_batch(documents, num_perm=128, seed=1, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    一次计算多篇文档的minhash签名，与MinHash(tokens, num_perm, seed).signature相同。
+    :param documents: 文档列表，每篇文档为token列表，也可以是simhash_batch使用的{token: weight}或(token, weight)的列表，权重被忽略
+    :param num_perm: 排列个数，即签名的长度
+    :param seed: 随机种子
+    :param block_size: 每块临时矩阵的元素个数，控制内存
+    :return: (len(documents), num_perm)的uint32数组
+    """
+    documents = [_token_set(tokens) for tokens in documents]
+    words = list(itertools.chain.from_iterable(documents))
+    signatures = np.full((len(documents), num_perm), MERSENNE_PRIME, dtype=np.uint32)
+    if not words:
+        return signatures
+    # 用dict去重，numpy字符串数组的宽度由最长的token决定，而且会去掉末尾的"\x00"
+    vocab = {}
+    inverse = np.array([vocab.setdefault(word, len(vocab)) for word in words], dtype=np.int64)
+    unique_words = list(vocab)
+    hashes = token_hashes(unique_words)
+    rows = np.repeat(np.arange(len(documents)), [len(tokens) for tokens in documents])
+    a, b = permutations(num_perm, seed)
+    prime = np.uint64(MERSENNE_PRIME)
+    # 不同的token不多时先计算每个token的排列结果，各文档直接取对应的行
+    table = None
+    if len(unique_words) * num_perm <= block_size:
+        table = ((hashes[:, np.newaxis] * a + b) % prime).astype(np.uint32)
+    step = max(1, block_size // num_perm)
+    for start in range(0, len(inverse), step):
+        block_tokens = inverse[start:start + step]
+        if table is not None:
+            values = table[block_tokens]
+        else:
+            values = ((hashes[block_tokens, np.newaxis] * a + b) % prime).astype(np.uint32)
+        block_rows = rows[start:start + step]
+        # 每篇文档在块中的起始位置，文档可能跨块，因此与已有的签名再取一次最小值
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(block_rows)) + 1))
+        docs = block_rows[starts]
+        minimums = np.minimum.reduceat(values, starts, axis=0)
+        signatures[docs] = np.minimum(signatures[docs], minimums)
+    return signatures
+
+
+def jaccard(tokens1, tokens2):
+    """
+    两个token集合的精确Jaccard相似度。
+    :param tokens1:
+    :param tokens2:
+    :return:
+    """
+    set1, set2 = set(tokens1), set(tokens2)
+    if not set1 and not set2:
+        return 1.0
+    return len(set1 & set2) / float(len(set1 | set2))
+
+
+class MinHash(object):
+    def __init__(self, tokens=(), num_perm=128, seed=1):
+        """
+        构造函数。
+        :param tokens: token列表
+        :param num_perm: 排列个数
+        :param seed: 随机种子
+        """
+        self.num_perm = num_perm
+        self.seed = seed
+        self.signature = minhash_batch([tokens], num_perm, seed)[0]
+
+    def __str__(self):
+        """
+        toString函数。
+        :return:
+        """
+        return str(self.signature)
+
+    def jaccard(self, other):
+        """
+        估计Jaccard相似度。
+        :param other:
+        :return:
+        """
+        if self.num_perm != other.num_perm or self.seed != other.seed:
+            raise ValueError("signatures with different num_perm or seed are not comparable")
+        return float(np.mean(self.signature == other.signature))
+
+
+def test_minhash():
+    """
+    测试minhash估计的Jaccard相似度。
+    :return:
+    """
+    s1 = 'This is a test string for testing'.split()
+    s2 = 'This is a test string for testing also'.split()
+    s3 = 'nai nai ge xiong cao'.split()
+    hash1, hash2, hash3 = MinHash(s1), MinHash(s2), MinHash(s3)
+    common_logger.info("{0}   {1}".format(hash1.jaccard(hash2), jaccard(s1, s2)))
+    common_logger.info("{0}   {1}".format(hash1.jaccard(hash3), jaccard(s1, s3)))
+
+
+if __name__ == '__main__':
+    test_minhash()
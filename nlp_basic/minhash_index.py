@@ -0,0 +1,222 @@
+# -*- coding:utf-8 -*-
+
+# ==============================================================================
+# minhash的分段LSH索引，用于按Jaccard相似度查找近似重复的文档，接口与SimHashIndex相同。
+# 把长度为num_perm的签名分成b段，每段r个值。两篇Jaccard相似度为s的文档，
+# 某一段完全相同的概率为s^r，至少有一段相同（成为候选）的概率为1 - (1 - s^r)^b，
+# 这是一条S形曲线，在s约为(1/b)^(1/r)处陡峭上升。按阈值选择b和r，使低于阈值成为候选（误报）
+# 与高于阈值没有成为候选（漏报）的概率面积加权之和最小，误报只增加验证的开销，默认漏报的权重更大。
+# 1. 每段的r个值折叠为一个64位的键（FNV式的乘法和异或），所有文档的所有段一次向量化计算；
+# 2. insert逐个加入文档，每段的哈希表为{键: [文档位置]}；bulk_build每段按键排序后保存为数组；
+#    compact把哈希表中的文档合并到排序数组；
+# 3. query在每段中查找键相同的文档作为候选，用签名估计候选的Jaccard相似度，
+#    返回不低于阈值的(文档id, 相似度)，按相似度从大到小排列。
+# ==============================================================================
+import itertools
+import numpy as np
+from nlp_basic.minhash_demo import minhash_batch
+from util.log_util import LoggerUtil
+
+# 日志器
+common_logger = LoggerUtil.get_common_logger()
+
+# 折叠每段的值时使用的乘数（64位FNV素数）
+FNV_PRIME = 1099511628211
+
+
+def optimal_bands(threshold, num_perm, false_positive_weight=0.1, false_negative_weight=0.9):
+    """
+    选择段数b和每段的值个数r，使加权的误报面积与漏报面积之和最小。
+    误报面积为相似度低于threshold时成为候选的概率的积分，漏报面积为高于threshold时不成为候选的概率的积分。
+    误报在查询时会被签名的相似度过滤掉，因此默认漏报的权重更大。
+    :param threshold: Jaccard相似度的阈值
+    :param num_perm: 签名的长度
+    :param false_positive_weight: 误报的权重，误报只增加验证候选的开销
+    :param false_negative_weight: 漏报的权重，漏报会降低召回率
+    :return: (b, r)
+    """
+    similarity = np.linspace(0, 1, 1001)
+    below = similarity < threshold
+    best = None
+    for b in range(1, num_perm + 1):
+        for r in range(1, num_perm // b + 1):
+            probability = 1 - (1 - similarity ** r) ** b
+            false_positive = probability[below].sum()
+            false_negative = (1 - probability[~below]).sum()
+            error = (false_positive_weight * false_positive + false_negative_weight * false_negative) / len(similarity)
+            if best is None or error < best[0]:
+                best = (error, b, r)
+    return best[1], best[2]
+
+
+class MinHashIndex(object):
+    def __init__(self, threshold=0.8, num_perm=128, bands=None):
+        """
+        构造函数。
+        :param threshold: Jaccard相似度不低于threshold的文档视为近似重复
+        :param num_perm: 签名的长度，必须与minhash_batch的num_perm相同
+        :param bands: (b, r)，默认由optimal_bands根据threshold选择
+        """
+        if not 0 < threshold <= 1:
+            raise ValueError("threshold must be in (0, 1]")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.b, self.r = bands or optimal_bands(threshold, num_perm)
+        if self.b * self.r > num_perm:
+            raise ValueError("b * r must not exceed num_perm")
+        self.doc_ids = []
+        self.signatures = np.zeros((1024, num_perm), dtype=np.uint32)
+        # bulk_build建立的每段排序数组：(键, 文档位置)
+        self.sorted_bands = [(np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64))] * self.b
+        # insert加入的每段哈希表
+        self.bands = [dict() for _ in range(self.b)]
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def _band_keys(self, signatures):
+        """
+        每篇文档每一段的键。
+        :param signatures: (n, num_perm)的签名数组
+        :return: (n, b)的uint64数组
+        """
+        values = signatures[:, :self.b * self.r].reshape(len(signatures), self.b, self.r).astype(np.uint64)
+        keys = np.zeros((len(signatures), self.b), dtype=np.uint64)
+        prime = np.uint64(FNV_PRIME)
+        for j in range(self.r):
+            keys = keys * prime ^ values[:, :, j]
+        return keys
+
+    def _append(self, doc_ids, signatures):
+        """
+        保存文档id和签名，数组容量不足时翻倍。
+        :param doc_ids:
+        :param signatures: (n, num_perm)的签名数组
+        :return: 新文档的起始位置
+        """
+        start = len(self.doc_ids)
+        end = start + len(signatures)
+        if end > len(self.signatures):
+            capacity = max(end, 2 * len(self.signatures))
+            resized = np.zeros((capacity, self.num_perm), dtype=np.uint32)
+            resized[:start] = self.signatures[:start]
+            self.signatures = resized
+        self.signatures[start:end] = signatures
+        self.doc_ids.extend(doc_ids)
+        return start
+
+    def insert(self, doc_id, signature):
+        """
+        加入一个文档。
+        :param doc_id: 文档id
+        :param signature: 长度为num_perm的签名
+        :return:
+        """
+        signature = np.asarray(signature, dtype=np.uint32).reshape(1, self.num_perm)
+        position = self._append([doc_id], signature)
+        for band, key in zip(self.bands, self._band_keys(signature)[0].tolist()):
+            band.setdefault(key, []).append(position)
+
+    def _merge_sorted(self, positions, signatures):
+        """
+        把文档合并到每段的排序数组中。
+        :param positions: 文档位置数组
+        :param signatures: 对应的签名数组
+        :return:
+        """
+        keys = self._band_keys(signatures)
+        for i in range(self.b):
+            old_keys, old_positions = self.sorted_bands[i]
+            band_keys = np.concatenate((old_keys, keys[:, i]))
+            band_positions = np.concatenate((old_positions, positions))
+            order = np.argsort(band_keys, kind="mergesort")
+            self.sorted_bands[i] = (band_keys[order], band_positions[order])
+
+    def bulk_build(self, signatures, doc_ids=None):
+        """
+        一次加入大量文档，每段重新排序为数组。
+        :param signatures: (n, num_perm)的签名数组
+        :param doc_ids: 文档id列表，默认为文档在索引中的位置
+        :return:
+        """
+        signatures = np.asarray(signatures, dtype=np.uint32)
+        if doc_ids is None:
+            doc_ids = range(len(self.doc_ids), len(self.doc_ids) + len(signatures))
+        start = self._append(list(doc_ids), signatures)
+        self._merge_sorted(np.arange(start, start + len(signatures), dtype=np.int64), signatures)
+
+    def compact(self):
+        """
+        把insert加入的文档从哈希表合并到每段的排序数组中。
+        :return:
+        """
+        if not self.bands[0]:
+            return
+        positions = np.array(sorted(itertools.chain.from_iterable(self.bands[0].values())), dtype=np.int64)
+        self._merge_sorted(positions, self.signatures[positions])
+        self.bands = [dict() for _ in range(self.b)]
+
+    def _candidate_positions(self, signature):
+        """
+        至少有一段与signature相同的文档位置，可能有重复。
+        :param signature: 长度为num_perm的签名
+        :return: 文档位置数组
+        """
+        signature = np.asarray(signature, dtype=np.uint32).reshape(1, self.num_perm)
+        result = [np.zeros(0, dtype=np.int64)]
+        for i, key in enumerate(self._band_keys(signature)[0].tolist()):
+            keys, positions = self.sorted_bands[i]
+            key = np.uint64(key)
+            left = np.searchsorted(keys, key, side="left")
+            right = np.searchsorted(keys, key, side="right")
+            result.append(positions[left:right])
+            inserted = self.bands[i].get(int(key))
+            if inserted:
+                result.append(np.array(inserted, dtype=np.int64))
+        return np.concatenate(result)
+
+    def candidates(self, signature):
+        """
+        至少有一段与signature相同的文档位置。
+        :param signature: 长度为num_perm的签名
+        :return: 文档位置数组
+        """
+        return np.unique(self._candidate_positions(signature))
+
+    def query(self, signature, threshold=None):
+        """
+        查找估计的Jaccard相似度不低于threshold的文档。
+        :param signature: 长度为num_perm的签名
+        :param threshold: 相似度的阈值，默认为建立索引时的threshold；低于建立索引时的阈值时召回率会下降
+        :return: 按相似度从大到小排列的(文档id, 相似度)列表
+        """
+        threshold = self.threshold if threshold is None else threshold
+        signature = np.asarray(signature, dtype=np.uint32)
+        positions = np.unique(self._candidate_positions(signature))
+        similarities = (self.signatures[positions] == signature).mean(axis=1)
+        keep = similarities >= threshold
+        positions, similarities = positions[keep], similarities[keep]
+        order = np.lexsort((positions, -similarities))
+        return [(self.doc_ids[position], similarity)
+                for position, similarity in zip(positions[order].tolist(), similarities[order].tolist())]
+
+
+def test_minhash_index():
+    """
+    测试minhash LSH索引。
+    :return:
+    """
+    documents = ['This is a test string for testing'.split(),
+                 'This is a test string for testing also'.split(),
+                 'nai nai ge xiong cao'.split()]
+    signatures = minhash_batch(documents, 128)
+    index = MinHashIndex(threshold=0.8, num_perm=128)
+    index.bulk_build(signatures[:2], ["doc1", "doc2"])
+    index.insert("doc3", signatures[2])
+    common_logger.info("b = {0}, r = {1}".format(index.b, index.r))
+    for signature in signatures:
+        common_logger.info("{0}".format(index.query(signature)))
+
+
+if __name__ == '__main__':
+    test_minhash_index()
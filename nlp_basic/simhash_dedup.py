@@ -0,0 +1,222 @@
+# -*- coding:utf-8 -*-
+
+# ==============================================================================
+# 基于simhash的流式文本去重。
+# 1. 读取：输入为文件时每一行是一篇文档，文档id为行号（从1开始，跳过空行）；
+#    输入为目录时每个文件是一篇文档，文档id为相对路径。文档按批次读取，不一次读入整个语料；
+# 2. 分词：jieba或按空白字符切分，在进程池中与simhash_batch一起计算，
+#    同时进行中的批次不超过max_pending个，读取速度不会超过计算速度，内存有上限；
+# 3. 去重：按文档顺序在SimHashIndex中查找海明距离不超过k的文档，找到则标记为其重复，
+#    否则作为新的簇加入索引。索引中只保存每个簇的第一篇文档，每compact_every篇合并一次排序数组；
+# 4. 输出：每处理完一个批次就写出“文档id\t簇id\t海明距离”，簇id为该簇第一篇文档的id，
+#    并按report_every定期打印处理速度（篇/秒）。
+# ==============================================================================
+import os
+import io
+import time
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from nlp_basic.simhash_demo import simhash_batch
+from nlp_basic.simhash_index import SimHashIndex
+from util.log_util import LoggerUtil
+
+# 日志器
+common_logger = LoggerUtil.get_common_logger()
+
+TOKENIZERS = ("jieba", "whitespace")
+
+
+def iter_documents(path, encoding="utf-8"):
+    """
+    逐篇读取文档。
+    :param path: 文件或目录
+    :param encoding: 文件编码
+    :return: (文档id, 文本)的生成器
+    """
+    if os.path.isdir(path):
+        for root, dir_names, file_names in os.walk(path):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                file_path = os.path.join(root, file_name)
+                with io.open(file_path, "r", encoding=encoding, errors="ignore") as f:
+                    yield os.path.relpath(file_path, path), f.read()
+    else:
+        with io.open(path, "r", encoding=encoding, errors="ignore") as f:
+            for line_no, line in enumerate(f, 1):
+                line = line.strip()
+                if line:
+                    yield line_no, line
+
+
+def tokenize(text, tokenizer="jieba"):
+    """
+    分词。
+    :param text: 文本
+    :param tokenizer: jieba或whitespace
+    :return: token列表
+    """
+    if tokenizer == "whitespace":
+        return text.split()
+    import jieba
+    return [word for word in jieba.lcut(text) if word.strip()]
+
+
+def fingerprint_texts(texts, tokenizer="jieba", hash_bits=64):
+    """
+    分词并计算一批文本的simhash值，在进程池中调用。
+    :param texts: 文本列表
+    :param tokenizer: jieba或whitespace
+    :param hash_bits: simhash的位数
+    :return: uint64数组
+    """
+    return simhash_batch([tokenize(text, tokenizer) for text in texts], hash_bits, as_array=True)
+
+
+def _batches(documents, batch_size):
+    """
+    把文档流切分为批次。
+    :param documents: (文档id, 文本)的可迭代对象
+    :param batch_size: 每批的文档数
+    :return: (文档id列表, 文本列表)的生成器
+    """
+    documents = iter(documents)
+    while True:
+        batch = list(itertools.islice(documents, batch_size))
+        if not batch:
+            return
+        doc_ids, texts = zip(*batch)
+        yield list(doc_ids), list(texts)
+
+
+def _fingerprint_stream(batches, tokenizer, hash_bits, n_jobs, max_pending):
+    """
+    按输入顺序返回每批的simhash值，n_jobs大于1时在进程池中计算，同时进行中的批次不超过max_pending个。
+    :param batches: _batches的结果
+    :param tokenizer: jieba或whitespace
+    :param hash_bits: simhash的位数
+    :param n_jobs: 进程数
+    :param max_pending: 同时进行中的批次数
+    :return: (文档id列表, uint64数组)的生成器
+    """
+    if n_jobs <= 1:
+        for doc_ids, texts in batches:
+            yield doc_ids, fingerprint_texts(texts, tokenizer, hash_bits)
+        return
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        pending = []
+        for doc_ids, texts in batches:
+            pending.append((doc_ids, executor.submit(fingerprint_texts, texts, tokenizer, hash_bits)))
+            if len(pending) >= max_pending:
+                doc_ids, future = pending.pop(0)
+                yield doc_ids, future.result()
+        for doc_ids, future in pending:
+            yield doc_ids, future.result()
+
+
+class SimHashDedup(object):
+    def __init__(self, k=3, hash_bits=64, compact_every=100000):
+        """
+        构造函数。
+        :param k: 海明距离不超过k的文档视为重复
+        :param hash_bits: simhash的位数，不超过64
+        :param compact_every: 每加入多少个簇合并一次索引的排序数组
+        """
+        self.index = SimHashIndex(k=k, f=hash_bits)
+        self.compact_every = compact_every
+        self.n_documents = 0
+        self.n_duplicates = 0
+        self._inserted = 0
+
+    def assign(self, doc_ids, fingerprints):
+        """
+        按顺序为一批文档分配簇，新簇加入索引。
+        :param doc_ids: 文档id列表
+        :param fingerprints: uint64 simhash数组
+        :return: (文档id, 簇id, 海明距离)的列表
+        """
+        result = []
+        for doc_id, fingerprint in zip(doc_ids, fingerprints.tolist()):
+            matches = self.index.query(fingerprint)
+            if matches:
+                cluster_id, distance = matches[0]
+                self.n_duplicates += 1
+            else:
+                cluster_id, distance = doc_id, 0
+                self.index.insert(doc_id, fingerprint)
+                self._inserted += 1
+                if self._inserted >= self.compact_every:
+                    self.index.compact()
+                    self._inserted = 0
+            result.append((doc_id, cluster_id, distance))
+        self.n_documents += len(result)
+        return result
+
+    def run(self, documents, output, tokenizer="jieba", n_jobs=1, batch_size=1000, max_pending=None,
+            report_every=100000):
+        """
+        对文档流去重，每批的结果立即写入output。
+        :param documents: (文档id, 文本)的可迭代对象，如iter_documents的结果
+        :param output: 可写的文本文件对象
+        :param tokenizer: jieba或whitespace
+        :param n_jobs: 计算simhash的进程数，-1表示使用所有CPU
+        :param batch_size: 每批的文档数
+        :param max_pending: 同时进行中的批次数，默认为2 * n_jobs
+        :param report_every: 每处理多少篇文档打印一次速度
+        :return: 统计信息
+        """
+        if tokenizer not in TOKENIZERS:
+            raise ValueError("tokenizer must be one of {0}".format(TOKENIZERS))
+        if n_jobs == -1:
+            n_jobs = os.cpu_count() or 1
+        max_pending = max_pending or 2 * n_jobs
+        start_time = time.perf_counter()
+        next_report = report_every
+        stream = _fingerprint_stream(_batches(documents, batch_size), tokenizer, self.index.f, n_jobs,
+                                     max_pending)
+        for doc_ids, fingerprints in stream:
+            for doc_id, cluster_id, distance in self.assign(doc_ids, fingerprints):
+                output.write("{0}\t{1}\t{2}\n".format(doc_id, cluster_id, distance))
+            output.flush()
+            if self.n_documents >= next_report:
+                next_report = (self.n_documents // report_every + 1) * report_every
+                common_logger.info("{0} documents, {1} duplicates, {2:.1f} docs/sec".format(
+                    self.n_documents, self.n_duplicates, self.n_documents / (time.perf_counter() - start_time)))
+        seconds = time.perf_counter() - start_time
+        stats = {"documents": self.n_documents,
+                 "duplicates": self.n_duplicates,
+                 "clusters": len(self.index),
+                 "seconds": seconds,
+                 "docs_per_sec": self.n_documents / seconds if seconds > 0 else 0.0}
+        common_logger.info("dedup finished: {0}".format(stats))
+        return stats
+
+
+def test_simhash_dedup():
+    """
+    测试对几行文本去重。
+    :return:
+    """
+    documents = [(1, "我来到北京清华大学"),
+                 (2, "他来到了网易杭研大厦"),
+                 (3, "我来到北京清华大学"),
+                 (4, "小明硕士毕业于中国科学院计算所，后在日本京都大学深造")]
+    output = io.StringIO()
+    SimHashDedup(k=3).run(documents, output, batch_size=2)
+    common_logger.info("\n{0}".format(output.getvalue()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="simhash near-duplicate detection")
+    parser.add_argument("input", help="text file with one document per line, or a directory of documents")
+    parser.add_argument("output", help="tsv file of document id, cluster id and hamming distance")
+    parser.add_argument("--tokenizer", default="jieba", choices=TOKENIZERS)
+    parser.add_argument("--k", type=int, default=3, help="maximum hamming distance of duplicates")
+    parser.add_argument("--hash_bits", type=int, default=64)
+    parser.add_argument("--n_jobs", type=int, default=1, help="processes for fingerprinting, -1 for all CPUs")
+    parser.add_argument("--batch_size", type=int, default=1000)
+    parser.add_argument("--encoding", default="utf-8")
+    args = parser.parse_args()
+    with io.open(args.output, "w", encoding="utf-8") as out:
+        SimHashDedup(args.k, args.hash_bits).run(iter_documents(args.input, args.encoding), out, args.tokenizer,
+                                                 args.n_jobs, args.batch_size)
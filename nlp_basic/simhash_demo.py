@@ -24,6 +24,15 @@
 # 两个二进制“异或”后得到1的个数即为海明距离的大小。
 # 每篇文档得到SimHash签名值后，接着计算两个签名的海明距离即可。
 # 根据经验值，对64位的 SimHash值，海明距离在3以内的可认为相似度比较高。
+# 大量simhash之间的海明距离用hamming模块中的向量化popcount计算。
+#
+# 向量化的计算方式（simhash_batch）：
+# 1. 所有文档的token去重后一起计算hash值，按32位一段保存在uint64数组中，逐个字符位置对所有token同时
+#    做乘法和异或，进位在各段之间传递，结果与_string_hash逐位相同，128位也是精确的；
+#    token按长度分组计算，超过LONG_TOKEN_LEN的token（URL、base64等）逐个计算，内存与token的总长度成正比；
+# 2. 用np.unpackbits把hash值展开为(token数, hash_bits)的0/1矩阵，转换为+1/-1；
+# 3. 文档×token的稀疏权重矩阵乘以该矩阵，即为每篇文档各个位上的加权和，>=0的位置1后用np.packbits合并。
+# token可以带权重：传入{token: weight}或(token, weight)的列表，普通token列表的权重为出现次数。
 # ==============================================================================
 import sys
 import re
@@ -32,17 +41,199 @@ import collections
 import datetime
 import codecs
 import itertools
+import numpy as np
+import scipy.sparse as sp
 from util.log_util import LoggerUtil
 
 # 日志器
 common_logger = LoggerUtil.get_common_logger()
 
 
+# _string_hash中的乘数
+HASH_MULTIPLIER = 1000003
+# 分段计算hash值时每段的位数
+LIMB_BITS = 32
+LIMB_MASK = (1 << LIMB_BITS) - 1
+# 超过该长度的token不参与向量化计算，用string_hash逐个计算
+LONG_TOKEN_LEN = 256
+
+
+def _token_weights(tokens):
+    """
+    把一篇文档的token转换为token列表和权重列表。
+    :param tokens: token列表、{token: weight}或(token, weight)的列表
+    :return:
+    """
+    if isinstance(tokens, dict):
+        return list(tokens.keys()), list(tokens.values())
+    words = []
+    weights = []
+    for token in tokens:
+        if isinstance(token, (tuple, list)):
+            words.append(token[0])
+            weights.append(token[1])
+        else:
+            words.append(token)
+            weights.append(1)
+    return words, weights
+
+
+def string_hash(source, hash_bits=64):
+    """
+    针对source生成hash值 (一个可变长度版本的Python的内置散列)
+    :param source:
+    :param hash_bits: hash值的位数
+    :return:
+    """
+    if source == "":
+        return 0
+    else:
+        x = ord(source[0]) << 7
+        m = HASH_MULTIPLIER
+        mask = 2 ** hash_bits - 1
+        for c in source:
+            x = ((x * m) ^ ord(c)) & mask
+        x ^= len(source)
+        if x == -1:
+            x = -2
+        return x
+
+
+def _hash_limbs(codes, lengths, n_limbs, hash_bits):
+    """
+    对长度相近的一组token逐个字符位置计算hash值。
+    :param codes: (n, max_len)的码位数组，超出token长度的部分为0
+    :param lengths: 每个token的长度，都大于0
+    :param n_limbs: 段数
+    :param hash_bits: hash值的位数
+    :return: (n, n_limbs)的uint64数组
+    """
+    limbs = np.zeros((len(codes), n_limbs), dtype=np.uint64)
+    limbs[:, 0] = codes[:, 0] << np.uint64(7)
+    multiplier = np.uint64(HASH_MULTIPLIER)
+    for j in range(codes.shape[1]):
+        active = lengths > j
+        carry = np.zeros(len(codes), dtype=np.uint64)
+        for limb in range(n_limbs):
+            # 每段小于2^32，乘以1000003再加进位不会超过2^64
+            t = limbs[:, limb] * multiplier + carry
+            carry = t >> np.uint64(LIMB_BITS)
+            limbs[:, limb] = np.where(active, t & np.uint64(LIMB_MASK), limbs[:, limb])
+        limbs[:, 0] ^= np.where(active, codes[:, j], np.uint64(0))
+    top_bits = hash_bits - (n_limbs - 1) * LIMB_BITS
+    limbs[:, -1] &= np.uint64((1 << top_bits) - 1)
+    limbs[:, 0] ^= lengths.astype(np.uint64)
+    return limbs
+
+
+def token_hash_limbs(tokens, hash_bits=64):
+    """
+    向量化计算_string_hash，结果与SimHash._string_hash相同。
+    hash值按32位一段从低到高保存，乘法的进位在段之间传递，因此任意位数都是精确的。
+    token按长度分组（组内最长的不超过最短的两倍），每组的码位矩阵只补齐到组内最长的token，
+    超过LONG_TOKEN_LEN的token用string_hash逐个计算，一个很长的token不会放大整批的内存和耗时。
+    :param tokens: 字符串列表，不要先转换为numpy字符串数组，numpy会去掉末尾的"\x00"
+    :param hash_bits: hash值的位数
+    :return: (len(tokens), ceil(hash_bits / 32))的uint64数组，每个元素只使用低32位
+    """
+    n_limbs = (hash_bits + LIMB_BITS - 1) // LIMB_BITS
+    tokens = list(tokens)
+    lengths = np.array([len(token) for token in tokens], dtype=np.int64)
+    limbs = np.zeros((len(tokens), n_limbs), dtype=np.uint64)
+    short = np.flatnonzero((lengths > 0) & (lengths <= LONG_TOKEN_LEN))
+    if len(short):
+        # 所有短token的码位连在一起，starts为每个token的起始位置
+        text = "".join(tokens[i] for i in short.tolist())
+        codes = np.frombuffer(text.encode("utf-32-le", "surrogatepass"), dtype="<u4").astype(np.uint64)
+        short_lengths = lengths[short]
+        starts = np.cumsum(short_lengths) - short_lengths
+        low = 1
+        while low <= LONG_TOKEN_LEN:
+            group = np.flatnonzero((short_lengths >= low) & (short_lengths < 2 * low))
+            low *= 2
+            if not len(group):
+                continue
+            group_lengths = short_lengths[group]
+            offsets = np.arange(int(group_lengths.max()))
+            positions = starts[group, np.newaxis] + offsets
+            valid = offsets < group_lengths[:, np.newaxis]
+            group_codes = np.where(valid, codes[np.minimum(positions, len(codes) - 1)], np.uint64(0))
+            limbs[short[group]] = _hash_limbs(group_codes, group_lengths, n_limbs, hash_bits)
+    for i in np.flatnonzero(lengths > LONG_TOKEN_LEN).tolist():
+        value = string_hash(tokens[i], hash_bits)
+        limbs[i] = [(value >> (LIMB_BITS * limb)) & LIMB_MASK for limb in range(n_limbs)]
+    # 空字符串的hash值为0，保持全0
+    return limbs
+
+
+def _unpack_bits(limbs, hash_bits):
+    """
+    把分段的hash值展开为0/1矩阵，第i列为hash值的第i位。
+    :param limbs: token_hash_limbs的结果
+    :param hash_bits: hash值的位数
+    :return: (n, hash_bits)的uint8数组
+    """
+    data = np.ascontiguousarray(limbs.astype("<u4")).view(np.uint8)
+    try:
+        bits = np.unpackbits(data, axis=1, bitorder="little")
+    except TypeError:
+        # numpy 1.17之前没有bitorder参数，把每个字节内的位顺序反转
+        bits = np.unpackbits(data, axis=1).reshape(len(data), -1, 8)[:, :, ::-1].reshape(len(data), -1)
+    return bits[:, :hash_bits]
+
+
+def _pack_bits(bits):
+    """
+    把0/1矩阵的每一行合并为整数，第i列为整数的第i位。
+    :param bits: (n, hash_bits)的0/1数组
+    :return: 整数列表
+    """
+    n_bytes = (bits.shape[1] + 7) // 8
+    padded = np.zeros((bits.shape[0], n_bytes * 8), dtype=np.uint8)
+    padded[:, :bits.shape[1]] = bits
+    try:
+        packed = np.packbits(padded, axis=1, bitorder="little")
+    except TypeError:
+        packed = np.packbits(padded.reshape(len(padded), -1, 8)[:, :, ::-1].reshape(len(padded), -1), axis=1)
+    return [int.from_bytes(row.tobytes(), "little") for row in packed]
+
+
+def simhash_batch(documents, hash_bits=64, as_array=False):
+    """
+    一次计算多篇文档的simhash值，与SimHash(tokens, hash_bits).hash相同。
+    :param documents: 文档列表，每篇文档为token列表、{token: weight}或(token, weight)的列表
+    :param hash_bits: simhash的位数
+    :param as_array: 为True时返回uint64数组，只支持不超过64位
+    :return: simhash值列表或uint64数组
+    """
+    rows = []
+    words = []
+    weights = []
+    for d, tokens in enumerate(documents):
+        doc_words, doc_weights = _token_weights(tokens)
+        rows.extend([d] * len(doc_words))
+        words.extend(doc_words)
+        weights.extend(doc_weights)
+    # 用dict去重，numpy字符串数组的宽度由最长的token决定，而且会去掉末尾的"\x00"
+    vocab = {}
+    inverse = [vocab.setdefault(word, len(vocab)) for word in words]
+    unique_words = list(vocab)
+    signs = _unpack_bits(token_hash_limbs(unique_words, hash_bits), hash_bits).astype(np.float64) * 2 - 1
+    doc_words = sp.csr_matrix((np.array(weights, dtype=np.float64), (rows, inverse)),
+                              shape=(len(documents), len(unique_words)))
+    bits = (np.asarray(doc_words.dot(signs)) >= 0).astype(np.uint8)
+    if as_array:
+        if hash_bits > 64:
+            raise ValueError("as_array only supports hash_bits <= 64")
+        return np.array(_pack_bits(bits), dtype=np.uint64)
+    return _pack_bits(bits)
+
+
 class SimHash:
     def __init__(self, tokens='', hash_bits=128):
         """
         构造函数。
-        :param tokens:
+        :param tokens: token列表、{token: weight}或(token, weight)的列表
         :param hash_bits:
         """
         self.hash_bits = hash_bits
@@ -57,7 +248,15 @@ class SimHash:
 
     def simhash(self, tokens):
         """
-        生成simhash值。
+        生成simhash值，使用向量化的simhash_batch。
+        :param tokens: token列表、{token: weight}或(token, weight)的列表
+        :return:
+        """
+        return simhash_batch([tokens], self.hash_bits)[0]
+
+    def simhash_python(self, tokens):
+        """
+        逐个token、逐位计算simhash值，所有token的权重为1。
         :param tokens:
         :return:
         """
@@ -86,11 +285,7 @@ class SimHash:
         :return:
         """
         x = (self.hash ^ other.hash) & ((1 << self.hash_bits) - 1)
-        tot = 0
-        while x:
-            tot += 1
-            x &= x - 1
-        return tot
+        return bin(x).count("1")
 
     def similarity(self, other):
         """
@@ -111,18 +306,7 @@ class SimHash:
         :param source:
         :return:
         """
-        if source == "":
-            return 0
-        else:
-            x = ord(source[0]) << 7
-            m = 1000003
-            mask = 2 ** self.hash_bits - 1
-            for c in source:
-                x = ((x * m) ^ ord(c)) & mask
-            x ^= len(source)
-            if x == -1:
-                x = -2
-            return x
+        return string_hash(source, self.hash_bits)
 
 
 def test_simhash():
@@ -143,6 +327,24 @@ def test_simhash():
     common_logger.info("{0}   {1}".format(hash1.hamming_distance(hash3), hash1.similarity(hash3)))
 
 
+def test_simhash_batch():
+    """
+    测试批量计算simhash和带权重的token。
+    :return:
+    """
+    documents = ['This is a test string for testing'.split(),
+                 'This is a test string for testing also'.split(),
+                 'nai nai ge xiong cao'.split(),
+                 # 很长的token、末尾为"\x00"的token和空token
+                 ["https://example.com/" + "a" * 2000, "x\x00", "x", "\x00", "", "中文\x00\x00", "b" * 300]]
+    for hash_bits in (64, 128):
+        batch = simhash_batch(documents, hash_bits)
+        single = [SimHash(hash_bits=hash_bits).simhash_python(tokens) for tokens in documents]
+        common_logger.info("{0} bits: {1} {2}".format(hash_bits, batch, batch == single))
+    weighted = SimHash({"test": 5, "string": 3, "also": 1}, 64)
+    common_logger.info("weighted: {0}".format(weighted))
+
+
 def is_similar(value1, value2, n=4, f=64):
     """
     比较相似性。
@@ -152,14 +354,8 @@ def is_similar(value1, value2, n=4, f=64):
     :param f:
     :return:
     """
-    ans = 0
     x = (value1 ^ value2) & ((1 << f) - 1)
-    while x and (ans <= n):
-        ans += 1
-        x &= x - 1
-    if ans <= n:
-        return True
-    return False
+    return bin(x).count("1") <= n
 
 
 def test_similar():
@@ -0,0 +1,301 @@
+# -*- coding:utf-8 -*-
+
+# ==============================================================================
+# simhash的分段索引，用于海量文档的近似重复查找。
+# 抽屉原理：把f位的simhash分成k+1段，如果两个simhash的海明距离不超过k，
+# 那么至少有一段是完全相同的。因此每一段建立一个哈希表，查询时只需在k+1个表中查找
+# 与查询值某一段相同的文档作为候选，再计算候选的海明距离，不需要与所有文档逐一比较。
+# 1. insert逐个加入文档，每段的哈希表为{段的值: [文档位置]}；
+# 2. bulk_build一次加入大量文档，每段按段的值排序后保存为数组，查询时用二分查找，
+#    内存为每段两个数组，不为每个文档创建python对象；
+# 3. query同时查找排序数组和哈希表，用向量化的popcount计算候选的海明距离，返回距离不超过k的(文档id, 距离)；
+# 4. compact把哈希表中的文档合并到排序数组，逐个insert大量文档时定期调用，内存不随文档数按python对象增长；
+# 5. save把simhash按值排序后与文档id、每段的(段的值, 文档位置)排列表分别保存为.npy文件，
+#    load可以只读内存映射的方式打开，查询时只读取用到的页，不需要把整个索引读入内存。
+#    文档id都是整数或都是字符串时保存为.npy，否则（例如整数和字符串混合）保存为json，加载后类型不变。
+# ==============================================================================
+import os
+import io
+import json
+import itertools
+import numpy as np
+from nlp_basic.hamming import hamming_one_to_many
+from nlp_basic.simhash_demo import simhash_batch
+from util.log_util import LoggerUtil
+from util.os_util import OsUtil
+
+# 日志器
+common_logger = LoggerUtil.get_common_logger()
+
+
+def _min_uint_dtype(max_value):
+    """
+    能保存0到max_value的最小无符号整数类型。
+    :param max_value:
+    :return:
+    """
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if max_value <= np.iinfo(dtype).max:
+            return dtype
+    return np.uint64
+
+
+def _id_array(doc_ids):
+    """
+    文档id都是整数或都是字符串时转换为可以内存映射的数组。
+    :param doc_ids: 文档id列表或数组
+    :return: 数组，不能保持id的类型时返回None
+    """
+    if isinstance(doc_ids, np.ndarray):
+        return doc_ids if doc_ids.dtype.kind in "iuU" else None
+    if not doc_ids:
+        return np.zeros(0, dtype=np.int64)
+    types = set(type(doc_id) for doc_id in doc_ids)
+    # numpy的字符串数组会去掉末尾的"\x00"
+    if types == {str} and any(doc_id.endswith("\x00") for doc_id in doc_ids):
+        return None
+    if types == {int} or types == {str}:
+        array = np.array(doc_ids)
+        # 超过int64的整数得到object数组
+        if array.dtype.kind in "iuU":
+            return array
+    return None
+
+
+class SimHashIndex(object):
+    def __init__(self, k=3, f=64):
+        """
+        构造函数。
+        :param k: 海明距离不超过k的文档视为近似重复
+        :param f: simhash的位数，不超过64
+        """
+        if f > 64:
+            raise ValueError("f must not exceed 64")
+        if k + 1 > f:
+            raise ValueError("k + 1 must not exceed f")
+        self.k = k
+        self.f = f
+        # 前f % (k + 1)段多一位
+        widths = [f // (k + 1) + (1 if i < f % (k + 1) else 0) for i in range(k + 1)]
+        self.offsets = [sum(widths[:i]) for i in range(k + 1)]
+        self.masks = [(1 << width) - 1 for width in widths]
+        self.doc_ids = []
+        self.fingerprints = np.zeros(1024, dtype=np.uint64)
+        # bulk_build建立的每段排序数组：(段的值, 文档位置)
+        self.sorted_bands = [(np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64))] * (k + 1)
+        # insert加入的每段哈希表
+        self.bands = [dict() for _ in range(k + 1)]
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def _band_values(self, fingerprint):
+        """
+        simhash每一段的值。
+        :param fingerprint: simhash值
+        :return:
+        """
+        return [(fingerprint >> offset) & mask for offset, mask in zip(self.offsets, self.masks)]
+
+    def _append(self, doc_ids, fingerprints):
+        """
+        保存文档id和simhash值，数组容量不足时翻倍。
+        :param doc_ids:
+        :param fingerprints: uint64数组
+        :return: 新文档的起始位置
+        """
+        start = len(self.doc_ids)
+        end = start + len(fingerprints)
+        if end > len(self.fingerprints):
+            capacity = max(end, 2 * len(self.fingerprints))
+            resized = np.zeros(capacity, dtype=np.uint64)
+            resized[:start] = self.fingerprints[:start]
+            self.fingerprints = resized
+        self.fingerprints[start:end] = fingerprints
+        self.doc_ids.extend(doc_ids)
+        return start
+
+    def insert(self, doc_id, fingerprint):
+        """
+        加入一个文档。
+        :param doc_id: 文档id
+        :param fingerprint: simhash值
+        :return:
+        """
+        position = self._append([doc_id], np.array([fingerprint], dtype=np.uint64))
+        for band, value in zip(self.bands, self._band_values(int(fingerprint))):
+            band.setdefault(value, []).append(position)
+
+    def _merge_sorted(self, positions, fingerprints):
+        """
+        把文档合并到每段的排序数组中。
+        :param positions: 文档位置数组
+        :param fingerprints: 对应的uint64 simhash数组
+        :return:
+        """
+        for i, (offset, mask) in enumerate(zip(self.offsets, self.masks)):
+            values = (fingerprints >> np.uint64(offset)) & np.uint64(mask)
+            old_values, old_positions = self.sorted_bands[i]
+            values = np.concatenate((old_values, values))
+            band_positions = np.concatenate((old_positions, positions))
+            order = np.argsort(values, kind="mergesort")
+            self.sorted_bands[i] = (values[order], band_positions[order])
+
+    def bulk_build(self, fingerprints, doc_ids=None):
+        """
+        一次加入大量文档，每段重新排序为数组。
+        :param fingerprints: simhash值的列表或uint64数组
+        :param doc_ids: 文档id列表，默认为文档在索引中的位置
+        :return:
+        """
+        fingerprints = np.asarray(fingerprints, dtype=np.uint64)
+        if doc_ids is None:
+            doc_ids = range(len(self.doc_ids), len(self.doc_ids) + len(fingerprints))
+        start = self._append(list(doc_ids), fingerprints)
+        self._merge_sorted(np.arange(start, start + len(fingerprints), dtype=np.int64), fingerprints)
+
+    def compact(self):
+        """
+        把insert加入的文档从哈希表合并到每段的排序数组中，释放哈希表中的python对象。
+        :return:
+        """
+        if not self.bands[0]:
+            return
+        positions = np.array(sorted(itertools.chain.from_iterable(self.bands[0].values())), dtype=np.int64)
+        self._merge_sorted(positions, self.fingerprints[positions])
+        self.bands = [dict() for _ in range(self.k + 1)]
+
+    def _candidate_positions(self, fingerprint):
+        """
+        至少有一段与fingerprint相同的文档位置，可能有重复。
+        :param fingerprint: simhash值
+        :return: 文档位置数组
+        """
+        result = []
+        for i, value in enumerate(self._band_values(int(fingerprint))):
+            values, positions = self.sorted_bands[i]
+            # 按数组的类型查找，否则会把整个数组转换为uint64
+            value_key = values.dtype.type(value)
+            left = np.searchsorted(values, value_key, side="left")
+            right = np.searchsorted(values, value_key, side="right")
+            result.append(positions[left:right])
+            inserted = self.bands[i].get(value)
+            if inserted:
+                result.append(np.array(inserted, dtype=np.int64))
+        return np.concatenate(result)
+
+    def candidates(self, fingerprint):
+        """
+        至少有一段与fingerprint相同的文档位置。
+        :param fingerprint: simhash值
+        :return: 文档位置数组
+        """
+        return np.unique(self._candidate_positions(fingerprint))
+
+    def save(self, path):
+        """
+        保存索引，simhash数组按值从小到大排列，段的值和文档位置使用能容纳的最小整数类型。
+        :param path: 目录
+        :return:
+        """
+        self.compact()
+        n = len(self)
+        order = np.argsort(self.fingerprints[:n], kind="mergesort")
+        # 原位置到排序后位置的映射
+        rank = np.empty(n, dtype=np.int64)
+        rank[order] = np.arange(n)
+        arrays = {"params": np.array([self.k, self.f], dtype=np.int64),
+                  "fingerprints": self.fingerprints[:n][order]}
+        doc_ids = _id_array(self.doc_ids)
+        if doc_ids is not None:
+            arrays["doc_ids"] = doc_ids[order]
+        else:
+            doc_ids = [self.doc_ids[position] for position in order.tolist()]
+        position_dtype = _min_uint_dtype(n)
+        for i, (values, positions) in enumerate(self.sorted_bands):
+            arrays["band_values_{0}".format(i)] = values.astype(_min_uint_dtype(self.masks[i]))
+            arrays["band_positions_{0}".format(i)] = rank[positions].astype(position_dtype)
+        OsUtil.makedirs(path)
+        for name, array in arrays.items():
+            np.save(os.path.join(path, name + ".npy"), array)
+        json_path = os.path.join(path, "doc_ids.json")
+        if "doc_ids" in arrays:
+            if os.path.exists(json_path):
+                os.remove(json_path)
+        else:
+            with io.open(json_path, "w", encoding="utf-8") as f_json:
+                f_json.write(json.dumps(doc_ids, ensure_ascii=False))
+            npy_path = os.path.join(path, "doc_ids.npy")
+            if os.path.exists(npy_path):
+                os.remove(npy_path)
+
+    @staticmethod
+    def load(path, mmap=True):
+        """
+        加载save保存的索引。
+        :param path: 目录
+        :param mmap: 是否以只读内存映射的方式加载，内存映射的索引只能查询，不能再加入文档
+        :return: SimHashIndex
+        """
+        mmap_mode = "r" if mmap else None
+
+        def load_array(name):
+            return np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+
+        k, f = load_array("params").tolist()
+        index = SimHashIndex(k, f)
+        index.fingerprints = load_array("fingerprints")
+        json_path = os.path.join(path, "doc_ids.json")
+        if os.path.exists(json_path):
+            with io.open(json_path, "r", encoding="utf-8") as f_json:
+                index.doc_ids = json.load(f_json)
+        else:
+            index.doc_ids = load_array("doc_ids")
+            if not mmap:
+                index.doc_ids = index.doc_ids.tolist()
+        index.sorted_bands = [(load_array("band_values_{0}".format(i)), load_array("band_positions_{0}".format(i)))
+                              for i in range(k + 1)]
+        return index
+
+    def query(self, fingerprint, k=None):
+        """
+        查找海明距离不超过k的文档。
+        :param fingerprint: simhash值
+        :param k: 海明距离的阈值，不能超过建立索引时的k
+        :return: 按距离从小到大排列的(文档id, 海明距离)列表
+        """
+        k = self.k if k is None else k
+        if k > self.k:
+            raise ValueError("k must not exceed the index k={0}".format(self.k))
+        positions = self._candidate_positions(fingerprint)
+        index, distances = hamming_one_to_many(fingerprint, self.fingerprints[positions], threshold=k)
+        # 候选中通常只有很少的文档距离不超过k，过滤后再去重
+        positions, first = np.unique(positions[index], return_index=True)
+        distances = distances[first]
+        order = np.lexsort((positions, distances))
+        positions = positions[order]
+        if isinstance(self.doc_ids, np.ndarray):
+            doc_ids = self.doc_ids[positions].tolist()
+        else:
+            doc_ids = [self.doc_ids[position] for position in positions.tolist()]
+        return list(zip(doc_ids, distances[order].tolist()))
+
+
+def test_simhash_index():
+    """
+    测试simhash分段索引。
+    :return:
+    """
+    documents = ['This is a test string for testing'.split(),
+                 'This is a test string for testing also'.split(),
+                 'nai nai ge xiong cao'.split()]
+    fingerprints = simhash_batch(documents, 64)
+    index = SimHashIndex(k=3, f=64)
+    index.bulk_build(fingerprints[:2], ["doc1", "doc2"])
+    index.insert("doc3", fingerprints[2])
+    for fingerprint in fingerprints:
+        common_logger.info("{0}: {1}".format(fingerprint, index.query(fingerprint)))
+
+
+if __name__ == '__main__':
+    test_simhash_index()
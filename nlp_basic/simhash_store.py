@@ -0,0 +1,201 @@
+# -*- coding:utf-8 -*-
+
+# ==============================================================================
+# 持久化的simhash存储，重复运行时不需要从原始文本重新计算simhash。
+# 目录结构：
+# 1. CURRENT：当前代的编号，写入临时文件后用os.replace替换，切换是原子的；
+# 2. gen_<编号>/：SimHashIndex.save保存的基础索引（按值排序的uint64 simhash数组、文档id数组、
+#    每段的排列表），以只读内存映射的方式打开，查询时只读取用到的页；
+# 3. gen_<编号>/wal.log：预写日志，append的文档每行以json写入[simhash, 文档id]并flush，
+#    打开存储时重放到内存中的SimHashIndex。
+# 预写日志中的文档数达到max_wal_size时compact：基础索引与日志合并后保存为下一代，切换CURRENT后
+# 删除上一代。切换之前崩溃时仍打开上一代及其完整的日志，不会丢失文档，打开时删除其他代的目录。
+# ==============================================================================
+import os
+import io
+import json
+import shutil
+import tempfile
+import numpy as np
+from nlp_basic.simhash_demo import simhash_batch
+from nlp_basic.simhash_index import SimHashIndex
+from util.log_util import LoggerUtil
+from util.os_util import OsUtil
+
+# 日志器
+common_logger = LoggerUtil.get_common_logger()
+
+
+class SimHashStore(object):
+    def __init__(self, path, k=3, f=64, max_wal_size=100000, sync=False):
+        """
+        打开或创建存储，已有的存储使用保存时的k和f。
+        :param path: 目录
+        :param k: 海明距离不超过k的文档视为近似重复
+        :param f: simhash的位数，不超过64
+        :param max_wal_size: 预写日志中的文档数达到该值时compact
+        :param sync: 每次append后是否调用os.fsync，保证断电时日志不丢失
+        """
+        self.path = path
+        self.max_wal_size = max_wal_size
+        self.sync = sync
+        OsUtil.makedirs(path)
+        current_path = os.path.join(path, "CURRENT")
+        if os.path.exists(current_path):
+            with io.open(current_path, "r") as f_current:
+                self.generation = int(f_current.read().strip())
+        else:
+            self.generation = 0
+            SimHashIndex(k, f).save(self._generation_path(0))
+            self._write_current(0)
+        # compact中断时留下的其他代
+        for name in os.listdir(path):
+            if name.startswith("gen_") and name != "gen_{0}".format(self.generation):
+                shutil.rmtree(os.path.join(path, name))
+        self._open()
+
+    def _generation_path(self, generation):
+        return os.path.join(self.path, "gen_{0}".format(generation))
+
+    def _write_current(self, generation):
+        """
+        原子地把CURRENT切换为generation。
+        :param generation:
+        :return:
+        """
+        tmp_path = os.path.join(self.path, "CURRENT.tmp")
+        with io.open(tmp_path, "w") as f_current:
+            f_current.write(u"{0}\n".format(generation))
+            f_current.flush()
+            os.fsync(f_current.fileno())
+        os.replace(tmp_path, os.path.join(self.path, "CURRENT"))
+
+    def _open(self):
+        """
+        内存映射当前代的基础索引，重放预写日志。
+        :return:
+        """
+        generation_path = self._generation_path(self.generation)
+        self.base = SimHashIndex.load(generation_path, mmap=True)
+        self.k, self.f = self.base.k, self.base.f
+        self.wal = SimHashIndex(self.k, self.f)
+        wal_path = os.path.join(generation_path, "wal.log")
+        if os.path.exists(wal_path):
+            with io.open(wal_path, "r", encoding="utf-8") as f_wal:
+                for line in f_wal:
+                    try:
+                        fingerprint, doc_id = json.loads(line)
+                    except ValueError:
+                        # 写入时崩溃留下的不完整的最后一行
+                        common_logger.warning("skip broken wal record: {0!r}".format(line))
+                        continue
+                    self.wal.insert(doc_id, fingerprint)
+        self.wal_file = io.open(wal_path, "a", encoding="utf-8")
+        if self.wal_file.tell() > 0:
+            with io.open(wal_path, "rb") as f_wal:
+                f_wal.seek(-1, os.SEEK_END)
+                torn = f_wal.read(1) != b"\n"
+            if torn:
+                # 让不完整的记录单独成为一行，后面写入的记录不受影响
+                self.wal_file.write(u"\n")
+
+    def __len__(self):
+        return len(self.base) + len(self.wal)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        关闭预写日志。
+        :return:
+        """
+        if not self.wal_file.closed:
+            self.wal_file.close()
+
+    def extend(self, doc_ids, fingerprints):
+        """
+        加入多篇文档，先写预写日志再加入内存索引。
+        :param doc_ids: 文档id列表，为整数或字符串
+        :param fingerprints: simhash值的列表或uint64数组
+        :return:
+        """
+        # numpy的整数不能直接转换为json
+        doc_ids = [doc_id.item() if isinstance(doc_id, np.generic) else doc_id for doc_id in doc_ids]
+        records = list(zip(doc_ids, np.asarray(fingerprints, dtype=np.uint64).tolist()))
+        self.wal_file.write(u"".join(json.dumps([fingerprint, doc_id]) + u"\n" for doc_id, fingerprint in records))
+        self.wal_file.flush()
+        if self.sync:
+            os.fsync(self.wal_file.fileno())
+        for doc_id, fingerprint in records:
+            self.wal.insert(doc_id, fingerprint)
+        if len(self.wal) >= self.max_wal_size:
+            self.compact()
+
+    def append(self, doc_id, fingerprint):
+        """
+        加入一篇文档。
+        :param doc_id: 文档id，为整数或字符串
+        :param fingerprint: simhash值
+        :return:
+        """
+        self.extend([doc_id], [fingerprint])
+
+    def query(self, fingerprint, k=None):
+        """
+        在基础索引和预写日志中查找海明距离不超过k的文档。
+        :param fingerprint: simhash值
+        :param k: 海明距离的阈值，不能超过存储的k
+        :return: 按距离从小到大排列的(文档id, 海明距离)列表
+        """
+        result = self.base.query(fingerprint, k) + self.wal.query(fingerprint, k)
+        result.sort(key=lambda item: item[1])
+        return result
+
+    def compact(self):
+        """
+        把基础索引和预写日志合并为下一代。合并时需要把基础索引读入内存。
+        :return:
+        """
+        if len(self.wal) == 0:
+            return
+        merged = SimHashIndex(self.k, self.f)
+        base_ids = self.base.doc_ids
+        merged.bulk_build(self.base.fingerprints,
+                          base_ids.tolist() if isinstance(base_ids, np.ndarray) else list(base_ids))
+        merged.bulk_build(self.wal.fingerprints[:len(self.wal)], self.wal.doc_ids)
+        old_generation = self.generation
+        self.generation += 1
+        generation_path = self._generation_path(self.generation)
+        merged.save(generation_path)
+        self._write_current(self.generation)
+        self.close()
+        self.base = None
+        shutil.rmtree(self._generation_path(old_generation))
+        self._open()
+        common_logger.info("compacted {0} documents into {1}".format(len(self), generation_path))
+
+
+def test_simhash_store():
+    """
+    测试simhash存储的写入、compact和重新打开后查询。
+    :return:
+    """
+    documents = ['This is a test string for testing'.split(),
+                 'This is a test string for testing also'.split(),
+                 'nai nai ge xiong cao'.split()]
+    fingerprints = simhash_batch(documents, 64)
+    path = os.path.join(tempfile.mkdtemp(), "simhash_store")
+    with SimHashStore(path, k=3, max_wal_size=2) as store:
+        store.extend(["doc1", "doc2"], fingerprints[:2])
+        store.append("doc3", fingerprints[2])
+    with SimHashStore(path) as store:
+        for fingerprint in fingerprints:
+            common_logger.info("{0}: {1}".format(fingerprint, store.query(fingerprint)))
+
+
+if __name__ == '__main__':
+    test_simhash_store()
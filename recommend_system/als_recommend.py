@@ -0,0 +1,353 @@
+# -*- coding:utf-8 -*-
+
+# ==============================================================================
+# 隐式反馈的矩阵分解推荐算法ALS（Alternating Least Squares）。
+# 参考Hu, Koren, Volinsky的Collaborative Filtering for Implicit Feedback Datasets：
+# 1. 用户u对物品i有评分r时偏好p=1、置信度c=1+alpha*r，没有评分时p=0、c=1；
+# 2. 固定物品向量Y时，每个用户向量的最优解为
+#    x_u = (Y^T Y + Y^T (C_u - I) Y + lambda * I)^-1 * Y^T C_u p_u，
+#    其中Y^T Y对所有用户相同，只需计算一次，Y^T (C_u - I) Y只涉及用户评价过的物品；
+#    固定用户向量时物品向量的求解方式相同，两步交替迭代；
+# 3. 每半步把用户（或物品）按评分个数分块，每块用einsum计算所有的(f, f)矩阵，
+#    再用np.linalg.solve批量求解，各块在线程池中并行计算（numpy计算时释放GIL）；
+#    评分过多的单个用户（或物品）按评分分段计算后累加，einsum的临时数组始终不超过MAX_BLOCK_ENTRIES；
+# 4. 模型只保存(n_users, f)和(n_items, f)两个因子矩阵，内存为O((users + items) * f)，
+#    不需要UserBasedCF、ItemBasedCF中平方级别的相似度矩阵。
+# 推荐时用户对物品的得分为x_u * y_i，召回率、准确率、覆盖率和流行度的计算与协同过滤相同。
+# ==============================================================================
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from recommend_system.cf_data import load_ratings, split_mask
+from recommend_system.cf_matrix import RatingMatrix, top_n, top_n_dict, save_arrays, load_arrays
+from recommend_system.cf_metrics import SplitMetrics
+from recommend_system.user_item_base_cf import data_file_path
+from util.log_util import LoggerUtil
+
+# 日志器
+common_logger = LoggerUtil.get_common_logger()
+# 每块的评分个数 * f * f的上限，控制einsum临时数组的内存
+MAX_BLOCK_ENTRIES = 1 << 22
+
+
+def _block_nnz(n_factors):
+    """
+    einsum一次处理的评分个数，使临时数组的元素个数不超过MAX_BLOCK_ENTRIES。
+    :param n_factors: 因子个数
+    :return:
+    """
+    return max(1, MAX_BLOCK_ENTRIES // (n_factors * n_factors))
+
+
+def _row_blocks(indptr, n_factors):
+    """
+    按评分个数把行划分为多块，每块的评分个数不超过_block_nnz，单行超过时单独成块，由_solve_block分段计算。
+    :param indptr: CSR矩阵的indptr
+    :param n_factors: 因子个数
+    :return: (start, end)的列表
+    """
+    block_nnz = _block_nnz(n_factors)
+    n_rows = len(indptr) - 1
+    blocks = []
+    start = 0
+    while start < n_rows:
+        end = int(np.searchsorted(indptr, indptr[start] + block_nnz, side="right")) - 1
+        end = min(max(end, start + 1), n_rows)
+        blocks.append((start, end))
+        start = end
+    return blocks
+
+
+def _solve_block(matrix, fixed, gram, alpha, start, end):
+    """
+    求解第[start, end)行的因子向量。
+    :param matrix: CSR评分矩阵，行为需要求解的对象
+    :param fixed: 固定的另一侧因子矩阵
+    :param gram: fixed^T * fixed + lambda * I
+    :param alpha: 置信度系数
+    :param start:
+    :param end:
+    :return: (end - start, f)的因子矩阵
+    """
+    indptr = matrix.indptr[start:end + 1]
+    lo, hi = indptr[0], indptr[-1]
+    y = fixed[matrix.indices[lo:hi]]
+    # c - 1 = alpha * r
+    confidence = alpha * np.asarray(matrix.data[lo:hi], dtype=np.float64)
+    counts = np.diff(indptr)
+    nonempty = np.flatnonzero(counts)
+    starts = (indptr[:-1] - lo)[nonempty]
+    ends = starts + counts[nonempty]
+
+    a = np.tile(gram, (end - start, 1, 1))
+    b = np.zeros((end - start, fixed.shape[1]))
+    if len(nonempty):
+        # 评分在CSR中按行连续存放，reduceat即可按行求和
+        weighted = y * confidence[:, np.newaxis]
+        block_nnz = _block_nnz(fixed.shape[1])
+        for chunk_start in range(0, hi - lo, block_nnz):
+            chunk_end = min(chunk_start + block_nnz, hi - lo)
+            # 与本段相交的行在段内都至少有一个评分，段内的起始位置严格递增
+            inside = (starts < chunk_end) & (ends > chunk_start)
+            outer = np.einsum("ni,nj->nij", weighted[chunk_start:chunk_end], y[chunk_start:chunk_end])
+            a[nonempty[inside]] += np.add.reduceat(outer, np.maximum(starts[inside], chunk_start) - chunk_start,
+                                                   axis=0)
+        b[nonempty] = np.add.reduceat(y * (1 + confidence)[:, np.newaxis], starts, axis=0)
+    return np.linalg.solve(a, b[:, :, np.newaxis])[:, :, 0]
+
+
+def least_squares(matrix, fixed, regularization, alpha, executor=None):
+    """
+    ALS的半步：固定另一侧的因子矩阵，求解matrix每一行的因子向量。
+    :param matrix: CSR评分矩阵
+    :param fixed: 固定的另一侧因子矩阵
+    :param regularization: 正则化系数
+    :param alpha: 置信度系数
+    :param executor: 线程池，为None时在当前线程中计算
+    :return: (matrix.shape[0], f)的因子矩阵
+    """
+    n_factors = fixed.shape[1]
+    gram = fixed.T.dot(fixed) + regularization * np.eye(n_factors)
+    result = np.empty((matrix.shape[0], n_factors))
+    blocks = _row_blocks(matrix.indptr, n_factors)
+    if executor is None:
+        solved = [_solve_block(matrix, fixed, gram, alpha, start, end) for start, end in blocks]
+    else:
+        solved = executor.map(lambda block: _solve_block(matrix, fixed, gram, alpha, block[0], block[1]), blocks)
+    for (start, end), factors in zip(blocks, solved):
+        result[start:end] = factors
+    return result
+
+
+class ALSRecommender(object):
+    def __init__(self, datafile=None, factors=32, regularization=0.1, alpha=2.0, iterations=10, n_threads=4,
+                 seed=0):
+        """
+        构造函数及初始化。
+        :param datafile: 数据文件名称
+        :param factors: 因子个数
+        :param regularization: 正则化系数
+        :param alpha: 置信度系数，置信度为1 + alpha * 评分
+        :param iterations: 交替迭代的次数
+        :param n_threads: 求解时的线程数
+        :param seed: 初始化因子矩阵的随机种子
+        """
+        self.datafile = datafile
+        self.factors = factors
+        self.regularization = regularization
+        self.alpha = alpha
+        self.iterations = iterations
+        self.n_threads = n_threads
+        self.seed = seed
+        self.data = None
+        self.train_data = None
+        self.test_data = None
+        self.rating_matrix = None
+        self.user_factors = None
+        self.item_factors = None
+        # 最近一次recommend_all的结果，供各项评价指标共用
+        self.top_n_cache = None
+        # 当前划分的物品流行度和测试矩阵等统计
+        self.metrics_cache = None
+
+        if self.datafile is not None:
+            self.read_data()
+            self.split_data(3, 47)
+
+    def read_data(self, datafile=None):
+        """
+        读取评分文件，与UserBasedCF相同。
+        :param datafile:
+        :return:
+        """
+        self.datafile = datafile or self.datafile
+        self.data = load_ratings(self.datafile)
+
+    def split_data(self, k, seed, data=None, m=8):
+        """
+        拆分训练集和测试集，与UserBasedCF使用相同的划分。
+        :param k: 测试集所在的折
+        :param seed: 随机种子
+        :param data: 数据集
+        :param m: 折数为m + 1
+        :return:
+        """
+        self.data = data or self.data
+        test_mask = split_mask(len(self.data), k, seed, m + 1)
+        self.test_data = {}
+        self.train_data = {}
+        for (user, item, record), is_test in zip(self.data, test_mask.tolist()):
+            if is_test:
+                self.test_data.setdefault(user, {})
+                self.test_data[user][item] = record
+            else:
+                self.train_data.setdefault(user, {})
+                self.train_data[user][item] = record
+
+    def fit(self, train=None):
+        """
+        交替求解用户因子和物品因子。
+        :param train: 训练集
+        :return:
+        """
+        train = train or self.train_data
+        self.top_n_cache = None
+        self.metrics_cache = None
+        self.rating_matrix = RatingMatrix.from_dict(train)
+        user_items = self.rating_matrix.matrix
+        item_users = user_items.T.tocsr()
+        rng = np.random.RandomState(self.seed)
+        self.user_factors = rng.normal(scale=0.01, size=(self.rating_matrix.n_users, self.factors))
+        self.item_factors = rng.normal(scale=0.01, size=(self.rating_matrix.n_items, self.factors))
+        with ThreadPoolExecutor(max_workers=self.n_threads) as executor:
+            for iteration in range(self.iterations):
+                start_time = time.perf_counter()
+                self.user_factors = least_squares(user_items, self.item_factors, self.regularization,
+                                                  self.alpha, executor)
+                self.item_factors = least_squares(item_users, self.user_factors, self.regularization,
+                                                  self.alpha, executor)
+                common_logger.info("als iteration {0}: {1:.3f}s".format(iteration,
+                                                                        time.perf_counter() - start_time))
+        return self
+
+    def recommend(self, user, n_item=10, min_score=None):
+        """
+        为指定用户推荐物品，得分为用户因子与物品因子的内积。
+        :param user:
+        :param n_item:
+        :param min_score: 得分不大于min_score的物品不推荐，默认对所有未评价的物品排序，得分可以为负
+        :return: {item: score}
+        """
+        rm = self.rating_matrix
+        u = rm.user_index.get(user)
+        if u is None:
+            return dict()
+        rank = self.item_factors.dot(self.user_factors[u])
+        seen = rm.matrix.indices[rm.matrix.indptr[u]:rm.matrix.indptr[u + 1]]
+        return top_n_dict(rank, seen, rm.item_ids, n_item, min_score)
+
+    def recommend_all(self, n_item=10, block_size=1024, min_score=None):
+        """
+        一次为所有用户推荐物品，去掉用户已经评价过的物品后取得分最高的n_item个物品。
+        :param n_item: 推荐物品个数
+        :param block_size: 每次计算的用户数，用于控制稠密得分矩阵的内存
+        :param min_score: 得分不大于min_score的物品不推荐，默认对所有未评价的物品排序
+        :return: (n_users, n_item)的物品编码数组，不足时用-1填充
+        """
+        rm = self.rating_matrix
+        result = np.empty((rm.n_users, n_item), dtype=np.int32)
+        for start in range(0, rm.n_users, block_size):
+            end = min(start + block_size, rm.n_users)
+            scores = self.user_factors[start:end].dot(self.item_factors.T)
+            scores[rm.matrix[start:end].nonzero()] = -np.inf
+            result[start:end] = top_n(scores, n_item, min_score)
+        return result
+
+    def _top_n(self, n_item):
+        """
+        获取recommend_all的结果，相同参数的结果只计算一次。
+        :param n_item:
+        :return:
+        """
+        if self.top_n_cache is None or self.top_n_cache[0] != n_item:
+            self.top_n_cache = (n_item, self.recommend_all(n_item=n_item))
+        return self.top_n_cache[1]
+
+    def save(self, path):
+        """
+        保存模型：id编码、CSR评分矩阵和两个因子矩阵。
+        :param path: 目录
+        :return:
+        """
+        if self.user_factors is None:
+            raise ValueError("save requires fit()")
+        self.rating_matrix.save(path)
+        save_arrays(path, user_factors=self.user_factors, item_factors=self.item_factors)
+
+    @staticmethod
+    def load(path, mmap=True):
+        """
+        加载save保存的模型。
+        :param path: 目录
+        :param mmap: 是否以只读内存映射的方式加载
+        :return: ALSRecommender
+        """
+        model = ALSRecommender()
+        model.rating_matrix = RatingMatrix.load(path, mmap)
+        arrays = load_arrays(path, ["user_factors", "item_factors"], mmap)
+        model.user_factors = arrays["user_factors"]
+        model.item_factors = arrays["item_factors"]
+        model.factors = model.user_factors.shape[1]
+        return model
+
+    def split_metrics(self, test=None):
+        """
+        当前训练集和测试集上预先统计的评价数据，训练集或测试集变化时重新统计。
+        :param test: 测试集，默认为test_data
+        :return: SplitMetrics
+        """
+        test = test or self.test_data
+        if self.metrics_cache is None or self.metrics_cache.test is not test:
+            self.metrics_cache = SplitMetrics(self.rating_matrix, test)
+        return self.metrics_cache
+
+    def recall_and_precision(self, test=None, n_item=10):
+        """
+        计算召回率和准确率。
+        :param test:
+        :param n_item:
+        :return:
+        """
+        return self.split_metrics(test).recall_and_precision(self._top_n(n_item))
+
+    def coverage(self, n_item=10):
+        """
+        计算覆盖率。
+        :param n_item:
+        :return:
+        """
+        return self.split_metrics().coverage(self._top_n(n_item))
+
+    def popularity(self, n_item=10):
+        """
+        计算流行度。
+        :param n_item:
+        :return:
+        """
+        return self.split_metrics().popularity(self._top_n(n_item))
+
+
+def test_als_recommend():
+    """
+    测试ALS推荐。
+    :return:
+    """
+    als = ALSRecommender(data_file_path)
+    als.fit()
+    user = "345"
+    rank = als.recommend(user)
+    for i, rvi in rank.items():
+        items = als.test_data.get(user, {})
+        record = items.get(i, 0)
+        print("{0: >5}: {1:.4f}--{2:.4f}".format(i, rvi, record))
+
+
+def test_als():
+    """
+    测试ALS的召回率、准确率、覆盖率和流行度。
+    :return:
+    """
+    print("{0: >8}{1: >20}{2: >20}{3: >20}{4: >20}".format('factors', "recall", 'precision', 'coverage',
+                                                           'popularity'))
+    for factors in [8, 16, 32, 64]:
+        als = ALSRecommender(data_file_path, factors=factors)
+        als.fit()
+        recall, precision = als.recall_and_precision()
+        coverage = als.coverage()
+        popularity = als.popularity()
+        print("{0: >8}{1: >19.3f}%{2: >19.3f}%{3: >19.3f}%{4: >20.3f}".format(
+            factors, recall * 100, precision * 100, coverage * 100, popularity))
+
+
+if __name__ == "__main__":
+    test_als()
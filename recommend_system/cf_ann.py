@@ -0,0 +1,153 @@
+# -*- coding:utf-8 -*-
+
+# ==============================================================================
+# 用随机投影局部敏感哈希（Random Projection LSH）查找近似最相似的用户。
+# 1. 每张哈希表随机生成n_bits个超平面，向量在超平面法向量上投影的符号组成n_bits位的哈希码，
+#    两个向量夹角越小，哈希码相同的概率越高；
+# 2. 查询时取各张表中与查询向量哈希码相同的桶作为候选，n_probe控制每张表额外探查的桶数
+#   （依次翻转投影绝对值最小的位），再对候选集合精确计算余弦相似度并取top k；
+# 3. n_tables和n_probe越大召回率越高、查询越慢，n_bits越大每个桶越小、查询越快但召回率越低。
+# 对L2归一化后的0/1评分向量，余弦相似度与UserBasedCF中的user_sim_best完全相同。
+# ==============================================================================
+import time
+import numpy as np
+import scipy.sparse as sp
+
+
+class RandomProjectionLSH(object):
+    def __init__(self, n_tables=16, n_bits=6, seed=0):
+        """
+        构造函数。
+        :param n_tables: 哈希表个数
+        :param n_bits: 每张表的哈希位数
+        :param seed: 随机种子
+        """
+        self.n_tables = n_tables
+        self.n_bits = n_bits
+        self.seed = seed
+        self.vectors = None
+        self.planes = None
+        self.bucket_codes = None
+        self.bucket_members = None
+
+    def fit(self, vectors):
+        """
+        对所有向量建立索引。
+        :param vectors: CSR格式的向量矩阵，每行已做L2归一化
+        :return:
+        """
+        self.vectors = sp.csr_matrix(vectors)
+        rng = np.random.RandomState(self.seed)
+        # 所有表的超平面放在同一个矩阵中，一次矩阵乘法得到所有表的投影
+        self.planes = rng.standard_normal((self.vectors.shape[1], self.n_tables * self.n_bits))
+        projections = self.vectors * self.planes
+        self.bucket_codes = []
+        self.bucket_members = []
+        for table in range(self.n_tables):
+            codes = self._codes(projections[:, table * self.n_bits:(table + 1) * self.n_bits])
+            order = np.argsort(codes, kind="mergesort")
+            self.bucket_codes.append(codes[order])
+            self.bucket_members.append(order.astype(np.int32))
+        return self
+
+    def _codes(self, projections):
+        """
+        投影符号转换为整数哈希码。
+        :param projections: (n, n_bits)的投影值
+        :return:
+        """
+        return (projections > 0).astype(np.int64).dot(1 << np.arange(self.n_bits, dtype=np.int64))
+
+    def _probe_codes(self, projection, n_probe):
+        """
+        查询向量在一张表中需要探查的哈希码，先是自身的哈希码，再依次翻转投影绝对值最小的位。
+        :param projection: (n_bits,)的投影值
+        :param n_probe: 额外探查的桶数
+        :return:
+        """
+        code = int(self._codes(projection[np.newaxis, :])[0])
+        flips = np.argsort(np.abs(projection))[:n_probe]
+        return [code] + [code ^ (1 << int(bit)) for bit in flips]
+
+    def candidates(self, row, n_probe=0):
+        """
+        查找与第row个向量落在相同桶中的候选向量。
+        :param row: 向量编码
+        :param n_probe: 每张表额外探查的桶数
+        :return: 候选向量编码数组，不包括自身
+        """
+        projections = np.asarray(self.vectors[row] * self.planes).ravel()
+        result = []
+        for table in range(self.n_tables):
+            projection = projections[table * self.n_bits:(table + 1) * self.n_bits]
+            codes = self.bucket_codes[table]
+            for code in self._probe_codes(projection, n_probe):
+                start = np.searchsorted(codes, code, side="left")
+                end = np.searchsorted(codes, code, side="right")
+                result.append(self.bucket_members[table][start:end])
+        result = np.unique(np.concatenate(result))
+        return result[result != row]
+
+    def query(self, row, k, n_probe=0):
+        """
+        近似查找与第row个向量最相似的k个向量。
+        :param row: 向量编码
+        :param k: 返回的个数
+        :param n_probe: 每张表额外探查的桶数，越大召回率越高
+        :return: 按相似度从大到小排列的(向量编码数组, 相似度数组)
+        """
+        candidates = self.candidates(row, n_probe)
+        sims = (self.vectors[candidates] * self.vectors[row].T).toarray().ravel()
+        keep = sims > 0
+        candidates, sims = candidates[keep], sims[keep]
+        if len(candidates) > k:
+            selected = np.argpartition(-sims, k - 1)[:k]
+            candidates, sims = candidates[selected], sims[selected]
+        order = np.lexsort((candidates, -sims))
+        return candidates[order], sims[order]
+
+
+def normalized_binary_rows(rating_matrix):
+    """
+    0/1评分向量按行L2归一化，两行的内积即为UserBasedCF中的用户余弦相似度。
+    :param rating_matrix: RatingMatrix
+    :return: CSR矩阵
+    """
+    binary = sp.csr_matrix(rating_matrix.binary, dtype=np.float64)
+    norms = np.sqrt(np.diff(binary.indptr)).astype(np.float64)
+    norms[norms == 0] = 1
+    return sp.diags(1.0 / norms) * binary
+
+
+def benchmark_ann(cf, k=20, settings=((8, 6, 0), (8, 6, 2), (16, 6, 2), (16, 4, 0)), n_queries=200):
+    """
+    在同一批用户上比较精确查找和LSH近似查找top k相似用户的召回率和耗时。
+    :param cf: 已经计算过user_similarity_best的UserBasedCF
+    :param k: 相似用户个数
+    :param settings: (n_tables, n_bits, n_probe)的列表
+    :param n_queries: 查询的用户数
+    :return: 每种设置一行的结果列表
+    """
+    rm = cf.rating_matrix
+    users = rm.user_ids[:n_queries].tolist()
+    start_time = time.perf_counter()
+    exact = dict()
+    for user in users:
+        ranked = sorted(cf.user_sim_best[user].items(), key=lambda x: x[1], reverse=True)[0:k]
+        exact[user] = set(v for v, _ in ranked)
+    exact_time = (time.perf_counter() - start_time) / len(users)
+    results = [{"method": "exact", "recall": 1.0, "latency": exact_time}]
+
+    vectors = normalized_binary_rows(rm)
+    for n_tables, n_bits, n_probe in settings:
+        index = RandomProjectionLSH(n_tables=n_tables, n_bits=n_bits).fit(vectors)
+        start_time = time.perf_counter()
+        found = 0
+        for user in users:
+            neighbors, _ = index.query(rm.user_index[user], k, n_probe=n_probe)
+            found += len(exact[user] & set(rm.user_ids[neighbors].tolist()))
+        latency = (time.perf_counter() - start_time) / len(users)
+        results.append({"method": "lsh tables={0} bits={1} probe={2}".format(n_tables, n_bits, n_probe),
+                        "recall": found / float(sum(len(v) for v in exact.values())),
+                        "latency": latency})
+    return results
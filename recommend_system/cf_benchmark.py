@@ -0,0 +1,302 @@
+# -*- coding:utf-8 -*-
+
+# ==============================================================================
+# recommend_system的性能基准测试。
+# 1. 按MovieLens u.data的格式生成合成评分数据，用户数和物品数随评分数增长，
+#    物品的热门程度服从长尾分布，同样的评分数和随机种子生成的文件相同，生成后缓存在数据目录中；
+# 2. 对UserBasedCF、ItemBasedCF和simple_recommend分别测试各个阶段：
+#    load（读取评分文件）、split（划分训练集和测试集）、similarity（计算相似度）、
+#    recommend（逐个用户推荐）、evaluate（全部用户的评价）；
+# 3. 每个阶段记录墙钟时间（time.perf_counter）、峰值常驻内存（peak RSS）和每秒处理的对象数，
+#    结果连同python、numpy、scipy的版本和当前的git提交一起输出为JSON，用于比较不同版本的性能。
+# 峰值内存在Linux上通过向/proc/self/clear_refs写入5在每个阶段前重置，其他平台为进程启动以来的峰值。
+# 超过MODEL_LIMITS的评分数时跳过该模型，在结果的skipped中说明，ignore_limits为True时不跳过。
+# 命令：python cf_benchmark.py --sizes 100000 1000000 --output benchmark.json
+# ==============================================================================
+import argparse
+import contextlib
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+import scipy
+import config.common_config as com_config
+from recommend_system import simple_recommend
+from recommend_system.cf_evaluation import evaluate_multi_k
+from recommend_system.user_item_base_cf import UserBasedCF, ItemBasedCF
+from util.log_util import LoggerUtil
+from util.os_util import OsUtil
+
+# 日志器
+common_logger = LoggerUtil.get_common_logger()
+# 默认的评分数
+DEFAULT_SIZES = (10 ** 5, 10 ** 6, 10 ** 7)
+# 默认测试的模型
+DEFAULT_MODELS = ("UserBasedCF", "ItemBasedCF", "simple_recommend")
+# 每个模型测试的最大评分数：1000万条评分时约9.4万个用户，用户共现矩阵接近稠密，
+# simple_recommend的用户×用户和用户×物品矩阵都是稠密的，在100万条评分时已经需要约2.4GB内存
+MODEL_LIMITS = {"UserBasedCF": 10 ** 6, "ItemBasedCF": 10 ** 7, "simple_recommend": 10 ** 6}
+# 合成数据的缓存目录
+DEFAULT_DATA_DIR = os.path.join(com_config.RESOURCE_DIR, "benchmark")
+# 评价时的K值
+K_LIST = (5, 10, 20, 40, 80, 160)
+
+
+def synthetic_shape(n_ratings):
+    """
+    合成数据的用户数和物品数，10万条评分时与ml-100k相同（943个用户，1682个物品）。
+    :param n_ratings: 评分数
+    :return: (n_users, n_items)
+    """
+    n_users = max(10, int(943 * n_ratings / 10 ** 5))
+    n_items = max(10, int(1682 * (n_ratings / 10 ** 5) ** 0.5))
+    return n_users, n_items
+
+
+def generate_ratings(file_path, n_ratings, seed=0, chunk_size=10 ** 6):
+    """
+    生成u.data格式的合成评分文件，每行为user_id、item_id、rating、timestamp。
+    :param file_path: 输出文件路径
+    :param n_ratings: 评分数
+    :param seed: 随机种子
+    :param chunk_size: 每次生成并写入的行数
+    :return:
+    """
+    n_users, n_items = synthetic_shape(n_ratings)
+    rng = np.random.RandomState(seed)
+    # 物品的热门程度服从长尾分布
+    item_weights = 1.0 / (np.arange(n_items) + 10.0) ** 0.8
+    item_weights /= item_weights.sum()
+    item_ids = rng.permutation(n_items) + 1
+    with open(file_path, "w") as f:
+        for start in range(0, n_ratings, chunk_size):
+            size = min(chunk_size, n_ratings - start)
+            columns = np.column_stack([rng.randint(1, n_users + 1, size),
+                                       item_ids[rng.choice(n_items, size, p=item_weights)],
+                                       rng.randint(1, 6, size),
+                                       rng.randint(874724710, 893286638, size)])
+            np.savetxt(f, columns, fmt="%d", delimiter="\t")
+
+
+def synthetic_data_file(n_ratings, seed=0, data_dir=DEFAULT_DATA_DIR):
+    """
+    获取合成评分文件，不存在时生成。
+    :param n_ratings: 评分数
+    :param seed: 随机种子
+    :param data_dir: 数据目录
+    :return: 文件路径
+    """
+    OsUtil.makedirs(data_dir)
+    file_path = os.path.join(data_dir, "ratings_{0}_{1}.data".format(n_ratings, seed))
+    if not os.path.exists(file_path):
+        common_logger.info("generate {0} ratings to {1}".format(n_ratings, file_path))
+        generate_ratings(file_path + ".tmp", n_ratings, seed)
+        os.rename(file_path + ".tmp", file_path)
+    return file_path
+
+
+def reset_peak_rss():
+    """
+    重置进程的峰值常驻内存，只在Linux上有效。
+    :return:
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except (IOError, OSError):
+        pass
+
+
+def peak_rss():
+    """
+    进程的峰值常驻内存。
+    :return: 字节数
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Linux上ru_maxrss的单位为KB，macOS上为字节
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def measure(records, model, n_ratings, stage, func, ops):
+    """
+    执行一个阶段并记录耗时、峰值内存和吞吐量。
+    :param records: 结果列表
+    :param model: 模型名称
+    :param n_ratings: 评分数
+    :param stage: 阶段名称
+    :param func: 无参数的函数
+    :param ops: 本阶段处理的对象数，可以是以func的返回值为参数的函数
+    :return: func的返回值
+    """
+    gc.collect()
+    reset_peak_rss()
+    start_time = time.perf_counter()
+    result = func()
+    wall_time = time.perf_counter() - start_time
+    ops = ops(result) if callable(ops) else ops
+    records.append({"model": model, "n_ratings": n_ratings, "stage": stage,
+                    "wall_time": wall_time, "peak_rss": peak_rss(), "ops": ops,
+                    "ops_per_sec": ops / wall_time if wall_time > 0 else None})
+    common_logger.info("{0} {1} {2}: {3:.3f}s".format(model, n_ratings, stage, wall_time))
+    return result
+
+
+def _sample_users(users, n_recommend, seed):
+    """
+    抽取推荐阶段使用的用户。
+    :param users: 用户id列表
+    :param n_recommend: 用户数
+    :param seed: 随机种子
+    :return:
+    """
+    users = sorted(users)
+    rng = np.random.RandomState(seed)
+    return [users[i] for i in rng.choice(len(users), min(n_recommend, len(users)), replace=False)]
+
+
+def bench_cf(records, model, data_file, n_ratings, n_recommend=100, seed=0):
+    """
+    测试UserBasedCF或ItemBasedCF的各个阶段。
+    :param records: 结果列表
+    :param model: UserBasedCF或ItemBasedCF
+    :param data_file: 评分文件
+    :param n_ratings: 评分数
+    :param n_recommend: recommend阶段的用户数
+    :param seed: 随机种子
+    :return:
+    """
+    cf = UserBasedCF() if model == "UserBasedCF" else ItemBasedCF()
+    measure(records, model, n_ratings, "load", lambda: cf.read_data(data_file), n_ratings)
+    measure(records, model, n_ratings, "split", lambda: cf.split_data(3, 47), n_ratings)
+    if model == "UserBasedCF":
+        measure(records, model, n_ratings, "similarity", cf.user_similarity_best,
+                lambda _: cf.rating_matrix.n_users)
+    else:
+        measure(records, model, n_ratings, "similarity", cf.item_similarity,
+                lambda _: cf.rating_matrix.n_items)
+    users = _sample_users(cf.train_data.keys(), n_recommend, seed)
+    measure(records, model, n_ratings, "recommend",
+            lambda: [cf.recommend(user, k=20, n_item=10) for user in users], len(users))
+    measure(records, model, n_ratings, "evaluate",
+            lambda: evaluate_multi_k(cf, k_list=K_LIST, n_item=10), cf.rating_matrix.n_users * len(K_LIST))
+
+
+def bench_simple(records, data_file, n_ratings, n_recommend=100, seed=0):
+    """
+    测试simple_recommend的各个阶段，读取和划分数据与UserBasedCF相同，
+    evaluate阶段为从相似度矩阵中为所有用户查找最相似的用户。
+    :param records: 结果列表
+    :param data_file: 评分文件
+    :param n_ratings: 评分数
+    :param n_recommend: recommend阶段的用户数
+    :param seed: 随机种子
+    :return:
+    """
+    model = "simple_recommend"
+    cf = UserBasedCF()
+    measure(records, model, n_ratings, "load", lambda: cf.read_data(data_file), n_ratings)
+    measure(records, model, n_ratings, "split", lambda: cf.split_data(3, 47), n_ratings)
+    prefers = cf.train_data
+    sim_matrix = measure(records, model, n_ratings, "similarity",
+                         lambda: simple_recommend.similarity_matrix(prefers), len(prefers))
+    users = _sample_users(prefers.keys(), n_recommend, seed)
+    measure(records, model, n_ratings, "recommend",
+            lambda: [simple_recommend.top_matches(prefers, user, 10) for user in users], len(users))
+    measure(records, model, n_ratings, "evaluate",
+            lambda: [simple_recommend.top_matches(prefers, user, 10, sim_matrix=sim_matrix) for user in prefers],
+            len(prefers))
+
+
+def _git_revision():
+    """
+    当前的git提交，不在git仓库中时返回None。
+    :return:
+    """
+    try:
+        output = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=com_config.PROJECT_DIR,
+                                         stderr=subprocess.STDOUT)
+        return output.decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, models=DEFAULT_MODELS, n_recommend=100, seed=0,
+                   data_dir=DEFAULT_DATA_DIR, ignore_limits=False):
+    """
+    运行所有的基准测试。
+    :param sizes: 评分数列表
+    :param models: 模型列表
+    :param n_recommend: recommend阶段的用户数
+    :param seed: 随机种子
+    :param data_dir: 合成数据目录
+    :param ignore_limits: 是否忽略MODEL_LIMITS
+    :return: 可以序列化为JSON的结果
+    """
+    records = []
+    skipped = []
+    for n_ratings in sizes:
+        data_file = synthetic_data_file(n_ratings, seed, data_dir)
+        for model in models:
+            if not ignore_limits and n_ratings > MODEL_LIMITS.get(model, n_ratings):
+                skipped.append({"model": model, "n_ratings": n_ratings,
+                                "reason": "exceeds limit {0}".format(MODEL_LIMITS[model])})
+                continue
+            if model == "simple_recommend":
+                bench_simple(records, data_file, n_ratings, n_recommend, seed)
+            else:
+                bench_cf(records, model, data_file, n_ratings, n_recommend, seed)
+            gc.collect()
+    return {"created": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "git_revision": _git_revision(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "scipy": scipy.__version__,
+            "platform": platform.platform(),
+            "seed": seed,
+            "results": records,
+            "skipped": skipped}
+
+
+def test_benchmark():
+    """
+    在10万条评分上运行基准测试。
+    :return:
+    """
+    result = run_benchmarks(sizes=[10 ** 5])
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark recommend_system")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES), help="numbers of ratings")
+    parser.add_argument("--models", nargs="+", default=list(DEFAULT_MODELS), choices=DEFAULT_MODELS)
+    parser.add_argument("--n_recommend", type=int, default=100, help="users in the recommend stage")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data_dir", default=DEFAULT_DATA_DIR, help="directory of the synthetic data")
+    parser.add_argument("--output", default=None, help="json file, print to stdout when omitted")
+    parser.add_argument("--ignore_limits", action="store_true", help="run models above MODEL_LIMITS")
+    args = parser.parse_args()
+    # 模型的打印输出不能混入标准输出中的JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        benchmark = run_benchmarks(args.sizes, args.models, args.n_recommend, args.seed, args.data_dir,
+                                   args.ignore_limits)
+    if args.output is None:
+        print(json.dumps(benchmark, indent=2))
+    else:
+        with open(args.output, "w") as f:
+            json.dump(benchmark, f, indent=2)
@@ -0,0 +1,81 @@
+# -*- coding:utf-8 -*-
+
+# ==============================================================================
+# 推荐结果的LRU缓存。
+# 1. 用OrderedDict保存结果，命中时把条目移到末尾，超过容量时从头部淘汰最久未使用的条目；
+# 2. 键为(user, k, n_item, model_version)，重新计算相似度、重新划分数据或加入评分后模型版本加一并清空缓存，
+#    旧版本的结果不会再命中。加入评分也会改变以这些用户为邻居的其他用户的结果，因此不按用户删除；
+# 3. 所有操作都在同一个锁内完成，可以在多个线程中共用。
+# ==============================================================================
+import threading
+from collections import OrderedDict
+
+
+class RecommendCache(object):
+    def __init__(self, capacity=10000):
+        """
+        构造函数。
+        :param capacity: 最多缓存的结果个数
+        """
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """
+        查找缓存的结果。
+        :param key: (user, k, n_item, model_version)
+        :return: 缓存的结果，没有时返回None
+        """
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        缓存结果，超过容量时淘汰最久未使用的结果。
+        :param key: (user, k, n_item, model_version)
+        :param value: 推荐结果
+        :return:
+        """
+        if self.capacity <= 0:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """
+        删除所有缓存结果，统计数据保留。
+        :return:
+        """
+        with self.lock:
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+
+    def stats(self):
+        """
+        缓存的命中统计。
+        :return:
+        """
+        with self.lock:
+            total = self.hits + self.misses
+            return {"size": len(self.entries), "capacity": self.capacity,
+                    "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / float(total) if total else 0.0,
+                    "evictions": self.evictions, "invalidations": self.invalidations}
@@ -0,0 +1,155 @@
+# -*- coding:utf-8 -*-
+
+# ==============================================================================
+# MovieLens格式评分文件的列式读取。
+# u.data每一行为"user_id \t item_id \t rating \t timestamp"，id都是整数。
+# 按块读取文件，用numpy一次解析整块文本，结果保存为int32/int8的列数组，
+# 内存约为字符串元组列表的十分之一；超过内存的大文件可以用iter_rating_chunks流式处理。
+# ==============================================================================
+import numpy as np
+
+# 每行的列数
+N_COLUMNS = 4
+# 默认每次读取的字节数
+DEFAULT_CHUNK_BYTES = 16 * 1024 * 1024
+
+
+class RatingColumns(object):
+    def __init__(self, users, items, records):
+        """
+        构造函数。
+        :param users: int32的用户id数组
+        :param items: int32的物品id数组
+        :param records: int8的评分数组
+        """
+        self.users = users
+        self.items = items
+        self.records = records
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        """
+        按原来read_data的格式逐条生成(user_id, item_id, record)，id为字符串。
+        :return:
+        """
+        for user, item, record in zip(self.users.tolist(), self.items.tolist(), self.records.tolist()):
+            yield str(user), str(item), record
+
+    @staticmethod
+    def concatenate(chunks):
+        """
+        合并多个块。
+        :param chunks: RatingColumns列表
+        :return:
+        """
+        chunks = list(chunks)
+        if not chunks:
+            return RatingColumns(np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32),
+                                 np.empty(0, dtype=np.int8))
+        return RatingColumns(np.concatenate([c.users for c in chunks]),
+                             np.concatenate([c.items for c in chunks]),
+                             np.concatenate([c.records for c in chunks]))
+
+
+def parse_ratings(text):
+    """
+    解析一段完整行组成的文本。
+    :param text: 以空白分隔的文本，每行4列
+    :return: RatingColumns
+    """
+    values = np.fromstring(text, dtype=np.int64, sep=" ")
+    if len(values) % N_COLUMNS != 0:
+        raise ValueError("rating lines must have {0} columns".format(N_COLUMNS))
+    values = values.reshape(-1, N_COLUMNS)
+    return RatingColumns(values[:, 0].astype(np.int32), values[:, 1].astype(np.int32),
+                         values[:, 2].astype(np.int8))
+
+
+def iter_rating_chunks(file_path, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """
+    按块流式读取评分文件，每块在最后一个换行处截断，剩余部分留给下一块。
+    :param file_path: 评分文件路径
+    :param chunk_bytes: 每次读取的字节数
+    :return: RatingColumns的生成器
+    """
+    remainder = b""
+    with open(file_path, "rb") as f:
+        while True:
+            block = f.read(chunk_bytes)
+            if not block:
+                break
+            block = remainder + block
+            end = block.rfind(b"\n") + 1
+            if end == 0:
+                remainder = block
+                continue
+            remainder = block[end:]
+            yield parse_ratings(block[:end].decode("ascii"))
+    if remainder.strip():
+        yield parse_ratings(remainder.decode("ascii"))
+
+
+def load_ratings(file_path, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """
+    读取整个评分文件为列数组，解析时的临时内存不超过一个块。
+    :param file_path: 评分文件路径
+    :param chunk_bytes: 每次读取的字节数
+    :return: RatingColumns
+    """
+    return RatingColumns.concatenate(iter_rating_chunks(file_path, chunk_bytes))
+
+
+def _random_generator(seed):
+    """
+    创建随机数生成器，旧版本numpy没有np.random.Generator时使用RandomState。
+    :param seed: 随机种子
+    :return:
+    """
+    if hasattr(np.random, "default_rng"):
+        return np.random.default_rng(seed)
+    return np.random.RandomState(seed)
+
+
+def fold_assignments(n_ratings, n_folds, seed):
+    """
+    一次随机抽样为每条评分分配所在的折，同一个种子得到相同的划分。
+    :param n_ratings: 评分条数
+    :param n_folds: 折数
+    :param seed: 随机种子
+    :return: 取值为[0, n_folds)的数组，使用能容纳n_folds - 1的最小无符号整数类型
+    """
+    if n_folds < 1:
+        raise ValueError("n_folds must be positive, got {0}".format(n_folds))
+    # 折数不超过256时为uint8，与int8抽样得到的划分相同
+    dtype = np.min_scalar_type(n_folds - 1)
+    rng = _random_generator(seed)
+    if hasattr(rng, "integers"):
+        return rng.integers(0, n_folds, size=n_ratings, dtype=dtype)
+    return rng.randint(0, n_folds, size=n_ratings).astype(dtype)
+
+
+def split_mask(n_ratings, k, seed, n_folds):
+    """
+    训练集和测试集的划分，第k折为测试集。
+    :param n_ratings: 评分条数
+    :param k: 测试集所在的折
+    :param seed: 随机种子
+    :param n_folds: 折数
+    :return: 测试集的布尔掩码，取反即为训练集
+    """
+    return fold_assignments(n_ratings, n_folds, seed) == k
+
+
+def kfold_masks(n_ratings, n_folds, seed):
+    """
+    k折交叉验证，只抽样一次，依次生成每一折的测试集掩码，不复制评分数据。
+    :param n_ratings: 评分条数
+    :param n_folds: 折数
+    :param seed: 随机种子
+    :return: (k, 测试集布尔掩码)的生成器
+    """
+    folds = fold_assignments(n_ratings, n_folds, seed)
+    for k in range(n_folds):
+        yield k, folds == k
@@ -0,0 +1,99 @@
+# -*- coding:utf-8 -*-
+
+# ==============================================================================
+# 协同过滤模型在多个K值上的单遍评价。
+# 邻居数组在计算相似度时已经按最大的K排好序，K个邻居的得分等于前K列邻居贡献的前缀和：
+# score(K2) = score(K1) + 第[K1, K2)列邻居的得分，因此只需按K从小到大累加一遍，
+# 在每个K处取top N并累计召回率、准确率、覆盖率和流行度，不再为每个K重新排序和计算。
+# 物品流行度和测试矩阵来自模型的SplitMetrics，每个划分只统计一次。
+# 同时记录每个K的耗时和tracemalloc统计的峰值内存。
+# ==============================================================================
+import time
+import tracemalloc
+import numpy as np
+from recommend_system.cf_matrix import top_n
+
+
+def evaluate_multi_k(model, k_list=(5, 10, 20, 40, 80, 160), n_item=10, test=None, block_size=1024, metrics=None):
+    """
+    对UserBasedCF或ItemBasedCF在多个K值上做一次性评价。
+    模型需要已经计算好相似度，且保留的邻居个数不小于最大的K。
+    :param model: 提供rating_matrix、neighbor_matrix和partial_scores的协同过滤模型
+    :param k_list: K值列表
+    :param n_item: 每个用户推荐的物品个数
+    :param test: 测试集，默认为模型的test_data
+    :param block_size: 每次计算的用户数
+    :param metrics: 当前划分的SplitMetrics，默认使用模型的split_metrics
+    :return: 每个K一行的结果列表，包括recall、precision、coverage、popularity、time和memory
+    """
+    k_list = sorted(k_list)
+    rm = model.rating_matrix
+    metrics = metrics or model.split_metrics(test)
+
+    hits = [0] * len(k_list)
+    rec_counts = [0] * len(k_list)
+    popularity_sums = [0.0] * len(k_list)
+    recommended = [np.zeros(rm.n_items, dtype=bool) for _ in k_list]
+    times = [0.0] * len(k_list)
+    peaks = [0] * len(k_list)
+
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        parts = []
+        for j, (prev_k, k) in enumerate(zip([0] + k_list[:-1], k_list)):
+            start_time = time.perf_counter()
+            parts.append(model.neighbor_matrix(prev_k, k))
+            times[j] += time.perf_counter() - start_time
+
+        for start in range(0, rm.n_users, block_size):
+            end = min(start + block_size, rm.n_users)
+            seen = rm.matrix[start:end].nonzero()
+            scores = np.zeros((end - start, rm.n_items), dtype=np.float64)
+            for j, part in enumerate(parts):
+                if hasattr(tracemalloc, "reset_peak"):
+                    tracemalloc.reset_peak()
+                start_time = time.perf_counter()
+                # 前缀和：在上一个K的得分上累加新增邻居的得分
+                scores += model.partial_scores(start, end, part).toarray()
+                scores[seen] = 0
+                recommendations = top_n(scores, n_item)
+                hits[j] += metrics.hits(recommendations, start)
+                popularity_sum, rec_count = metrics.popularity_sum(recommendations)
+                popularity_sums[j] += popularity_sum
+                rec_counts[j] += rec_count
+                recommended[j][recommendations[recommendations >= 0]] = True
+                times[j] += time.perf_counter() - start_time
+                peaks[j] = max(peaks[j], tracemalloc.get_traced_memory()[1])
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+
+    results = []
+    for j, k in enumerate(k_list):
+        results.append({
+            "k": k,
+            "recall": hits[j] / float(metrics.n_test) if metrics.n_test else 0.0,
+            "precision": hits[j] / (rm.n_users * n_item * 1.0) if rm.n_users else 0.0,
+            "coverage": recommended[j].sum() / (rm.n_items * 1.0) if rm.n_items else 0.0,
+            "popularity": popularity_sums[j] / rec_counts[j] if rec_counts[j] else 0.0,
+            "time": times[j],
+            "memory": peaks[j],
+        })
+    return results
+
+
+def format_evaluation(results):
+    """
+    将评价结果格式化为表格。
+    :param results: evaluate_multi_k的返回值
+    :return:
+    """
+    lines = ["{0: >3}{1: >20}{2: >20}{3: >20}{4: >20}{5: >20}{6: >20}"
+             .format('K', "recall", 'precision', 'coverage', 'popularity', 'time', 'peak memory')]
+    for row in results:
+        lines.append("{0: >3}{1: >19.3f}%{2: >19.3f}%{3: >19.3f}%{4: >20.3f}{5: >19.3f}s{6: >18.1f}MB".format(
+            row["k"], row["recall"] * 100, row["precision"] * 100, row["coverage"] * 100,
+            row["popularity"], row["time"], row["memory"] / 1024.0 / 1024.0))
+    return "\n".join(lines)
@@ -0,0 +1,506 @@
+# -*- coding:utf-8 -*-
+
+# ==============================================================================
+# 协同过滤的稀疏矩阵计算。
+# 将用户和物品编码为连续的整数id，构造scipy.sparse的CSR用户×物品评分矩阵，
+# 用稀疏矩阵乘法代替字典上的多重循环计算共现次数和余弦相似度：
+# 1. 用户共现矩阵 C = B * B^T，B为0/1形式的用户×物品矩阵，C[u][v]为用户u和v共同评价过的物品数；
+# 2. 物品共现矩阵 C = B^T * B，C[i][j]为同时评价过物品i和j的用户数；
+# 3. 余弦相似度 W[u][v] = C[u][v] / sqrt(N(u) * N(v))，N(u)为共现矩阵对角线上的值。
+# ==============================================================================
+import os
+import functools
+import itertools
+import operator
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import scipy.sparse as sp
+from util.os_util import OsUtil
+
+# 稠密矩阵乘法的计算量不超过稀疏矩阵乘法计算量的该倍数时，用稠密矩阵乘法计算共现矩阵
+DENSE_FLOP_RATIO = 512
+# 稠密矩阵乘法时输入矩阵和共现矩阵的最大元素个数
+MAX_DENSE_ENTRIES = 1 << 24
+
+class RatingMatrix(object):
+    def __init__(self, matrix, user_ids, item_ids, user_index=None, item_index=None):
+        """
+        构造函数。
+        :param matrix: CSR格式的用户×物品评分矩阵
+        :param user_ids: 用户原始id数组，下标即为用户的整数编码
+        :param item_ids: 物品原始id数组，下标即为物品的整数编码
+        :param user_index: 用户原始id到编码的映射，默认根据user_ids构造字典
+        :param item_index: 物品原始id到编码的映射，默认根据item_ids构造字典
+        """
+        self.matrix = matrix
+        self.user_ids = user_ids
+        self.item_ids = item_ids
+        if user_index is None:
+            user_index = dict((u, i) for i, u in enumerate(user_ids.tolist()))
+        if item_index is None:
+            item_index = dict((item, i) for i, item in enumerate(item_ids.tolist()))
+        self.user_index = user_index
+        self.item_index = item_index
+
+    @property
+    def n_users(self):
+        return self.matrix.shape[0]
+
+    @property
+    def n_items(self):
+        return self.matrix.shape[1]
+
+    @property
+    def binary(self):
+        """
+        0/1形式的用户×物品矩阵，表示用户是否评价过物品。
+        :return:
+        """
+        binary = self.matrix.copy()
+        binary.data = np.ones_like(binary.data, dtype=np.int32)
+        return binary
+
+    def add_ratings(self, batch):
+        """
+        在评分矩阵中加入一批评分，新出现的用户和物品追加在编码的末尾，已有的评分被覆盖。
+        :param batch: (user, item, record)的列表
+        :return: (n_users, n_items)的0/1矩阵，表示新增的用户-物品对
+        """
+        # 从文件加载的只读映射转换为字典后才能追加新的id
+        self.user_index = dict(self.user_index)
+        self.item_index = dict(self.item_index)
+        updates = dict()
+        new_users = []
+        new_items = []
+        for user, item, record in batch:
+            if user not in self.user_index:
+                self.user_index[user] = len(self.user_index)
+                new_users.append(user)
+            if item not in self.item_index:
+                self.item_index[item] = len(self.item_index)
+                new_items.append(item)
+            updates[(self.user_index[user], self.item_index[item])] = record
+        if new_users:
+            self.user_ids = np.concatenate((self.user_ids, np.array(new_users)))
+        if new_items:
+            self.item_ids = np.concatenate((self.item_ids, np.array(new_items)))
+        shape = (len(self.user_ids), len(self.item_ids))
+
+        rows = np.array([u for u, _ in updates], dtype=np.int32)
+        cols = np.array([i for _, i in updates], dtype=np.int32)
+        records = np.array(list(updates.values()), dtype=np.float32)
+        positions = sp.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)), shape=shape)
+        old = resize(self.matrix, shape)
+        old_records = old.multiply(positions).tocsr()
+        old_records.eliminate_zeros()
+        self.matrix = (old - old_records + sp.csr_matrix((records, (rows, cols)), shape=shape)).tocsr()
+        self.matrix.sort_indices()
+
+        old_records.data[:] = 1
+        delta = (positions - old_records).tocsr()
+        delta.eliminate_zeros()
+        return sp.csr_matrix(delta, dtype=np.int32)
+
+    def save(self, path):
+        """
+        把评分矩阵和id编码保存为目录下的.npy文件，另外保存排好序的id，加载时不需要重建字典。
+        :param path: 目录
+        :return:
+        """
+        user_order = np.argsort(self.user_ids, kind="mergesort")
+        item_order = np.argsort(self.item_ids, kind="mergesort")
+        save_arrays(path, user_ids=self.user_ids, item_ids=self.item_ids,
+                    user_order=user_order, sorted_user_ids=self.user_ids[user_order],
+                    item_order=item_order, sorted_item_ids=self.item_ids[item_order],
+                    rating_data=self.matrix.data, rating_indices=self.matrix.indices,
+                    rating_indptr=self.matrix.indptr)
+
+    @staticmethod
+    def load(path, mmap=True):
+        """
+        从save保存的目录加载评分矩阵。
+        :param path: 目录
+        :param mmap: 是否以只读内存映射的方式加载，多个进程可以共享同一份文件页
+        :return:
+        """
+        arrays = load_arrays(path, ["user_ids", "item_ids", "user_order", "sorted_user_ids", "item_order",
+                                    "sorted_item_ids", "rating_data", "rating_indices", "rating_indptr"], mmap)
+        shape = (len(arrays["user_ids"]), len(arrays["item_ids"]))
+        matrix = sp.csr_matrix((arrays["rating_data"], arrays["rating_indices"], arrays["rating_indptr"]),
+                               shape=shape)
+        return RatingMatrix(matrix, arrays["user_ids"], arrays["item_ids"],
+                            SortedIdIndex(arrays["sorted_user_ids"], arrays["user_order"]),
+                            SortedIdIndex(arrays["sorted_item_ids"], arrays["item_order"]))
+
+    @staticmethod
+    def from_dict(train):
+        """
+        根据{user: {item: record}}格式的训练集构造评分矩阵。
+        :param train: 训练集
+        :return:
+        """
+        user_ids = np.array(list(train.keys()))
+        # 展开和编码都在map、chain等内置函数中完成，避免逐条评分执行python语句
+        items = list(itertools.chain.from_iterable(train.values()))
+        item_index = dict(zip(dict.fromkeys(items), itertools.count()))
+        cols = np.fromiter(map(item_index.__getitem__, items), dtype=np.int32, count=len(items))
+        records = np.fromiter(itertools.chain.from_iterable(ratings.values() for ratings in train.values()),
+                              dtype=np.float32, count=len(cols))
+        indptr = np.zeros(len(user_ids) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter(map(len, train.values()), dtype=np.int64, count=len(user_ids)), out=indptr[1:])
+        item_ids = np.array(list(item_index))
+        matrix = sp.csr_matrix((records, cols, indptr), shape=(len(user_ids), len(item_ids)))
+        matrix.sort_indices()
+        return RatingMatrix(matrix, user_ids, item_ids)
+
+
+class SortedIdIndex(Mapping):
+    def __init__(self, sorted_ids, order):
+        """
+        基于排序数组的只读id映射，用二分查找代替字典，适合内存映射的id数组。
+        :param sorted_ids: 排好序的原始id数组
+        :param order: sorted_ids中每个id的编码
+        """
+        self.sorted_ids = sorted_ids
+        self.order = order
+
+    def __getitem__(self, key):
+        try:
+            position = np.searchsorted(self.sorted_ids, key)
+        except TypeError:
+            raise KeyError(key)
+        if position < len(self.order) and self.sorted_ids[position] == key:
+            return int(self.order[position])
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self.sorted_ids.tolist())
+
+    def __len__(self):
+        return len(self.sorted_ids)
+
+
+def save_arrays(path, **arrays):
+    """
+    把数组分别保存为目录下的.npy文件。
+    :param path: 目录
+    :param arrays: 文件名到数组的映射
+    :return:
+    """
+    OsUtil.makedirs(path)
+    for name, array in arrays.items():
+        np.save(os.path.join(path, name + ".npy"), np.asarray(array))
+
+
+def load_arrays(path, names, mmap=True):
+    """
+    加载目录下的.npy文件。
+    :param path: 目录
+    :param names: 文件名列表
+    :param mmap: 是否以只读内存映射的方式加载
+    :return: 文件名到数组的字典
+    """
+    mmap_mode = "r" if mmap else None
+    return dict((name, np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)) for name in names)
+
+
+def top_n_dict(rank, seen, item_ids, n_item, min_score=0):
+    """
+    从单个用户的得分向量中取得分最高的n_item个物品。
+    :param rank: 长度为n_items的浮点得分向量
+    :param seen: 用户已经评价过的物品编码，不推荐
+    :param item_ids: 物品原始id数组
+    :param n_item: 推荐物品个数
+    :param min_score: 得分不大于min_score的物品不推荐，协同过滤中得分为0表示没有相似的邻居；
+    为None时对所有未评价的物品排序（例如得分可以为负的矩阵分解）
+    :return: {item: score}，按得分从大到小排列
+    """
+    rank[seen] = -np.inf
+    candidates = np.flatnonzero(rank > (-np.inf if min_score is None else min_score))
+    if len(candidates) > n_item:
+        candidates = candidates[np.argpartition(-rank[candidates], n_item - 1)[:n_item]]
+    candidates = candidates[np.argsort(-rank[candidates], kind="mergesort")]
+    return dict(zip(item_ids[candidates].tolist(), rank[candidates].tolist()))
+
+
+def cooccurrence(binary, n_jobs=1):
+    """
+    计算行之间的共现矩阵 binary * binary^T，对角线为每一行的非零元素个数。
+    计算物品共现时传入binary的转置即可。
+    共现矩阵可以按列拆分求和：binary * binary^T = sum(binary[:, s] * binary[:, s]^T)，
+    n_jobs大于1时把列划分为多个分片，在多个进程中分别计算部分共现矩阵后相加。
+    共现矩阵接近稠密且不超过MAX_DENSE_ENTRIES时改用稠密矩阵乘法，此时不使用多进程。
+    :param binary: 0/1形式的CSR矩阵
+    :param n_jobs: 进程数，-1表示使用所有CPU
+    :return:
+    """
+    binary = sp.csr_matrix(binary, dtype=np.int32)
+    if _prefer_dense(binary):
+        return _dense_cooccurrence(binary)
+    if n_jobs == -1:
+        n_jobs = os.cpu_count() or 1
+    # 列数少于分片数（包括没有列）时不划分分片
+    if n_jobs is None or n_jobs <= 1 or binary.shape[1] < n_jobs * 4:
+        return _partial_cooccurrence(binary)
+
+    shards = _column_shards(binary.tocsc(), n_jobs * 4)
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        partials = executor.map(_partial_cooccurrence, shards)
+        return functools.reduce(operator.add, partials).tocsr()
+
+
+def _prefer_dense(binary):
+    """
+    共现矩阵接近稠密时，BLAS的稠密矩阵乘法比稀疏矩阵乘法快得多。
+    稀疏矩阵乘法的计算量为每一列非零元素个数的平方和，稠密矩阵乘法为n * n * m。
+    :param binary: 0/1形式的CSR矩阵
+    :return: 是否用稠密矩阵乘法
+    """
+    n, m = binary.shape
+    if n * n > MAX_DENSE_ENTRIES or n * m > MAX_DENSE_ENTRIES:
+        return False
+    sparse_flops = (np.bincount(binary.indices, minlength=m).astype(np.float64) ** 2).sum()
+    return n * n * m <= DENSE_FLOP_RATIO * sparse_flops
+
+
+def _dense_cooccurrence(binary):
+    """
+    用稠密矩阵乘法计算共现矩阵，只保存非零元素。
+    共现次数不超过列数，在MAX_DENSE_ENTRIES以内可以用float32精确表示。
+    :param binary: 0/1形式的CSR矩阵
+    :return:
+    """
+    dense = binary.astype(np.float32).toarray()
+    product = np.dot(dense, dense.T).ravel()
+    n = binary.shape[0]
+    flat = np.flatnonzero(product)
+    indptr = np.searchsorted(flat, np.arange(n + 1) * n)
+    return sp.csr_matrix((product[flat].astype(np.int32), (flat % n).astype(np.int32), indptr), shape=(n, n))
+
+
+def _partial_cooccurrence(shard):
+    """
+    计算一个分片的共现矩阵。
+    :param shard: 0/1形式的CSR矩阵
+    :return:
+    """
+    return (shard * shard.T).tocsr()
+
+
+def _column_shards(binary, n_shards):
+    """
+    按计算量把矩阵的列划分为连续的分片，每一列的计算量约为非零元素个数的平方。
+    :param binary: CSC矩阵
+    :param n_shards: 分片个数
+    :return: CSR格式的分片列表
+    """
+    costs = np.cumsum(np.diff(binary.indptr).astype(np.float64) ** 2)
+    bounds = np.searchsorted(costs, np.linspace(0, costs[-1], n_shards + 1)[1:-1])
+    bounds = np.unique(np.concatenate(([0], bounds, [binary.shape[1]])))
+    return [binary[:, start:end].tocsr() for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def cosine_similarity(cooc, rows=None):
+    """
+    根据共现矩阵计算余弦相似度，去掉对角线上的自身相似度。
+    :param cooc: 共现矩阵
+    :param rows: 只计算指定的行，默认计算所有行
+    :return: CSR格式的相似度矩阵，指定rows时只包含这些行
+    """
+    counts = cooc.diagonal().astype(np.float64)
+    if rows is not None:
+        cooc = cooc[rows]
+    local_rows = np.repeat(np.arange(cooc.shape[0]), np.diff(cooc.indptr))
+    global_rows = local_rows if rows is None else rows[local_rows]
+    # 去掉对角线元素后，每一行的起始位置减去之前各行去掉的元素个数
+    diagonal = np.flatnonzero(global_rows == cooc.indices)
+    off_diag = np.ones(len(cooc.indices), dtype=bool)
+    off_diag[diagonal] = False
+    cols = cooc.indices[off_diag]
+    norm = counts[global_rows[off_diag]]
+    # 原地计算分母，减少临时数组
+    norm *= counts[cols]
+    np.sqrt(norm, out=norm)
+    data = np.divide(cooc.data[off_diag], norm, out=norm)
+    removed = np.bincount(local_rows[diagonal], minlength=cooc.shape[0])
+    indptr = cooc.indptr - np.concatenate(([0], np.cumsum(removed)))
+    sim = sp.csr_matrix((data, cols, indptr), shape=cooc.shape)
+    return sim
+
+
+def resize(matrix, shape):
+    """
+    在右侧和下方补零，把CSR矩阵扩展到新的形状。
+    :param matrix: CSR矩阵
+    :param shape: 新的形状，不小于原来的形状
+    :return:
+    """
+    indptr = np.concatenate((matrix.indptr, np.repeat(matrix.indptr[-1], shape[0] - matrix.shape[0])))
+    return sp.csr_matrix((matrix.data, matrix.indices, indptr), shape=shape)
+
+
+def update_cooccurrence(cooc, binary, delta):
+    """
+    增量更新共现矩阵 X^T * X。X由binary增加delta后，
+    新的共现矩阵为 C + D^T * X + X^T * D + D^T * D，只涉及新增评分所在的行。
+    :param cooc: 原共现矩阵
+    :param binary: 增加前的0/1矩阵X，形状已扩展到与delta相同
+    :param delta: 新增的0/1矩阵D
+    :return: 新的共现矩阵，以及共现次数发生变化的行
+    """
+    n = delta.shape[1]
+    delta = sp.csr_matrix(delta, dtype=np.int32)
+    binary = sp.csr_matrix(binary, dtype=np.int32)
+    cross = delta.T * binary
+    change = (cross + cross.T + delta.T * delta).tocsr()
+    cooc = (resize(sp.csr_matrix(cooc), (n, n)) + change).tocsr()
+    changed = np.flatnonzero(np.diff(change.indptr))
+    return cooc, changed
+
+
+def affected_rows(cooc, changed):
+    """
+    计数变化的对象会影响所有与其共现的对象的相似度，返回需要重新归一化的行。
+    :param cooc: 共现矩阵
+    :param changed: 共现次数发生变化的行
+    :return:
+    """
+    return np.union1d(changed, cooc[changed].indices).astype(np.int64)
+
+
+def replace_rows(matrix, rows, new_rows):
+    """
+    用new_rows替换CSR矩阵中的指定行。
+    :param matrix: CSR矩阵
+    :param rows: 被替换的行号
+    :param new_rows: 新的行，行数与rows相同
+    :return:
+    """
+    n = matrix.shape[0]
+    keep = np.setdiff1d(np.arange(n), rows)
+    keep_selector = sp.csr_matrix((np.ones(len(keep)), (keep, np.arange(len(keep)))), shape=(n, len(keep)))
+    new_selector = sp.csr_matrix((np.ones(len(rows)), (rows, np.arange(len(rows)))), shape=(n, len(rows)))
+    return (keep_selector * matrix[keep] + new_selector * new_rows).tocsr()
+
+
+class SimilarityRows(Mapping):
+    def __init__(self, sim, ids, index):
+        """
+        以{id: {id: similarity}}字典的形式只读访问相似度矩阵，每一行在访问时才转换为字典，
+        避免为所有的相似对构造嵌套字典。没有相似对象的行不出现在映射中。
+        :param sim: CSR格式的相似度矩阵
+        :param ids: 原始id数组
+        :param index: 原始id到整数编码的字典
+        """
+        self.sim = sim
+        self.ids = ids
+        self.index = index
+        self.rows = np.flatnonzero(np.diff(sim.indptr))
+
+    def __getitem__(self, key):
+        row = self.index.get(key)
+        if row is None:
+            raise KeyError(key)
+        start, end = self.sim.indptr[row], self.sim.indptr[row + 1]
+        if start == end:
+            raise KeyError(key)
+        return dict(zip(self.ids[self.sim.indices[start:end]].tolist(),
+                        self.sim.data[start:end].tolist()))
+
+    def __iter__(self):
+        return iter(self.ids[self.rows].tolist())
+
+    def __len__(self):
+        return len(self.rows)
+
+
+def top_k_neighbors(sim, k):
+    """
+    取相似度矩阵每一行中最相似的k个邻居，按相似度从大到小排列，相似度相同时按编码从小到大排列。
+    邻居不足k个的行用-1填充邻居编码、用0填充相似度。
+    :param sim: CSR格式的相似度矩阵
+    :param k: 邻居个数
+    :return: (n, k)的邻居编码数组和(n, k)的相似度数组
+    """
+    n = sim.shape[0]
+    neighbors = np.full((n, k), -1, dtype=np.int32)
+    scores = np.zeros((n, k), dtype=np.float32)
+    for row in range(n):
+        start, end = sim.indptr[row], sim.indptr[row + 1]
+        data = sim.data[start:end]
+        indices = sim.indices[start:end]
+        if end - start > k:
+            # partition是线性时间，只保留前k个和与第k个相似度相同的候选再排序，保证并列时结果确定
+            threshold = -np.partition(-data, k - 1)[k - 1]
+            candidates = np.flatnonzero(data >= threshold)
+            data = data[candidates]
+            indices = indices[candidates]
+        order = np.lexsort((indices, -data))[:k]
+        neighbors[row, :len(order)] = indices[order]
+        scores[row, :len(order)] = data[order]
+    return neighbors, scores
+
+
+def neighbor_matrix(neighbors, scores, start, end):
+    """
+    将邻居数组的第[start, end)列转换为稀疏矩阵，M[i][j]为i的邻居j的相似度。
+    :param neighbors: (n, top_k)的邻居编码数组
+    :param scores: (n, top_k)的相似度数组
+    :param start: 起始列
+    :param end: 结束列
+    :return: (n, n)的CSR矩阵
+    """
+    if end > neighbors.shape[1]:
+        raise ValueError("only {0} neighbors were kept, got end={1}".format(neighbors.shape[1], end))
+    n = neighbors.shape[0]
+    cols = neighbors[:, start:end]
+    valid = cols >= 0
+    rows = np.repeat(np.arange(n), valid.sum(axis=1))
+    return sp.csr_matrix((scores[:, start:end][valid], (rows, cols[valid])), shape=(n, n))
+
+
+def top_n(scores, n_item, min_score=0):
+    """
+    按行取得分最高的n_item个物品，得分不大于min_score的物品不推荐，不足n_item个时用-1填充。
+    :param scores: (n_users, n_items)的稠密得分矩阵，已评价过的物品得分需置为0或-inf
+    :param n_item: 推荐物品个数
+    :param min_score: 得分的下限（不含），为None时只排除得分为-inf的物品
+    :return: (n_users, n_item)的物品编码数组，每行按得分从大到小排列
+    """
+    n_rows, n_cols = scores.shape
+    result = np.full((n_rows, n_item), -1, dtype=np.int32)
+    if n_cols > n_item:
+        candidates = np.argpartition(-scores, n_item - 1, axis=1)[:, :n_item]
+    else:
+        candidates = np.tile(np.arange(n_cols), (n_rows, 1))
+    row_index = np.arange(n_rows)[:, np.newaxis]
+    candidate_scores = scores[row_index, candidates]
+    order = np.argsort(-candidate_scores, axis=1, kind="mergesort")
+    candidates = candidates[row_index, order]
+    valid = candidate_scores[row_index, order] > (-np.inf if min_score is None else min_score)
+    result[:, :candidates.shape[1]][valid] = candidates[valid]
+    return result
+
+
+def update_top_k_neighbors(neighbors, scores, rows, sim_rows):
+    """
+    重新计算指定行的top k邻居，新增的行先用-1和0填充。
+    load_arrays(mmap=True)加载的只读数组先复制再修改，不改动已保存的文件。
+    :param neighbors: (n, top_k)的邻居编码数组
+    :param scores: (n, top_k)的相似度数组
+    :param rows: 需要重新计算的行
+    :param sim_rows: 这些行更新后的相似度，CSR矩阵，列数为新的对象个数
+    :return: 更新后的邻居编码数组和相似度数组
+    """
+    n, k = sim_rows.shape[1], neighbors.shape[1]
+    if n > neighbors.shape[0]:
+        extra = n - neighbors.shape[0]
+        neighbors = np.vstack((neighbors, np.full((extra, k), -1, dtype=neighbors.dtype)))
+        scores = np.vstack((scores, np.zeros((extra, k), dtype=scores.dtype)))
+    if not neighbors.flags.writeable:
+        neighbors = np.array(neighbors)
+    if not scores.flags.writeable:
+        scores = np.array(scores)
+    neighbors[rows], scores[rows] = top_k_neighbors(sim_rows, k)
+    return neighbors, scores
@@ -0,0 +1,117 @@
+# -*- coding:utf-8 -*-
+
+# ==============================================================================
+# 推荐结果的评价指标。
+# 每个训练集/测试集划分只做一次O(评分数)的统计：物品流行度、取对数后的流行度、物品总数，
+# 以及按评分矩阵编码后的0/1测试矩阵和每个用户的测试物品数，都保存为按物品编码索引的numpy数组。
+# 之后每个指标都是在(n_users, n_item)推荐矩阵上的一次向量化归约，不同的K共用这些统计。
+# 推荐矩阵中的-1表示该位置没有推荐物品，不参与计算。
+# ==============================================================================
+import numpy as np
+import scipy.sparse as sp
+
+
+def encode_test_data(test, rating_matrix):
+    """
+    将{user: {item: record}}格式的测试集按评分矩阵的编码转换为0/1矩阵，
+    训练集中没有出现过的物品不可能被推荐，因此不进入矩阵，但计入每个用户的测试物品数。
+    :param test: 测试集
+    :param rating_matrix: 训练集的评分矩阵
+    :return: (n_users, n_items)的CSR测试矩阵和每个训练用户的测试物品数
+    """
+    rows = []
+    cols = []
+    counts = np.zeros(rating_matrix.n_users, dtype=np.int64)
+    for user, items in test.items():
+        u = rating_matrix.user_index.get(user)
+        if u is None:
+            continue
+        counts[u] = len(items)
+        for item in items:
+            i = rating_matrix.item_index.get(item)
+            if i is not None:
+                rows.append(u)
+                cols.append(i)
+    matrix = sp.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)),
+                           shape=(rating_matrix.n_users, rating_matrix.n_items))
+    return matrix, counts
+
+
+def hit_count(recommendations, test_matrix):
+    """
+    统计推荐结果中命中测试集的物品数。
+    :param recommendations: (n_users, n_item)的推荐物品编码数组
+    :param test_matrix: 0/1测试矩阵
+    :return:
+    """
+    rows, cols = np.nonzero(recommendations >= 0)
+    if len(rows) == 0:
+        return 0
+    return int(np.asarray(test_matrix[rows, recommendations[rows, cols]]).sum())
+
+
+class SplitMetrics(object):
+    def __init__(self, rating_matrix, test):
+        """
+        构造函数，统计训练集和测试集。
+        :param rating_matrix: 训练集的评分矩阵
+        :param test: {user: {item: record}}格式的测试集
+        """
+        self.rating_matrix = rating_matrix
+        self.test = test
+        # 物品总数即可能被推荐的物品全集
+        self.n_items = rating_matrix.n_items
+        self.n_users = rating_matrix.n_users
+        self.item_popularity = np.bincount(rating_matrix.matrix.indices, minlength=self.n_items)
+        self.log_popularity = np.log1p(self.item_popularity)
+        self.test_matrix, self.test_counts = encode_test_data(test, rating_matrix)
+        self.n_test = int(self.test_counts.sum())
+
+    def hits(self, recommendations, start=0):
+        """
+        推荐结果中命中测试集的物品数。
+        :param recommendations: 第[start, start + len(recommendations))个用户的推荐物品编码数组
+        :param start: 起始用户编码，分块计算时使用
+        :return:
+        """
+        return hit_count(recommendations, self.test_matrix[start:start + len(recommendations)])
+
+    def recall_and_precision(self, recommendations):
+        """
+        召回率和准确率。
+        :param recommendations: 所有用户的推荐物品编码数组
+        :return:
+        """
+        hit = self.hits(recommendations)
+        n_recommended = self.n_users * recommendations.shape[1]
+        recall = hit / float(self.n_test) if self.n_test else 0.0
+        precision = hit / (n_recommended * 1.0) if n_recommended else 0.0
+        return recall, precision
+
+    def coverage(self, recommendations):
+        """
+        覆盖率，推荐过的物品占物品全集的比例。
+        :param recommendations:
+        :return:
+        """
+        recommended = np.zeros(self.n_items, dtype=bool)
+        recommended[recommendations[recommendations >= 0]] = True
+        return float(recommended.sum()) / self.n_items if self.n_items else 0.0
+
+    def popularity_sum(self, recommendations):
+        """
+        推荐物品取对数后的流行度之和以及推荐物品个数，分块计算时分别累加。
+        :param recommendations:
+        :return:
+        """
+        valid = recommendations[recommendations >= 0]
+        return float(self.log_popularity[valid].sum()), len(valid)
+
+    def popularity(self, recommendations):
+        """
+        平均流行度。
+        :param recommendations:
+        :return:
+        """
+        total, count = self.popularity_sum(recommendations)
+        return total / count if count else 0.0
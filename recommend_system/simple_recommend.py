@@ -2,8 +2,13 @@
 
 # ==============================================================================
 # 最简单的推荐系统的示例。
+# 除了逐对计算的sim_distance和sim_pearson，还可以用similarity_matrix一次计算所有用户两两之间的相似度：
+# 把偏好数据转换为用户×物品的评分矩阵X和是否评分的掩码矩阵M，只在共同评分的物品上求和，
+# 例如共同评分的物品数为 M * M^T，person1在共同评分物品上的评分和为 X * M^T，
+# 评分乘积的和为 X * X^T，代入皮尔逊相关系数和欧几里得距离的公式即可得到整个相似度矩阵。
 # ==============================================================================
 from math import sqrt
+import numpy as np
 from util.log_util import LoggerUtil
 
 # 日志器
@@ -81,18 +86,126 @@ def sim_pearson(prefers, person1, person2):
     return result
 
 
-def top_matches(prefers, person, n, similarity=sim_pearson):
+def prefers_to_matrix(prefers):
+    """
+    将偏好数据转换为稠密的评分矩阵和掩码矩阵。
+    :param prefers: 用户偏好数据
+    :return: 用户列表、物品列表、评分矩阵、掩码矩阵，未评分的位置评分为0
+    """
+    persons = list(prefers.keys())
+    items = sorted(set(item for person in persons for item in prefers[person]))
+    item_index = dict((item, i) for i, item in enumerate(items))
+    values = np.zeros((len(persons), len(items)))
+    for p, person in enumerate(persons):
+        for item, score in prefers[person].items():
+            values[p, item_index[item]] = score
+    mask = np.zeros(values.shape)
+    for p, person in enumerate(persons):
+        mask[p, [item_index[item] for item in prefers[person]]] = 1
+    return persons, items, values, mask
+
+
+def _person_columns(prefers, person):
+    """
+    只在person评分过的物品上构造所有用户的评分矩阵和掩码矩阵。
+    相似度只用到共同评分的物品，因此person一行的相似度与在完整矩阵上计算的结果相同。
+    :param prefers: 用户偏好数据
+    :param person: 用户
+    :return: 用户列表、person的下标、(n_persons, person的物品数)的评分矩阵和掩码矩阵
+    """
+    persons = list(prefers.keys())
+    items = list(prefers[person].keys())
+    values = np.zeros((len(persons), len(items)))
+    mask = np.zeros(values.shape)
+    for p, other in enumerate(persons):
+        other_prefers = prefers[other]
+        for i, item in enumerate(items):
+            if item in other_prefers:
+                values[p, i] = other_prefers[item]
+                mask[p, i] = 1
+    return persons, persons.index(person), values, mask
+
+
+def _similarity_rows(values, mask, rows, similarity):
+    """
+    计算指定用户与所有用户之间的相似度，只使用两人共同评分的物品，结果与逐对计算相同。
+    :param values: 评分矩阵
+    :param mask: 掩码矩阵
+    :param rows: 用户下标
+    :param similarity: sim_pearson或sim_distance
+    :return: (len(rows), n_persons)的相似度矩阵
+    """
+    row_values = values[rows]
+    row_mask = mask[rows]
+    n = row_mask.dot(mask.T)
+    p_sum = row_values.dot(values.T)
+    sum1_sq = (row_values ** 2).dot(mask.T)
+    sum2_sq = row_mask.dot((values ** 2).T)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if similarity is sim_distance:
+            sum_of_squares = np.maximum(sum1_sq + sum2_sq - 2 * p_sum, 0)
+            return np.where(n == 0, 0, 1 / (1 + np.sqrt(sum_of_squares)))
+
+        sum1 = row_values.dot(mask.T)
+        sum2 = row_mask.dot(values.T)
+        num = p_sum - sum1 * sum2 / n
+        den = np.sqrt(np.maximum((sum1_sq - sum1 ** 2 / n) * (sum2_sq - sum2 ** 2 / n), 0))
+        result = np.where(den == 0, 0, num / den)
+        return np.where(n == 0, 1, result)
+
+
+def similarity_matrix(prefers, similarity=sim_pearson, block_size=1024):
+    """
+    一次计算所有用户两两之间的相似度矩阵。
+    :param prefers: 用户偏好数据
+    :param similarity: sim_pearson或sim_distance
+    :param block_size: 每次计算的用户数，中间结果的内存与block_size * n_persons成正比
+    :return: 用户列表和(n_persons, n_persons)的相似度矩阵
+    """
+    if similarity not in (sim_pearson, sim_distance):
+        raise ValueError("similarity must be sim_pearson or sim_distance")
+    persons, _, values, mask = prefers_to_matrix(prefers)
+    result = np.empty((len(persons), len(persons)))
+    for start in range(0, len(persons), block_size):
+        rows = np.arange(start, min(start + block_size, len(persons)))
+        result[rows] = _similarity_rows(values, mask, rows, similarity)
+    return persons, result
+
+
+def top_matches(prefers, person, n, similarity=sim_pearson, sim_matrix=None):
     """
     计算相似度最高的top N。
+    sim_pearson和sim_distance使用向量化的方式只计算person所在的一行，只使用person评分过的物品，
+    传入similarity_matrix的结果时直接从相似度矩阵中选取。
     :param prefers:
     :param person:
     :param n:
     :param similarity:
+    :param sim_matrix: similarity_matrix返回的(用户列表, 相似度矩阵)
     :return:
     """
-    scores = [(similarity(prefers, person, other), other)
-              for other in prefers if other != person]
-    # sort the similarity
+    if sim_matrix is None and similarity not in (sim_pearson, sim_distance):
+        scores = [(similarity(prefers, person, other), other)
+                  for other in prefers if other != person]
+        # sort the similarity
+        scores.sort()
+        scores.reverse()
+        return scores[0:n]
+
+    if sim_matrix is None:
+        persons, row, values, mask = _person_columns(prefers, person)
+        sims = _similarity_rows(values, mask, [row], similarity)[0]
+    else:
+        persons, matrix = sim_matrix
+        row = persons.index(person)
+        sims = matrix[row]
+    others = np.array([i for i in range(len(persons)) if i != row], dtype=np.int64)
+    others_sims = sims[others]
+    if 0 < n < len(others):
+        # 与第n大的相似度相同的用户都保留，排序规则与逐对计算时相同
+        threshold = others_sims[np.argpartition(-others_sims, n - 1)[n - 1]]
+        others = others[others_sims >= threshold]
+    scores = [(float(sims[i]), persons[i]) for i in others]
     scores.sort()
     scores.reverse()
     return scores[0:n]
@@ -113,6 +226,18 @@ def test_sim_person_distance():
     common_logger.info("pearson:{0}".format(top_leo2))
 
 
+def test_similarity_matrix():
+    """
+    测试一次计算所有用户的相似度矩阵。
+    :return:
+    """
+    for similarity in (sim_pearson, sim_distance):
+        persons, matrix = similarity_matrix(critics, similarity=similarity)
+        common_logger.info("persons:{0}\n{1}".format(persons, matrix))
+        top_leo = top_matches(critics, "Leo", 5, sim_matrix=(persons, matrix))
+        common_logger.info("top matches:{0}".format(top_leo))
+
+
 if __name__ == '__main__':
     test_sim_person_distance()
     pass
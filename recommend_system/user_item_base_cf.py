@@ -14,11 +14,18 @@
 # 如果推荐出的物品都很热门，说明推荐的新颖度较低，否则说明推荐结果比较新颖。
 # 在计算平均流行度时对每个物品发流行度取对数，这是因为物品的流行度分布满足长尾分布，在取对数后，流行度的平均值更加稳定。
 # ==============================================================================
-import random
 import math
-import time
+import numpy as np
 import os
 import config.common_config as com_config
+from recommend_system.cf_ann import RandomProjectionLSH, normalized_binary_rows, benchmark_ann
+from recommend_system.cf_cache import RecommendCache
+from recommend_system.cf_data import load_ratings, split_mask, kfold_masks
+from recommend_system.cf_evaluation import evaluate_multi_k, format_evaluation
+from recommend_system.cf_matrix import RatingMatrix, cooccurrence, cosine_similarity, SimilarityRows, \
+    top_k_neighbors, neighbor_matrix, top_n, resize, update_cooccurrence, affected_rows, replace_rows, \
+    update_top_k_neighbors, top_n_dict, save_arrays, load_arrays
+from recommend_system.cf_metrics import SplitMetrics
 from util.log_util import LoggerUtil
 
 # 日志器
@@ -31,11 +38,49 @@ ml_100k_dir_path = os.path.join(com_config.RESOURCE_DIR, "ml-100k")
 data_file_path = os.path.join(ml_100k_dir_path, data_file_name)
 
 
+def _per_user_metrics(model, train, test, k, n_item):
+    """
+    逐个用户调用recommend计算召回率、准确率、覆盖率和流行度。
+    用于传入了其他训练集，或者没有邻居数组（python方式计算相似度）、不能使用recommend_all的情况。
+    :param model: UserBasedCF或ItemBasedCF
+    :param train: 训练集
+    :param test: 测试集
+    :param k:
+    :param n_item:
+    :return: 指标字典
+    """
+    item_popularity = dict()
+    for items in train.values():
+        for item in items.keys():
+            item_popularity.setdefault(item, 0)
+            item_popularity[item] += 1
+    hit = 0
+    n_test = 0
+    n_recommended = 0
+    popularity = 0.0
+    recommend_items = set()
+    for user in train.keys():
+        tu = test.get(user, {})
+        rank = model.recommend(user, train=train, k=k, n_item=n_item)
+        for item in rank.keys():
+            if item in tu:
+                hit += 1
+            recommend_items.add(item)
+            popularity += math.log(1 + item_popularity.get(item, 0))
+        n_test += len(tu)
+        n_recommended += len(rank)
+    return {"recall": hit / (n_test * 1.0) if n_test else 0.0,
+            "precision": hit / (len(train) * n_item * 1.0) if train else 0.0,
+            "coverage": len(recommend_items) / (len(item_popularity) * 1.0) if item_popularity else 0.0,
+            "popularity": popularity / n_recommended if n_recommended else 0.0}
+
+
 class UserBasedCF:
-    def __init__(self, datafile=None):
+    def __init__(self, datafile=None, cache_size=10000):
         """
         构造函数及初始化。
         :param datafile:数据文件名称。
+        :param cache_size: recommend结果缓存的最大个数，0表示不缓存。
         """
         self.datafile = datafile
         self.data = None
@@ -45,21 +90,36 @@ class UserBasedCF:
         self.user_sim = None
         # 用户最大相似度
         self.user_sim_best = None
-
-        # 初始化数据
-        self.read_data()
-        self.split_data(3, 47)
+        # 编码后的评分矩阵和稀疏的用户相似度矩阵
+        self.rating_matrix = None
+        self.user_cooccurrence = None
+        self.user_sim_matrix = None
+        # 每个用户最相似的top_k个用户和对应的相似度
+        self.user_neighbors = None
+        self.user_neighbor_scores = None
+        # 最近一次recommend_all的结果，供各项评价指标共用
+        self.top_n_cache = None
+        # 当前划分的物品流行度和测试矩阵等统计
+        self.metrics_cache = None
+        # 查找相似用户的近似最近邻索引，评分变化后置为None，下次使用时按ann_params重新建立
+        self.ann_index = None
+        self.ann_params = None
+        # 模型的版本，每次重新计算相似度、重新划分数据或加入评分后加一，是recommend结果缓存键的一部分
+        self.model_version = 0
+        self.recommend_cache = RecommendCache(cache_size)
+
+        # 初始化数据，从save保存的目录加载模型时不需要数据文件
+        if self.datafile is not None:
+            self.read_data()
+            self.split_data(3, 47)
 
     def read_data(self, datafile=None):
         """
         read the data from the data file which is a data set.
-        把文件中的内容读到data中。
+        把文件中的内容读到data中。data为int32/int8的列数组，迭代时仍然得到(user_id, item_id, record)。
         """
         self.datafile = datafile or self.datafile
-        self.data = []
-        for line in open(self.datafile):
-            user_id, item_id, record, _ = line.split()
-            self.data.append((user_id, item_id, int(record)))
+        self.data = load_ratings(self.datafile)
 
     def split_data(self, k, seed, data=None, m=8):
         """
@@ -69,22 +129,47 @@ class UserBasedCF:
         test data set / train data set is 1:m-1
         拆分数据集为训练集和测试集。将用户行为数据集按照均匀分布
         随机分成M份，挑选一份作为测试集，剩下的m-1份作为训练集。
+        对整个数据集只做一次随机抽样得到测试集掩码，每条评分的取值范围与random.randint(0, m)相同。
         :param k: 随机数为k时，拆分到测试集中。
         :param seed: 随机种子
         :param data: 数据集
         :param m: 拆分比例，训练集和测试集的比例为m。
         """
+        self.data = data or self.data
+        self._split_by_mask(split_mask(len(self.data), k, seed, m + 1))
+
+    def split_folds(self, seed, data=None, m=8):
+        """
+        k折交叉验证，只抽样一次，依次把每一折作为测试集。
+        :param seed: 随机种子
+        :param data: 数据集
+        :param m: 折数为m + 1，与split_data的取值范围一致
+        :return: 当前折的生成器，每次生成时train_data和test_data已经更新
+        """
+        self.data = data or self.data
+        for k, test_mask in kfold_masks(len(self.data), m + 1, seed):
+            self._split_by_mask(test_mask)
+            yield k
+
+    def _split_by_mask(self, test_mask):
+        """
+        根据测试集掩码生成训练集和测试集。
+        :param test_mask: 测试集的布尔掩码
+        :return:
+        """
         self.test_data = {}
         self.train_data = {}
-        self.data = data or self.data
-        random.seed(seed)
-        for user, item, record in self.data:
-            if random.randint(0, m) == k:
+        for (user, item, record), is_test in zip(self.data, test_mask.tolist()):
+            if is_test:
                 self.test_data.setdefault(user, {})
                 self.test_data[user][item] = record
             else:
                 self.train_data.setdefault(user, {})
                 self.train_data[user][item] = record
+        # 训练集已经改变，之前的推荐结果和评价统计都不再有效
+        self.top_n_cache = None
+        self.metrics_cache = None
+        self._new_model_version()
 
     def user_similarity(self, train=None):
         """
@@ -102,13 +187,60 @@ class UserBasedCF:
                 self.user_sim[u][v] = len(set(train[u].keys()) & set(train[v].keys()))
                 self.user_sim[u][v] /= math.sqrt(len(train[u]) * len(train[v]) * 1.0)
 
-    def user_similarity_best(self, train=None):
+    def user_similarity_best(self, train=None, backend="sparse", top_k=160, n_jobs=1):
         """
         the other method of getting user similarity which is better than above
         you can get the method on page 46
         In this experiment，we use this method
+        :param train: 训练集
+        :param backend: 计算方式，sparse为稀疏矩阵乘法，python为物品-用户倒排表上的循环。
+        :param top_k: sparse方式下为recommend_all保留的邻居个数。
+        :param n_jobs: sparse方式下计算共现矩阵的进程数，-1表示使用所有CPU。
         """
         train = train or self.train_data
+        self.top_n_cache = None
+        self.metrics_cache = None
+        self.ann_index = None
+        self._new_model_version()
+        if backend == "sparse":
+            self._user_similarity_sparse(train, top_k, n_jobs)
+        elif backend == "python":
+            self._user_similarity_python(train)
+        else:
+            raise ValueError("unknown backend: {0}".format(backend))
+
+    def _new_model_version(self):
+        """
+        相似度模型或训练集发生变化，版本加一并清空recommend结果缓存。
+        :return:
+        """
+        self.model_version += 1
+        self.recommend_cache.clear()
+
+    def _user_similarity_sparse(self, train, top_k, n_jobs):
+        """
+        用稀疏矩阵乘法计算用户相似度，结果与倒排表循环的方式相同。
+        user_sim_best只是相似度矩阵上的只读映射，不再构造嵌套字典。
+        :param train:
+        :return:
+        """
+        self.rating_matrix = RatingMatrix.from_dict(train)
+        self.user_cooccurrence = cooccurrence(self.rating_matrix.binary, n_jobs=n_jobs)
+        self.user_sim_matrix = cosine_similarity(self.user_cooccurrence)
+        self.user_sim_best = SimilarityRows(self.user_sim_matrix, self.rating_matrix.user_ids,
+                                            self.rating_matrix.user_index)
+        self.user_neighbors, self.user_neighbor_scores = top_k_neighbors(self.user_sim_matrix, top_k)
+
+    def _user_similarity_python(self, train):
+        """
+        通过物品-用户倒排表计算用户相似度。
+        :param train:
+        :return:
+        """
+        self.rating_matrix = None
+        self.user_cooccurrence = None
+        self.user_neighbors = None
+        self.user_neighbor_scores = None
         self.user_sim_best = dict()
 
         item_users = dict()
@@ -135,7 +267,58 @@ class UserBasedCF:
             for v, cuv in related_users.items():
                 self.user_sim_best[u][v] = cuv / math.sqrt(user_item_count[u] * user_item_count[v] * 1.0)
 
-    def recommend(self, user, train=None, k=8, n_item=40):
+    def build_ann_index(self, n_tables=16, n_bits=6, seed=0):
+        """
+        在L2归一化的0/1用户评分向量上建立随机投影LSH索引，供recommend(use_ann=True)使用。
+        需要先使用sparse方式计算用户相似度。没有调用时recommend(use_ann=True)用默认参数建立索引。
+        :param n_tables: 哈希表个数，越多召回率越高
+        :param n_bits: 每张表的哈希位数，越多每个桶越小
+        :param seed: 随机种子
+        :return:
+        """
+        if self.rating_matrix is None:
+            raise ValueError("build_ann_index requires user_similarity_best(backend='sparse')")
+        self.ann_params = (n_tables, n_bits, seed)
+        self.ann_index = RandomProjectionLSH(n_tables=n_tables, n_bits=n_bits, seed=seed)
+        self.ann_index.fit(normalized_binary_rows(self.rating_matrix))
+
+    def add_ratings(self, batch):
+        """
+        增量加入一批新的评分，更新训练集、评分矩阵和用户共现矩阵，
+        只对共现次数或评价物品数发生变化的用户重新计算相似度和top k邻居。
+        需要先使用sparse方式计算用户相似度。
+        :param batch: (user, item, record)的列表
+        :return:
+        """
+        if self.user_cooccurrence is None:
+            raise ValueError("add_ratings requires user_similarity_best(backend='sparse')")
+        rm = self.rating_matrix
+        old_binary = rm.binary
+        delta = rm.add_ratings(batch)
+        old_binary = resize(old_binary, delta.shape)
+        # 用户共现矩阵为 B * B^T，即以物品为行的矩阵 B^T 的共现
+        self.user_cooccurrence, changed = update_cooccurrence(self.user_cooccurrence, old_binary.T.tocsr(),
+                                                              delta.T.tocsr())
+        rows = affected_rows(self.user_cooccurrence, changed)
+        sim_rows = cosine_similarity(self.user_cooccurrence, rows)
+        user_sim = resize(self.user_sim_matrix, self.user_cooccurrence.shape)
+        self.user_sim_matrix = replace_rows(user_sim, rows, sim_rows)
+        self.user_sim_best = SimilarityRows(self.user_sim_matrix, rm.user_ids, rm.user_index)
+        self.user_neighbors, self.user_neighbor_scores = update_top_k_neighbors(
+            self.user_neighbors, self.user_neighbor_scores, rows, sim_rows)
+
+        for user, item, record in batch:
+            self.train_data.setdefault(user, {})
+            self.train_data[user][item] = record
+        self.top_n_cache = None
+        self.metrics_cache = None
+        # 评分向量已经改变，LSH索引在下次使用时重新建立
+        self.ann_index = None
+        # 训练集已经改变。覆盖已有评分时共现矩阵不变，但以这些用户为邻居的用户的推荐结果也会变化，
+        # 因此整体升级版本，不只删除rows中用户的结果
+        self._new_model_version()
+
+    def recommend(self, user, train=None, k=8, n_item=40, use_ann=False, n_probe=0):
         """
         为指定用户推荐item。选择最相似的k个用户，然后对用户和商品加权排序，
         计算最应该推荐的n_item个商品。
@@ -143,12 +326,37 @@ class UserBasedCF:
         :param train:
         :param k:
         :param n_item:
+        :param use_ann: 是否用build_ann_index建立的LSH索引近似查找相似用户，不对全部相似用户排序。
+        :param n_probe: 近似查找时每张哈希表额外探查的桶数，越大召回率越高、查询越慢。
         :return:
         """
+        # 只缓存使用模型自身训练集的精确推荐
+        if train is not None or use_ann:
+            return self._recommend(user, train, k, n_item, use_ann, n_probe)
+        key = (user, k, n_item, self.model_version)
+        result = self.recommend_cache.get(key)
+        if result is None:
+            result = self._recommend(user, train, k, n_item, use_ann, n_probe)
+            self.recommend_cache.put(key, result)
+        return dict(result)
+
+    def _recommend(self, user, train, k, n_item, use_ann, n_probe):
+        """
+        不使用缓存为指定用户推荐item，参数与recommend相同。
+        """
+        if self.user_sim_best is None:
+            return self._recommend_from_neighbors(user, k, n_item)
         train = train or self.train_data
         rank = dict()
         interacted_items = train.get(user, {})
-        for v, wuv in sorted(self.user_sim_best[user].items(), key=lambda x: x[1], reverse=True)[0:k]:
+        if use_ann:
+            if self.ann_index is None:
+                self.build_ann_index(*(self.ann_params or ()))
+            neighbors, sims = self.ann_index.query(self.rating_matrix.user_index[user], k, n_probe=n_probe)
+            similar_users = zip(self.rating_matrix.user_ids[neighbors].tolist(), sims.tolist())
+        else:
+            similar_users = sorted(self.user_sim_best[user].items(), key=lambda x: x[1], reverse=True)[0:k]
+        for v, wuv in similar_users:
             for i, rvi in train[v].items():
                 if i in interacted_items:
                     continue
@@ -156,30 +364,137 @@ class UserBasedCF:
                 rank[i] += wuv * rvi
         return dict(sorted(rank.items(), key=lambda x: x[1], reverse=True)[0:n_item])
 
+    def _recommend_from_neighbors(self, user, k, n_item):
+        """
+        只有top k邻居数组时（例如从save保存的目录加载）为用户推荐物品。
+        :param user:
+        :param k:
+        :param n_item:
+        :return:
+        """
+        rm = self.rating_matrix
+        u = rm.user_index.get(user)
+        if u is None:
+            return dict()
+        neighbors = self.user_neighbors[u, :k]
+        valid = neighbors >= 0
+        weights = self.user_neighbor_scores[u, :k][valid]
+        rank = np.asarray(rm.matrix[neighbors[valid]].T.dot(weights), dtype=np.float64).ravel()
+        seen = rm.matrix.indices[rm.matrix.indptr[u]:rm.matrix.indptr[u + 1]]
+        return top_n_dict(rank, seen, rm.item_ids, n_item)
+
+    def recommend_all(self, k=8, n_item=10, block_size=1024):
+        """
+        一次为所有用户推荐物品。每个用户的得分为最相似的k个用户的相似度矩阵与评分矩阵的乘积，
+        去掉用户已经评价过的物品后取得分最高的n_item个物品。需要使用sparse方式计算相似度。
+        :param k: 相似用户个数
+        :param n_item: 推荐物品个数
+        :param block_size: 每次计算的用户数，用于控制稠密得分矩阵的内存
+        :return: (n_users, n_item)的物品编码数组，用户顺序与rating_matrix.user_ids一致，不足时用-1填充。
+        """
+        rm = self.rating_matrix
+        sim_k = self.neighbor_matrix(0, k)
+        result = np.empty((rm.n_users, n_item), dtype=np.int32)
+        for start in range(0, rm.n_users, block_size):
+            end = min(start + block_size, rm.n_users)
+            scores = self.partial_scores(start, end, sim_k).toarray()
+            scores[rm.matrix[start:end].nonzero()] = 0
+            result[start:end] = top_n(scores, n_item)
+        return result
+
+    def neighbor_matrix(self, start, end):
+        """
+        每个用户排序后第[start, end)个相似用户构成的稀疏相似度矩阵。
+        :param start:
+        :param end:
+        :return:
+        """
+        if self.user_neighbors is None:
+            raise ValueError("neighbor arrays require user_similarity_best(backend='sparse')")
+        return neighbor_matrix(self.user_neighbors, self.user_neighbor_scores, start, end)
+
+    def partial_scores(self, start, end, sim_part):
+        """
+        计算第[start, end)个用户在部分相似用户上的推荐得分。
+        :param start: 起始用户编码
+        :param end: 结束用户编码
+        :param sim_part: neighbor_matrix返回的部分相似度矩阵
+        :return: 稀疏得分矩阵
+        """
+        return sim_part[start:end] * self.rating_matrix.matrix
+
+    def _top_n(self, k, n_item):
+        """
+        获取recommend_all的结果，相同参数的结果只计算一次。
+        :param k:
+        :param n_item:
+        :return:
+        """
+        if self.top_n_cache is None or self.top_n_cache[0] != (k, n_item):
+            self.top_n_cache = ((k, n_item), self.recommend_all(k=k, n_item=n_item))
+        return self.top_n_cache[1]
+
+    def save(self, path):
+        """
+        保存模型：id编码、CSR评分矩阵和top k邻居数组，每个数组一个.npy文件。
+        :param path: 目录
+        :return:
+        """
+        if self.user_neighbors is None:
+            raise ValueError("save requires user_similarity_best(backend='sparse')")
+        self.rating_matrix.save(path)
+        save_arrays(path, neighbors=self.user_neighbors, neighbor_scores=self.user_neighbor_scores)
+
+    @staticmethod
+    def load(path, mmap=True):
+        """
+        加载save保存的模型，不读取数据文件也不计算相似度。
+        :param path: 目录
+        :param mmap: 是否以只读内存映射的方式加载，多个服务进程可以共享同一份文件页
+        :return: UserBasedCF
+        """
+        model = UserBasedCF()
+        model._new_model_version()
+        model.rating_matrix = RatingMatrix.load(path, mmap)
+        arrays = load_arrays(path, ["neighbors", "neighbor_scores"], mmap)
+        model.user_neighbors = arrays["neighbors"]
+        model.user_neighbor_scores = arrays["neighbor_scores"]
+        return model
+
+    def split_metrics(self, test=None):
+        """
+        当前训练集和测试集上预先统计的评价数据，训练集或测试集变化时重新统计。
+        :param test: 测试集，默认为test_data
+        :return: SplitMetrics
+        """
+        test = test or self.test_data
+        if self.metrics_cache is None or self.metrics_cache.test is not test:
+            self.metrics_cache = SplitMetrics(self.rating_matrix, test)
+        return self.metrics_cache
+
+    def _use_per_user_metrics(self, train):
+        """
+        是否需要逐个用户计算评价指标：传入了其他训练集，或者没有recommend_all需要的邻居数组。
+        :param train:
+        :return:
+        """
+        return (train is not None and train is not self.train_data) or self.user_neighbors is None
+
     def recall_and_precision(self, train=None, test=None, k=8, n_item=10):
         """
         Get the recall and precision.
-        计算召回率和准确率。
+        计算召回率和准确率。推荐结果来自recommend_all，训练集即计算相似度时使用的数据；
+        传入其他训练集或使用python方式计算相似度时逐个用户调用recommend。
         :param train:
         :param test:
         :param k:
         :param n_item:
         :return:
         """
-        train = train or self.train_data
-        test = test or self.test_data
-        hit = 0
-        recall = 0
-        precision = 0
-        for user in train.keys():
-            tu = test.get(user, {})
-            rank = self.recommend(user, train=train, k=k, n_item=n_item)
-            for item, _ in rank.items():
-                if item in tu:
-                    hit += 1
-            recall += len(tu)
-            precision += n_item
-        return hit / (recall * 1.0), hit / (precision * 1.0)
+        if self._use_per_user_metrics(train):
+            metrics = _per_user_metrics(self, train or self.train_data, test or self.test_data, k, n_item)
+            return metrics["recall"], metrics["precision"]
+        return self.split_metrics(test).recall_and_precision(self._top_n(k, n_item))
 
     def coverage(self, train=None, test=None, k=8, n_item=10):
         """
@@ -191,17 +506,9 @@ class UserBasedCF:
         :param n_item:
         :return:
         """
-        train = train or self.train_data
-        test = test or self.test_data
-        recommend_items = set()
-        all_items = set()
-        for user in train.keys():
-            for item in train[user].keys():
-                all_items.add(item)
-            rank = self.recommend(user, train, k=k, n_item=n_item)
-            for item, _ in rank.items():
-                recommend_items.add(item)
-        return len(recommend_items) / (len(all_items) * 1.0)
+        if self._use_per_user_metrics(train):
+            return _per_user_metrics(self, train or self.train_data, test or self.test_data, k, n_item)["coverage"]
+        return self.split_metrics(test).coverage(self._top_n(k, n_item))
 
     def popularity(self, train=None, test=None, k=8, n_item=10):
         """
@@ -213,21 +520,10 @@ class UserBasedCF:
         :param n_item:
         :return:
         """
-        train = train or self.train_data
-        test = test or self.test_data
-        item_popularity = dict()
-        for user, items in train.items():
-            for item in items.keys():
-                item_popularity.setdefault(item, 0)
-                item_popularity[item] += 1
-        ret = 0
-        n = 0
-        for user in train.keys():
-            rank = self.recommend(user, train, k=k, n_item=n_item)
-            for item, _ in rank.items():
-                ret += math.log(1 + item_popularity[item])
-                n += 1
-        return ret / (n * 1.0)
+        if self._use_per_user_metrics(train):
+            return _per_user_metrics(self, train or self.train_data, test or self.test_data, k,
+                                     n_item)["popularity"]
+        return self.split_metrics(test).popularity(self._top_n(k, n_item))
 
 
 class ItemBasedCF(object):
@@ -241,10 +537,19 @@ class ItemBasedCF(object):
         self.train_data = None
         self.test_data = None
         self.item_sim = None
-        self.item_sim_best = None
-
-        self.read_data(self.datafile)
-        self.split_data(3, 47)
+        # 编码后的评分矩阵，以及每个物品最相似的top_k个物品和对应的相似度
+        self.rating_matrix = None
+        self.item_cooccurrence = None
+        self.item_neighbors = None
+        self.item_neighbor_scores = None
+        # 最近一次recommend_all的结果，供各项评价指标共用
+        self.top_n_cache = None
+        # 当前划分的物品流行度和测试矩阵等统计
+        self.metrics_cache = None
+
+        if self.datafile is not None:
+            self.read_data(self.datafile)
+            self.split_data(3, 47)
 
     def read_data(self, datafile=None):
         """
@@ -252,11 +557,8 @@ class ItemBasedCF(object):
         """
         print("read data:")
         self.datafile = datafile or self.datafile
-        self.data = []
-        for line in open(self.datafile):
-            user_id, item_id, record, _ = line.split()
-            self.data.append((user_id, item_id, int(record)))
-            # 格式 [('196', '242', 3), ('186', '302', 3), ('22', '377', 1)]
+        self.data = load_ratings(self.datafile)
+        # 列数组，迭代的格式为 [('196', '242', 3), ('186', '302', 3), ('22', '377', 1)]
 
     def split_data(self, k, seed, data=None, m=8):
         """
@@ -264,13 +566,34 @@ class ItemBasedCF(object):
         test_data is a test data set
         train_data is a train set
         test data set / train data set is 1:M-1
+        对整个数据集只做一次随机抽样得到测试集掩码。
+        """
+        self.data = data or self.data
+        self._split_by_mask(split_mask(len(self.data), k, seed, m + 1))
+
+    def split_folds(self, seed, data=None, m=8):
+        """
+        k折交叉验证，只抽样一次，依次把每一折作为测试集。
+        :param seed: 随机种子
+        :param data: 数据集
+        :param m: 折数为m + 1，与split_data的取值范围一致
+        :return: 当前折的生成器，每次生成时train_data和test_data已经更新
+        """
+        self.data = data or self.data
+        for k, test_mask in kfold_masks(len(self.data), m + 1, seed):
+            self._split_by_mask(test_mask)
+            yield k
+
+    def _split_by_mask(self, test_mask):
+        """
+        根据测试集掩码生成训练集和测试集。
+        :param test_mask: 测试集的布尔掩码
+        :return:
         """
         self.test_data = {}
         self.train_data = {}
-        data = data or self.data
-        random.seed(seed)
-        for user, item, record in self.data:
-            if random.randint(0, m) == k:
+        for (user, item, record), is_test in zip(self.data, test_mask.tolist()):
+            if is_test:
                 self.test_data.setdefault(user, {})
                 self.test_data[user][item] = record
             else:
@@ -278,72 +601,219 @@ class ItemBasedCF(object):
                 self.train_data[user][item] = record
                 # 格式{'291': {'1042': 4, '118': 2}, '200': {'222': 5},
                 # '308': {'1': 4}, '167': {'486': 4}, '122': {'387': 5}, '210': {'40': 3},
+        # 训练集已经改变，之前的推荐结果和评价统计都不再有效
+        self.top_n_cache = None
+        self.metrics_cache = None
 
-    def item_similarity(self, train=None):
+    def item_similarity(self, train=None, top_k=160, n_jobs=1):
         """
         the other method of getting user similarity which is better than above
         In this experiment，we use this method
-        计算物品相似度。
+        计算物品相似度。用稀疏矩阵乘法计算物品共现矩阵并做余弦归一化，
+        每个物品只保留最相似的top_k个物品，保存为(n_items, top_k)的邻居数组和相似度数组。
+        :param train: 训练集
+        :param top_k: 每个物品保留的邻居个数，recommend中的k不能超过该值。
+        :param n_jobs: 计算共现矩阵的进程数，-1表示使用所有CPU。
         """
         train = train or self.train_data
-        self.item_sim_best = dict()
-        n_items = dict()
-        c_items = dict()
-        for u, items in train.items():
-            for i in items:
-                n_items.setdefault(i, 0)
-                n_items[i] += 1
-                for j in items:
-                    if i == j:
-                        continue
-                    c_items.setdefault(i, {})
-                    c_items[i].setdefault(j, 0)
-                    c_items[i][j] += 1
-        for i, related_items in c_items.items():
-            self.item_sim_best.setdefault(i, dict())
-            for j, cij in related_items.items():
-                self.item_sim_best[i][j] = cij / math.sqrt(n_items[i] * n_items[j] * 1.0)
+        self.top_n_cache = None
+        self.metrics_cache = None
+        self.rating_matrix = RatingMatrix.from_dict(train)
+        self.item_cooccurrence = cooccurrence(self.rating_matrix.binary.T, n_jobs=n_jobs)
+        item_sim = cosine_similarity(self.item_cooccurrence)
+        self.item_neighbors, self.item_neighbor_scores = top_k_neighbors(item_sim, top_k)
+
+    def add_ratings(self, batch):
+        """
+        增量加入一批新的评分，更新训练集、评分矩阵和物品共现矩阵，
+        只对共现次数或评价人数发生变化的物品重新计算top k邻居。
+        需要先使用item_similarity计算物品相似度。
+        :param batch: (user, item, record)的列表
+        :return:
+        """
+        if self.item_cooccurrence is None:
+            raise ValueError("add_ratings requires item_similarity()")
+        rm = self.rating_matrix
+        old_binary = rm.binary
+        delta = rm.add_ratings(batch)
+        old_binary = resize(old_binary, delta.shape)
+        self.item_cooccurrence, changed = update_cooccurrence(self.item_cooccurrence, old_binary, delta)
+        rows = affected_rows(self.item_cooccurrence, changed)
+        self.item_neighbors, self.item_neighbor_scores = update_top_k_neighbors(
+            self.item_neighbors, self.item_neighbor_scores, rows, cosine_similarity(self.item_cooccurrence, rows))
+
+        for user, item, record in batch:
+            self.train_data.setdefault(user, {})
+            self.train_data[user][item] = record
+        self.top_n_cache = None
+        self.metrics_cache = None
 
     def recommend(self, user, train=None, k=8, n_item=10):
         """
         为指定用户推荐item。通过用户所有的物品，查找与每个物品最相似的k个物品，
         对物品数量和相似度进行加权排序，得到最合适的n_item个物品。
+        邻居在item_similarity中已经排好序，这里只需要取前k列累加。
         :param user:
-        :param train:
+        :param train: 用户的评分数据，默认使用计算相似度时的评分矩阵。
         :param k:
         :param n_item:
         :return:
         """
-        train = train or self.train_data
-        rank = dict()
-        ru = train.get(user, {})
-        for i, pi in ru.items():
-            for j, wj in sorted(self.item_sim_best[i].items(), key=lambda x: x[1], reverse=True)[0:k]:
-                if j in ru:
-                    continue
-                rank.setdefault(j, 0)
-                rank[j] += pi * wj
-        return dict(sorted(rank.items(), key=lambda x: x[1], reverse=True)[0:n_item])
+        rm = self.rating_matrix
+        if train is None:
+            u = rm.user_index.get(user)
+            if u is None:
+                return dict()
+            start, end = rm.matrix.indptr[u], rm.matrix.indptr[u + 1]
+            items = rm.matrix.indices[start:end]
+            records = rm.matrix.data[start:end]
+        else:
+            ru = [(rm.item_index[i], pi) for i, pi in train.get(user, {}).items() if i in rm.item_index]
+            items = np.array([i for i, _ in ru], dtype=np.int32)
+            records = np.array([pi for _, pi in ru], dtype=np.float32)
+
+        neighbors = self.item_neighbors[items, :k]
+        weights = self.item_neighbor_scores[items, :k] * records[:, np.newaxis]
+        valid = neighbors >= 0
+        rank = np.bincount(neighbors[valid], weights=weights[valid], minlength=rm.n_items)
+        # 用户已经评价过的物品不推荐
+        return top_n_dict(rank, items, rm.item_ids, n_item)
+
+    def recommend_batch(self, users, k=8, n_item=10, sim_k=None):
+        """
+        一次为一批用户推荐物品，与recommend_all相同，用一次稀疏矩阵乘法计算这批用户的得分。
+        :param users: 用户id列表
+        :param k: 每个物品的相似物品个数
+        :param n_item: 推荐物品个数
+        :param sim_k: neighbor_matrix(0, k)的结果，多次调用时可以传入以避免重复构造
+        :return: 与users顺序一致的{item: score}列表，训练集中没有的用户为空字典
+        """
+        rm = self.rating_matrix
+        if sim_k is None:
+            sim_k = self.neighbor_matrix(0, k)
+        rows = [rm.user_index.get(user) for user in users]
+        known = [u for u in rows if u is not None]
+        result = [dict() for _ in users]
+        if not known:
+            return result
+        ratings = rm.matrix[known]
+        scores = (ratings * sim_k).toarray()
+        scores[ratings.nonzero()] = 0
+        recommendations = top_n(scores, n_item)
+        position = 0
+        for i, u in enumerate(rows):
+            if u is None:
+                continue
+            items = recommendations[position]
+            items = items[items >= 0]
+            result[i] = dict(zip(rm.item_ids[items].tolist(), scores[position, items].tolist()))
+            position += 1
+        return result
+
+    def recommend_all(self, k=8, n_item=10, block_size=1024):
+        """
+        一次为所有用户推荐物品。每个用户的得分为评分矩阵与物品top k相似度矩阵的乘积，
+        去掉用户已经评价过的物品后取得分最高的n_item个物品。
+        :param k: 每个物品的相似物品个数
+        :param n_item: 推荐物品个数
+        :param block_size: 每次计算的用户数，用于控制稠密得分矩阵的内存
+        :return: (n_users, n_item)的物品编码数组，用户顺序与rating_matrix.user_ids一致，不足时用-1填充。
+        """
+        rm = self.rating_matrix
+        sim_k = self.neighbor_matrix(0, k)
+        result = np.empty((rm.n_users, n_item), dtype=np.int32)
+        for start in range(0, rm.n_users, block_size):
+            end = min(start + block_size, rm.n_users)
+            scores = self.partial_scores(start, end, sim_k).toarray()
+            scores[rm.matrix[start:end].nonzero()] = 0
+            result[start:end] = top_n(scores, n_item)
+        return result
+
+    def neighbor_matrix(self, start, end):
+        """
+        每个物品排序后第[start, end)个相似物品构成的稀疏相似度矩阵。
+        :param start:
+        :param end:
+        :return:
+        """
+        return neighbor_matrix(self.item_neighbors, self.item_neighbor_scores, start, end)
+
+    def partial_scores(self, start, end, sim_part):
+        """
+        计算第[start, end)个用户在部分相似物品上的推荐得分。
+        :param start: 起始用户编码
+        :param end: 结束用户编码
+        :param sim_part: neighbor_matrix返回的部分相似度矩阵
+        :return: 稀疏得分矩阵
+        """
+        return self.rating_matrix.matrix[start:end] * sim_part
+
+    def _top_n(self, k, n_item):
+        """
+        获取recommend_all的结果，相同参数的结果只计算一次。
+        :param k:
+        :param n_item:
+        :return:
+        """
+        if self.top_n_cache is None or self.top_n_cache[0] != (k, n_item):
+            self.top_n_cache = ((k, n_item), self.recommend_all(k=k, n_item=n_item))
+        return self.top_n_cache[1]
+
+    def save(self, path):
+        """
+        保存模型：id编码、CSR评分矩阵和top k邻居数组，每个数组一个.npy文件。
+        :param path: 目录
+        :return:
+        """
+        if self.item_neighbors is None:
+            raise ValueError("save requires item_similarity()")
+        self.rating_matrix.save(path)
+        save_arrays(path, neighbors=self.item_neighbors, neighbor_scores=self.item_neighbor_scores)
+
+    @staticmethod
+    def load(path, mmap=True):
+        """
+        加载save保存的模型，不读取数据文件也不计算相似度。
+        :param path: 目录
+        :param mmap: 是否以只读内存映射的方式加载，多个服务进程可以共享同一份文件页
+        :return: ItemBasedCF
+        """
+        model = ItemBasedCF()
+        model.rating_matrix = RatingMatrix.load(path, mmap)
+        arrays = load_arrays(path, ["neighbors", "neighbor_scores"], mmap)
+        model.item_neighbors = arrays["neighbors"]
+        model.item_neighbor_scores = arrays["neighbor_scores"]
+        return model
+
+    def split_metrics(self, test=None):
+        """
+        当前训练集和测试集上预先统计的评价数据，训练集或测试集变化时重新统计。
+        :param test: 测试集，默认为test_data
+        :return: SplitMetrics
+        """
+        test = test or self.test_data
+        if self.metrics_cache is None or self.metrics_cache.test is not test:
+            self.metrics_cache = SplitMetrics(self.rating_matrix, test)
+        return self.metrics_cache
+
+    def _use_per_user_metrics(self, train):
+        """
+        是否需要逐个用户计算评价指标：传入了其他训练集时recommend_all的结果不适用。
+        :param train:
+        :return:
+        """
+        return train is not None and train is not self.train_data
 
     def recall_and_precision(self, train=None, test=None, k=8, n_item=10):
         """
         Get the recall and precision.
-        计算召回率和准确率。
+        计算召回率和准确率。推荐结果来自recommend_all，训练集即计算相似度时使用的数据；
+        传入其他训练集时逐个用户调用recommend。
         """
-        train = train or self.train_data
-        test = test or self.test_data
-        hit = 0
-        recall = 0
-        precision = 0
-        for user in train.keys():
-            tu = test.get(user, {})
-            rank = self.recommend(user, train=train, k=k, n_item=n_item)
-            for item, _ in rank.items():
-                if item in tu:
-                    hit += 1
-            recall += len(tu)
-            precision += n_item
-        return hit / (recall * 1.0), hit / (precision * 1.0)
+        if self._use_per_user_metrics(train):
+            metrics = _per_user_metrics(self, train, test or self.test_data, k, n_item)
+            return metrics["recall"], metrics["precision"]
+        return self.split_metrics(test).recall_and_precision(self._top_n(k, n_item))
 
     def coverage(self, train=None, test=None, k=8, n_item=10):
         """
@@ -354,39 +824,19 @@ class ItemBasedCF(object):
         :param n_item:
         :return:
         """
-        train = train or self.train_data
-        test = test or self.test_data
-        recommend_items = set()
-        all_items = set()
-        for user in train.keys():
-            for item in train[user].keys():
-                all_items.add(item)
-            rank = self.recommend(user, train, k=k, n_item=n_item)
-            for item, _ in rank.items():
-                recommend_items.add(item)
-        return len(recommend_items) / (len(all_items) * 1.0)
+        if self._use_per_user_metrics(train):
+            return _per_user_metrics(self, train, test or self.test_data, k, n_item)["coverage"]
+        return self.split_metrics(test).coverage(self._top_n(k, n_item))
 
     def popularity(self, train=None, test=None, k=8, nitem=10):
         """
         Get the popularity.
         计算流行度。
         """
-        train = train or self.train_data
-        test = test or self.test_data
-        item_popularity = dict()
-        for user, items in train.items():
-            for item in items.keys():
-                item_popularity.setdefault(item, 0)
-                item_popularity[item] += 1
-        ret = 0
-        n = 0
-        # 对每一个user进行推荐 计算其流行度
-        for user in train.keys():
-            rank = self.recommend(user, train, k=k, n_item=nitem)
-            for item, _ in rank.items():
-                ret += math.log(1 + item_popularity[item])
-                n += 1
-        return ret / (n * 1.0)
+        # 对每一个user的推荐结果计算其流行度
+        if self._use_per_user_metrics(train):
+            return _per_user_metrics(self, train, test or self.test_data, k, nitem)["popularity"]
+        return self.split_metrics(test).popularity(self._top_n(k, nitem))
 
 
 def test_ubcf_recommend():
@@ -411,17 +861,44 @@ def test_user_based_cf():
     测试UserBasedCF。
     :return:
     """
-    start_time = time.clock()
     cf = UserBasedCF(data_file_path)
     cf.user_similarity_best()
-    print("{0: >3}{1: >20}{2: >20}{3: >20}{4: >20}{5: >20}"
-          .format('K', "recall", 'precision', 'coverage', 'popularity', 'time'))
-    for k in [5, 10, 20, 40, 80, 160]:
-        recall, precision = cf.recall_and_precision(k=k)
-        coverage = cf.coverage(k=k)
-        popularity = cf.popularity(k=k)
-        print("{0: >3}{1: >19.3f}%{2: >19.3f}%{3: >19.3f}%{4: >19.3f}%{5: >19.3f}s".format(
-            k, recall * 100, precision * 100, coverage * 100, popularity, time.clock() - start_time))
+    results = evaluate_multi_k(cf, k_list=[5, 10, 20, 40, 80, 160])
+    print(format_evaluation(results))
+
+
+def test_ann_recommend():
+    """
+    测试用LSH近似查找相似用户，与精确查找比较召回率和单次查询耗时。
+    :return:
+    """
+    cf = UserBasedCF(data_file_path)
+    cf.user_similarity_best()
+    print("{0: <40}{1: >20}{2: >20}".format("method", "recall", "latency"))
+    for row in benchmark_ann(cf, k=20):
+        print("{0: <40}{1: >19.3f}%{2: >18.3f}ms".format(row["method"], row["recall"] * 100, row["latency"] * 1000))
+
+    cf.build_ann_index()
+    user = "345"
+    print(cf.recommend(user, k=20, n_item=10))
+    print(cf.recommend(user, k=20, n_item=10, use_ann=True, n_probe=2))
+
+
+def test_recommend_cache():
+    """
+    测试UserBasedCF推荐结果的缓存。
+    :return:
+    """
+    cf = UserBasedCF(data_file_path)
+    cf.user_similarity_best()
+    users = list(cf.train_data.keys())[0:100]
+    for _ in range(3):
+        for user in users:
+            cf.recommend(user, k=20, n_item=10)
+    common_logger.info("cache stats:{0}".format(cf.recommend_cache.stats()))
+    # 加入新的评分后模型版本加一，之前的结果不再命中
+    cf.add_ratings([(users[0], "1", 5)])
+    common_logger.info("cache stats after add_ratings:{0}".format(cf.recommend_cache.stats()))
 
 
 def test_ibcf_recommend():
@@ -446,17 +923,10 @@ def test_item_based_cf():
     测试ItemBasedCF。
     :return:
     """
-    start_time = time.clock()
     cf = ItemBasedCF(data_file_path)
     cf.item_similarity()
-    print("{0: >3}{1: >20}{2: >20}{3: >20}{4: >20}{5: >20}"
-          .format('K', "recall", 'precision', 'coverage', 'popularity', 'time'))
-    for k in [5, 10, 20, 40, 80, 160]:
-        recall, precision = cf.recall_and_precision(k=k)
-        coverage = cf.coverage(k=k)
-        popularity = cf.popularity(k=k)
-        print("{0: >3}{1: >19.3f}%{2: >19.3f}%{3: >19.3f}%{4: >19.3f}%{5: >19.3f}s".format(
-            k, recall * 100, precision * 100, coverage * 100, popularity, time.clock() - start_time))
+    results = evaluate_multi_k(cf, k_list=[5, 10, 20, 40, 80, 160])
+    print(format_evaluation(results))
 
 
 def test_set():
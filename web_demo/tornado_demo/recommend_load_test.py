@@ -0,0 +1,83 @@
+# -*- coding:utf-8 -*-
+
+# ==============================================================================
+# 推荐服务的压测脚本。
+# 用AsyncHTTPClient保持concurrency个并发请求，分别压测合并请求的/recommend和
+# 逐个调用recommend()的/recommend_direct，输出吞吐量和客户端看到的p50/p99延迟，
+# 最后打印服务端/stats的统计。用户从模型的用户中随机抽取，热门用户会被重复请求。
+# 命令：python recommend_load_test.py --url=http://127.0.0.1:8000 --requests=5000 --concurrency=64
+# ==============================================================================
+import json
+import time
+import numpy as np
+import tornado.gen
+import tornado.ioloop
+from tornado.httpclient import AsyncHTTPClient
+from tornado.options import define, options, parse_command_line
+from web_demo.tornado_demo.recommend_service_demo import load_model
+
+define("url", default="http://127.0.0.1:8000", type=str, help="address of the recommend service.")
+define("requests", default=5000, type=int, help="number of requests for each endpoint.")
+define("concurrency", default=64, type=int, help="number of concurrent requests.")
+define("seed", default=0, type=int, help="random seed of the requested users.")
+
+
+async def run_load(url, users, concurrency):
+    """
+    以固定并发数请求所有用户。
+    :param url: 接口地址前缀，后面拼接用户id
+    :param users: 请求的用户id列表
+    :param concurrency: 并发数
+    :return: 总耗时和每个请求的耗时
+    """
+    client = AsyncHTTPClient(max_clients=concurrency)
+    queue = iter(users)
+    latencies = []
+
+    async def worker():
+        for user in queue:
+            start_time = time.perf_counter()
+            await client.fetch(url + user)
+            latencies.append(time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    await tornado.gen.multi([worker() for _ in range(concurrency)])
+    return time.perf_counter() - start_time, np.array(latencies)
+
+
+def format_result(name, elapsed, latencies):
+    """
+    格式化一个接口的压测结果。
+    :param name: 接口名称
+    :param elapsed: 总耗时
+    :param latencies: 每个请求的耗时
+    :return:
+    """
+    p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+    return "{0: <10} requests={1} qps={2:.1f} p50={3:.2f}ms p99={4:.2f}ms".format(
+        name, len(latencies), len(latencies) / elapsed, p50, p99)
+
+
+def test_load():
+    """
+    压测合并请求和逐个请求两种方式。
+    :return:
+    """
+    parse_command_line()
+    model = load_model(options.model_path)
+    rng = np.random.RandomState(options.seed)
+    # 按Zipf分布抽取用户，模拟热门用户的重复请求
+    ranks = np.minimum(rng.zipf(1.2, options.requests), model.rating_matrix.n_users) - 1
+    users = model.rating_matrix.user_ids[ranks].tolist()
+
+    io_loop = tornado.ioloop.IOLoop.current()
+    for name, path in [("direct", "/recommend_direct/"), ("batched", "/recommend/")]:
+        elapsed, latencies = io_loop.run_sync(
+            lambda: run_load(options.url + path, users, options.concurrency))
+        print(format_result(name, elapsed, latencies))
+    response = io_loop.run_sync(lambda: AsyncHTTPClient().fetch(options.url + "/stats"))
+    print(json.dumps(json.loads(response.body.decode("utf-8")), indent=2))
+
+
+if __name__ == "__main__":
+    test_load()
@@ -0,0 +1,241 @@
+# -*- coding:utf-8 -*-
+
+# ==============================================================================
+# 基于tornado的异步推荐服务。
+# 1. 服务启动时用ItemBasedCF.load加载一次训练好的模型（内存映射），之后所有请求共用该模型。
+# 2. RecommendBatcher合并请求：请求先进入等待队列，同一个用户的并发请求共用一个Future；
+#    第一个请求到达后等待window秒（或队列达到max_batch个用户），再把队列中的所有用户
+#    交给ItemBasedCF.recommend_batch，用一次稀疏矩阵乘法完成打分。
+#    打分在单独的线程中执行，IOLoop在打分期间继续接收请求，这些请求进入下一批。
+# 3. LatencyStats记录最近的请求耗时，/stats返回p50/p99延迟以及批次和合并的计数。
+# 4. /recommend_direct/<user>每个请求直接调用recommend()，作为对比的基准，
+#    压测脚本见recommend_load_test.py。
+# 命令：python recommend_service_demo.py --port=8000 --model_path=<模型目录>
+# ==============================================================================
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import tornado.ioloop
+import tornado.web
+import tornado.httpserver
+from tornado.concurrent import Future
+from tornado.web import RequestHandler
+from tornado.options import define, options, parse_command_line
+import config.common_config as com_config
+from recommend_system.user_item_base_cf import ItemBasedCF, data_file_path
+from util.log_util import LoggerUtil
+
+# 日志器
+common_logger = LoggerUtil.get_common_logger()
+
+define("port", default=8000, type=int, help="run server on the given port.")
+define("model_path", default=os.path.join(com_config.RESOURCE_DIR, "ibcf_model"), type=str,
+       help="directory of the model saved by ItemBasedCF.save.")
+define("window", default=0.001, type=float, help="seconds to wait for more requests before scoring a batch.")
+define("max_batch", default=256, type=int, help="score the batch at once when this many users are queued.")
+define("k", default=8, type=int, help="number of similar items.")
+define("n_item", default=10, type=int, help="number of recommended items.")
+
+
+class LatencyStats(object):
+    def __init__(self, size=10000):
+        """
+        构造函数。
+        :param size: 保留最近多少个请求的耗时
+        """
+        self.latencies = deque(maxlen=size)
+        self.count = 0
+
+    def add(self, seconds):
+        """
+        记录一次请求的耗时。
+        :param seconds: 秒
+        :return:
+        """
+        self.latencies.append(seconds)
+        self.count += 1
+
+    def summary(self):
+        """
+        请求数和最近请求的p50/p99延迟，单位毫秒。
+        :return:
+        """
+        if not self.latencies:
+            return {"count": self.count, "p50": 0.0, "p99": 0.0}
+        p50, p99 = np.percentile(np.array(self.latencies), [50, 99]) * 1000
+        return {"count": self.count, "p50": float(p50), "p99": float(p99)}
+
+
+class RecommendBatcher(object):
+    def __init__(self, model, k=8, n_item=10, window=0.001, max_batch=256):
+        """
+        构造函数。
+        :param model: 已经加载的ItemBasedCF
+        :param k: 每个物品的相似物品个数
+        :param n_item: 推荐物品个数
+        :param window: 合并请求的时间窗口，秒
+        :param max_batch: 每批最多的用户数
+        """
+        self.model = model
+        self.k = k
+        self.n_item = n_item
+        self.window = window
+        self.max_batch = max_batch
+        # 相似度矩阵只构造一次
+        self.sim_k = model.neighbor_matrix(0, k)
+        # 只用一个线程打分，保证同一时间只有一批在计算
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = dict()
+        self.flush_handle = None
+        self.batches = 0
+        self.batch_users = 0
+        self.coalesced = 0
+
+    def recommend(self, user):
+        """
+        把用户加入等待队列，已经在队列中的用户直接共用同一个结果。
+        :param user: 用户id
+        :return: 结果为{item: score}的Future
+        """
+        future = self.pending.get(user)
+        if future is not None:
+            self.coalesced += 1
+            return future
+        future = Future()
+        self.pending[user] = future
+        io_loop = tornado.ioloop.IOLoop.current()
+        if len(self.pending) >= self.max_batch:
+            if self.flush_handle is not None:
+                io_loop.remove_timeout(self.flush_handle)
+                self.flush_handle = None
+            io_loop.add_callback(self.flush)
+        elif self.flush_handle is None:
+            self.flush_handle = io_loop.call_later(self.window, self.flush)
+        return future
+
+    async def flush(self):
+        """
+        取出等待队列中的所有用户，在线程中一次打分后设置各自的结果。
+        :return:
+        """
+        self.flush_handle = None
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, dict()
+        users = list(batch.keys())
+        self.batches += 1
+        self.batch_users += len(users)
+        try:
+            results = await tornado.ioloop.IOLoop.current().run_in_executor(
+                self.executor, self.model.recommend_batch, users, self.k, self.n_item, self.sim_k)
+        except Exception as e:
+            for future in batch.values():
+                future.set_exception(e)
+            return
+        for user, result in zip(users, results):
+            batch[user].set_result(result)
+
+    def summary(self):
+        """
+        批次和请求合并的计数。
+        :return:
+        """
+        return {"batches": self.batches,
+                "mean_batch_size": self.batch_users / float(self.batches) if self.batches else 0.0,
+                "coalesced": self.coalesced}
+
+
+class RecommendHandler(RequestHandler):
+    def initialize(self, batcher, stats):
+        self.batcher = batcher
+        self.stats = stats
+
+    async def get(self, user):
+        start_time = time.perf_counter()
+        result = await self.batcher.recommend(user)
+        self.set_header("Content-type", "application/json; charset=utf-8")
+        self.write(json.dumps({"user": user, "items": result}))
+        self.stats.add(time.perf_counter() - start_time)
+
+
+class DirectRecommendHandler(RequestHandler):
+    def initialize(self, model, stats, k, n_item):
+        self.model = model
+        self.stats = stats
+        self.k = k
+        self.n_item = n_item
+
+    def get(self, user):
+        start_time = time.perf_counter()
+        result = self.model.recommend(user, k=self.k, n_item=self.n_item)
+        self.set_header("Content-type", "application/json; charset=utf-8")
+        self.write(json.dumps({"user": user, "items": result}))
+        self.stats.add(time.perf_counter() - start_time)
+
+
+class StatsHandler(RequestHandler):
+    def initialize(self, batcher, stats):
+        self.batcher = batcher
+        self.stats = stats
+
+    def get(self):
+        result = dict((name, stats.summary()) for name, stats in self.stats.items())
+        result["batcher"] = self.batcher.summary()
+        self.set_header("Content-type", "application/json; charset=utf-8")
+        self.write(json.dumps(result))
+
+
+def load_model(model_path):
+    """
+    加载训练好的模型，模型目录不存在时用ml-100k训练一个并保存。
+    :param model_path: 模型目录
+    :return: ItemBasedCF
+    """
+    if not os.path.exists(model_path):
+        common_logger.info("train model and save to {0}".format(model_path))
+        cf = ItemBasedCF(data_file_path)
+        cf.item_similarity()
+        cf.save(model_path)
+    return ItemBasedCF.load(model_path)
+
+
+def make_app(model, k=8, n_item=10, window=0.001, max_batch=256):
+    """
+    创建推荐服务应用。
+    :param model: 已经加载的ItemBasedCF
+    :param k: 每个物品的相似物品个数
+    :param n_item: 推荐物品个数
+    :param window: 合并请求的时间窗口，秒
+    :param max_batch: 每批最多的用户数
+    :return:
+    """
+    batcher = RecommendBatcher(model, k=k, n_item=n_item, window=window, max_batch=max_batch)
+    stats = {"batched": LatencyStats(), "direct": LatencyStats()}
+    return tornado.web.Application([
+        (r"/recommend/(\w+)", RecommendHandler, {"batcher": batcher, "stats": stats["batched"]}),
+        (r"/recommend_direct/(\w+)", DirectRecommendHandler,
+         {"model": model, "stats": stats["direct"], "k": k, "n_item": n_item}),
+        (r"/stats", StatsHandler, {"batcher": batcher, "stats": stats}),
+    ])
+
+
+def test_recommend_service():
+    """
+    测试推荐服务。
+    命令python recommend_service_demo.py --port=8000 --window=0.001
+    :return:
+    """
+    parse_command_line()
+    model = load_model(options.model_path)
+    app = make_app(model, k=options.k, n_item=options.n_item, window=options.window, max_batch=options.max_batch)
+    http_server = tornado.httpserver.HTTPServer(app)
+    http_server.listen(options.port)
+    common_logger.info("recommend service listen on {0}".format(options.port))
+    tornado.ioloop.IOLoop.current().start()
+
+
+if __name__ == "__main__":
+    test_recommend_service()